@@ -0,0 +1,517 @@
+"""Local stand-in FHIR server, for end to end load tests of export and upload
+
+Serves the NDJSON files of a directory (see `generate.py`) as the output of
+a Bulk `$export`, and accepts uploads, enough of the FHIR API for
+`fhir_server_export.run_export()` and `api.main()` to run against:
+
+  OPTIONS, GET [base]/metadata     CapabilityStatement of the served types
+  GET [base]/<Type>?_summary=count  count of a type, and `_count=N` samples
+  GET [base]/$export                kickoff; honors `_type`
+  GET [base]/$export-poll-status/N  202 with Retry-After and X-Progress until
+                                    the export completes, then the manifest
+  DELETE [base]/$export-poll-status/N  cancel
+  GET [base]/$export-output/N       output file, honoring Range; gzip encoded
+                                    if accepted, for requests without Range
+  PUT, PATCH [base]/<Type>/<id>     JSON resource, or JSON Patch
+  POST [base]                       batch or transaction Bundle
+  GET, DELETE [base]/$stats         request, status and upload counts; reset
+
+Uploads are validated and counted, not stored.  Latency is added to every
+request, and errors (500) and throttling (429, with Retry-After) injected
+into uploads at the configured rates; in a batch Bundle errors are
+injected per entry, and fail a transaction whole.
+
+    python benchmarks/fhir_server.py /tmp/bench-data --port 8080 --latency 0.005 --error-rate 0.01
+    python timewarp/api.py --concurrency 8 http://127.0.0.1:8080/fhir 1 /tmp/warp
+"""
+import argparse
+from collections import Counter
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "timewarp"))
+
+from fhir_server_export import file_resource_type  # noqa: E402
+from json_codec import JSONDecodeError, dumps, loads  # noqa: E402
+
+FHIR_JSON = "application/fhir+json"
+JSON_PATCH = "application/json-patch+json"
+COPY_CHUNK_SIZE = 1024 * 1024
+GZIP_LEVEL = 3
+
+
+def outcome(diagnostics: str, code: str = "exception") -> dict:
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": code, "diagnostics": diagnostics}]}
+
+
+class OutputFile:
+    """An NDJSON file of the data directory, served as export output"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.resource_type = file_resource_type(path)
+        self.count = 0
+        with open(path, 'rb') as ndjson_file:
+            for line in ndjson_file:
+                if not line.strip():
+                    continue
+                if self.resource_type is None:
+                    self.resource_type = loads(line)["resourceType"]
+                self.count += 1
+        self._gzip_path = None
+        self._gzip_lock = threading.Lock()
+
+    def gzip_path(self, directory: str) -> str:
+        """Path of a gzip compressed copy of the file in directory, made on first use"""
+        with self._gzip_lock:
+            if self._gzip_path is None:
+                path = os.path.join(directory, os.path.basename(self.path) + ".gz")
+                with open(self.path, 'rb') as source, gzip.open(
+                        path, 'wb', compresslevel=GZIP_LEVEL) as target:
+                    shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+                self._gzip_path = path
+            return self._gzip_path
+
+
+class ExportJob:
+    def __init__(self, files: List[Tuple[int, OutputFile]], duration: float, request: str):
+        self.files = files
+        self.started = time.monotonic()
+        self.duration = duration
+        self.request = request
+        self.transaction_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    def progress(self) -> float:
+        if self.duration <= 0:
+            return 1.0
+        return min((time.monotonic() - self.started) / self.duration, 1.0)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the stand-in's data, configuration and stats"""
+    daemon_threads = True
+
+    def __init__(
+            self, data_dir: str, host: str = "127.0.0.1", port: int = 0, base_path: str = "/fhir",
+            latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+            throttle_rate: float = 0.0, retry_after: float = 1.0, export_seconds: float = 2.0,
+            poll_retry_after: float = 1.0, patch: bool = True, gzip: bool = True,
+            seed: int = 0):
+        super().__init__((host, port), StandInHandler)
+        self.base_path = "/" + base_path.strip("/") if base_path.strip("/") else ""
+        self.output_files = [
+            OutputFile(os.path.join(data_dir, filename))
+            for filename in sorted(os.listdir(data_dir)) if filename.endswith(".ndjson")]
+        self.latency, self.jitter = latency, jitter
+        self.error_rate, self.throttle_rate = error_rate, throttle_rate
+        self.retry_after = retry_after
+        self.export_seconds, self.poll_retry_after = export_seconds, poll_retry_after
+        self.patch = patch
+        # compressed copies of the output files, for gzip encoded responses
+        self.gzip_dir = tempfile.mkdtemp(prefix="fhir-stand-in-") if gzip else None
+        self.jobs: Dict[int, ExportJob] = {}
+        self.counters: Counter = Counter()
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{self.base_path}"
+
+    def resource_types(self) -> List[str]:
+        return sorted({output_file.resource_type for output_file in self.output_files})
+
+    def count(self, *keys: str, amount: int = 1):
+        with self.lock:
+            for key in keys:
+                self.counters[key] += amount
+
+    def draw(self) -> float:
+        with self.lock:
+            return self.random.random()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(sorted(self.counters.items()))
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters.clear()
+
+    def server_close(self):
+        super().server_close()
+        if self.gzip_dir is not None:
+            shutil.rmtree(self.gzip_dir, ignore_errors=True)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as a real server would
+    server: StandInServer
+
+    def log_message(self, *args):
+        pass
+
+    # -- helpers
+
+    def _send(self, status: int, body=None, headers=(), content_type: str = FHIR_JSON):
+        if body is not None and not isinstance(body, bytes):
+            body = dumps(body)
+        body = body or b""
+        self.send_response(status)
+        if body:
+            self.send_header("Content-Type", content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(f"status {status}")
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _route(self) -> Tuple[Optional[List[str]], dict]:
+        """Path segments relative to the base path (None if outside it), and query"""
+        url = urlparse(self.path)
+        path = re.sub("/+", "/", url.path)
+        if not (path == self.server.base_path or path.startswith(self.server.base_path + "/")):
+            return None, {}
+        segments = [s for s in path[len(self.server.base_path):].split("/") if s]
+        return segments, parse_qs(url.query)
+
+    def _delay(self):
+        if self.server.latency or self.server.jitter:
+            time.sleep(self.server.latency + self.server.jitter * self.server.draw())
+
+    def _inject(self) -> bool:
+        """Respond with an injected 429 or 500, at the configured rates; True if so"""
+        draw = self.server.draw()
+        if draw < self.server.throttle_rate:
+            self._send(
+                429, outcome("injected throttling", "throttled"),
+                headers=[("Retry-After", f"{self.server.retry_after:g}")])
+            return True
+        if draw < self.server.throttle_rate + self.server.error_rate:
+            self._send(500, outcome("injected error"))
+            return True
+        return False
+
+    def _dispatch(self, method: str):
+        self.server.count(f"request {method}")
+        self.body = self._read_body()  # always consumed, keeping the connection usable
+        segments, query = self._route()
+        self._delay()
+        if segments is None:
+            return self._send(404, outcome(f"not found: {self.path}", "not-found"))
+        handler = getattr(self, f"_{method.lower()}", None)
+        return handler(segments, query)
+
+    def do_OPTIONS(self):
+        self._dispatch("OPTIONS")
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    # -- interactions
+
+    def _options(self, segments, query):
+        self._send(200, self._capability_statement())
+
+    def _capability_statement(self) -> dict:
+        interactions = [{"code": code} for code in ("read", "update", "patch", "search-type")]
+        return {
+            "resourceType": "CapabilityStatement", "status": "active", "kind": "instance",
+            "fhirVersion": "4.0.1", "format": ["json"],
+            "rest": [{"mode": "server", "resource": [
+                {"type": resource_type, "interaction": interactions}
+                for resource_type in self.server.resource_types()]}]}
+
+    def _get(self, segments, query):
+        if segments == ["metadata"]:
+            return self._send(200, self._capability_statement())
+        if segments == ["$export"]:
+            return self._kickoff(query)
+        if len(segments) == 2 and segments[0] == "$export-poll-status":
+            return self._poll(segments[1])
+        if len(segments) == 2 and segments[0] == "$export-output":
+            return self._output(segments[1])
+        if segments == ["$stats"]:
+            return self._send(200, self.server.stats(), content_type="application/json")
+        if len(segments) == 1:
+            return self._search(segments[0], query)
+        self._send(404, outcome(f"not found: {self.path}", "not-found"))
+
+    def _search(self, resource_type: str, query: dict):
+        files = [f for f in self.server.output_files if f.resource_type == resource_type]
+        total = sum(output_file.count for output_file in files)
+        bundle = {"resourceType": "Bundle", "type": "searchset", "total": total}
+        if query.get("_summary") != ["count"]:
+            wanted = int(query.get("_count", ["20"])[0])
+            entries = []
+            for output_file in files:
+                with open(output_file.path, 'rb') as ndjson_file:
+                    for line in ndjson_file:
+                        if len(entries) >= wanted:
+                            break
+                        if line.strip():
+                            entries.append({"resource": loads(line)})
+            bundle["entry"] = entries
+        self._send(200, bundle)
+
+    def _kickoff(self, query: dict):
+        types = set(",".join(query.get("_type", [])).split(",")) - {""}
+        files = [
+            (index, output_file) for index, output_file in enumerate(self.server.output_files)
+            if not types or output_file.resource_type in types]
+        with self.server.lock:
+            job_id = len(self.server.jobs)
+            self.server.jobs[job_id] = ExportJob(
+                files, self.server.export_seconds, f"{self.server.base_url}{self.path}")
+        self.server.count("exports")
+        self._send(202, headers=[(
+            "Content-Location", f"{self.server.base_url}/$export-poll-status/{job_id}")])
+
+    def _job(self, job_id: str) -> Optional[ExportJob]:
+        job = self.server.jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            self._send(404, outcome(f"no export job {job_id}", "not-found"))
+        return job
+
+    def _poll(self, job_id: str):
+        job = self._job(job_id)
+        if job is None:
+            return
+        progress = job.progress()
+        if progress < 1.0:
+            return self._send(202, headers=[
+                ("Retry-After", f"{self.server.poll_retry_after:g}"),
+                ("X-Progress", f"in progress, {progress:.0%}")])
+        self._send(200, {
+            "transactionTime": job.transaction_time,
+            "request": job.request,
+            "requiresAccessToken": False,
+            "output": [
+                {"type": output_file.resource_type, "count": output_file.count,
+                 "url": f"{self.server.base_url}/$export-output/{index}"}
+                for index, output_file in job.files],
+            "error": [],
+        }, content_type="application/json")
+
+    def _output(self, index: str):
+        if not index.isdigit() or int(index) >= len(self.server.output_files):
+            return self._send(404, outcome(f"no output file {index}", "not-found"))
+        output_file = self.server.output_files[int(index)]
+        path, start, end = output_file.path, 0, output_file.size - 1
+        status, headers = 200, [("Accept-Ranges", "bytes")]
+        range_header = self.headers.get("Range")
+        accept_encoding = self.headers.get("Accept-Encoding", "")
+        if (not range_header and self.server.gzip_dir is not None
+                and "gzip" in [
+                    value.split(";")[0].strip() for value in accept_encoding.split(",")]):
+            path = output_file.gzip_path(self.server.gzip_dir)
+            end = os.path.getsize(path) - 1
+            headers.append(("Content-Encoding", "gzip"))
+        elif range_header:
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header.strip())
+            if match is None or int(match.group(1)) >= output_file.size:
+                return self._send(
+                    416, headers=[("Content-Range", f"bytes */{output_file.size}")])
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            status = 206
+            headers.append(("Content-Range", f"bytes {start}-{end}/{output_file.size}"))
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+ndjson")
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        with open(path, 'rb') as ndjson_file:
+            ndjson_file.seek(start)
+            while length > 0:
+                chunk = ndjson_file.read(min(COPY_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                length -= len(chunk)
+        self.server.count(f"status {status}")
+        self.server.count("output bytes", amount=end - start + 1)
+
+    def _delete(self, segments, query):
+        if segments == ["$stats"]:
+            self.server.reset_stats()
+            return self._send(204)
+        if len(segments) == 2 and segments[0] == "$export-poll-status":
+            if self._job(segments[1]) is not None:
+                del self.server.jobs[int(segments[1])]
+                self._send(202)
+            return
+        self._send(405, outcome("delete not supported", "not-supported"))
+
+    def _put(self, segments, query):
+        body = self.body
+        if len(segments) != 2:
+            return self._send(400, outcome("PUT requires [base]/<Type>/<id>", "invalid"))
+        if self._inject():
+            return
+        try:
+            resource = loads(body)
+        except JSONDecodeError as e:
+            return self._send(400, outcome(f"invalid JSON: {e}", "invalid"))
+        if [resource.get("resourceType"), resource.get("id")] != segments:
+            return self._send(400, outcome("resourceType/id don't match the URL", "invalid"))
+        self.server.count("resources updated", "updates PUT")
+        self.server.count("upload bytes", amount=len(body))
+        self._send(200)
+
+    def _patch(self, segments, query):
+        body = self.body
+        if not self.server.patch:
+            return self._send(405, outcome("PATCH not supported", "not-supported"))
+        if len(segments) != 2:
+            return self._send(400, outcome("PATCH requires [base]/<Type>/<id>", "invalid"))
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != JSON_PATCH:
+            return self._send(415, outcome("only JSON Patch is supported", "not-supported"))
+        if self._inject():
+            return
+        try:
+            operations = loads(body)
+        except JSONDecodeError as e:
+            return self._send(400, outcome(f"invalid JSON: {e}", "invalid"))
+        if not isinstance(operations, list) or not all(
+                isinstance(op, dict) and "op" in op and "path" in op for op in operations):
+            return self._send(400, outcome("invalid JSON Patch", "invalid"))
+        self.server.count("resources updated", "updates PATCH")
+        self.server.count("upload bytes", amount=len(body))
+        self._send(200)
+
+    def _post(self, segments, query):
+        body = self.body
+        if segments:
+            return self._send(
+                400, outcome("only Bundles POSTed to [base] are supported", "invalid"))
+        if self._inject():
+            return
+        try:
+            bundle = loads(body)
+        except JSONDecodeError as e:
+            return self._send(400, outcome(f"invalid JSON: {e}", "invalid"))
+        bundle_type = bundle.get("type")
+        if bundle.get("resourceType") != "Bundle" or bundle_type not in ("batch", "transaction"):
+            return self._send(400, outcome("expected a batch or transaction Bundle", "invalid"))
+
+        entries = []
+        for entry in bundle.get("entry", []):
+            if self.server.draw() < self.server.error_rate:
+                entries.append({"response": {
+                    "status": "500 Internal Server Error",
+                    "outcome": outcome("injected error")}})
+            else:
+                entries.append({"response": {"status": "200 OK"}})
+        failed = sum(entry["response"]["status"][0] != "2" for entry in entries)
+        if bundle_type == "transaction" and failed:
+            return self._send(500, outcome(f"transaction failed; {failed} injected error(s)"))
+        self.server.count("resources updated", amount=len(entries) - failed)
+        self.server.count(f"updates {bundle_type}", amount=len(entries) - failed)
+        self.server.count("upload bytes", amount=len(body))
+        self._send(200, {
+            "resourceType": "Bundle", "type": f"{bundle_type}-response", "entry": entries})
+
+
+def serve(data_dir: str, **options) -> StandInServer:
+    """Start a stand-in server on a background thread; stop with `shutdown()`"""
+    server = StandInServer(data_dir, **options)
+    threading.Thread(target=server.serve_forever, name="fhir-stand-in", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a local stand-in FHIR server for load tests")
+    parser.add_argument(
+        "data_dir", help="Directory of NDJSON files to serve as export output, see generate.py")
+    parser.add_argument("--host", action="store", help="Address to listen on", default="127.0.0.1")
+    parser.add_argument(
+        "--port", action="store", help="Port to listen on", type=int, default=8080)
+    parser.add_argument(
+        "--base-path", action="store", help="Path of the FHIR base URL", default="/fhir")
+    parser.add_argument(
+        "--latency", action="store", help="Seconds added to every request",
+        type=float, default=0.0)
+    parser.add_argument(
+        "--jitter", action="store",
+        help="Up to this many more seconds, at random, added to every request",
+        type=float, default=0.0)
+    parser.add_argument(
+        "--error-rate", action="store",
+        help="Fraction of uploads (and batch entries) failed with a 500",
+        type=float, default=0.0)
+    parser.add_argument(
+        "--throttle-rate", action="store", help="Fraction of uploads refused with a 429",
+        type=float, default=0.0)
+    parser.add_argument(
+        "--retry-after", action="store", help="Retry-After seconds of 429 responses",
+        type=float, default=1.0)
+    parser.add_argument(
+        "--export-seconds", action="store", help="Seconds each export takes to complete",
+        type=float, default=2.0)
+    parser.add_argument(
+        "--poll-retry-after", action="store",
+        help="Retry-After seconds of export status responses", type=float, default=1.0)
+    parser.add_argument(
+        "--no-patch", action="store_true",
+        help="Refuse PATCH with a 405, as servers without JSON Patch support do")
+    parser.add_argument(
+        "--no-gzip", action="store_true",
+        help="Serve export output unencoded, even when gzip is accepted")
+    parser.add_argument(
+        "--seed", action="store", help="Random seed of the injected failures",
+        type=int, default=0)
+
+    args = parser.parse_args()
+    server = StandInServer(
+        args.data_dir, host=args.host, port=args.port, base_path=args.base_path,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        export_seconds=args.export_seconds, poll_retry_after=args.poll_retry_after,
+        patch=not args.no_patch, gzip=not args.no_gzip, seed=args.seed)
+    print(
+        f"serving {len(server.output_files)} file(s) of {', '.join(server.resource_types())} "
+        f"at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
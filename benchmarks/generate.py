@@ -0,0 +1,227 @@
+"""Seeded generator of synthetic FHIR export data, for benchmarks
+
+Writes NDJSON files, one per resource type and named as export output is
+(`<name>.<Type>.ndjson`, see `fhir_server_export.local_filename_for()`),
+holding any number of resources, from 10k to 10M or more.
+
+Resources are copies of templates: the QuestionnaireResponse and
+Questionnaire fixtures in `r4/`, plus the typical clinical resources of
+`CLINICAL_TEMPLATES`.  Each copy gets a new id and subject, and every date
+of the template is moved by the same random offset, keeping the template's
+precision (date, datetime or partial).  Types are drawn by `TYPE_MIX`
+weights; output depends only on the seed and number of resources.
+
+    python benchmarks/generate.py /tmp/bench-data --resources 100000 --seed 1
+"""
+import argparse
+from collections import Counter
+import json
+import os
+import random
+import sys
+from typing import Dict, List, Tuple, Union
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "timewarp"))
+
+from json_codec import dumps, loads  # noqa: E402
+from timeshift import shift_date_value  # noqa: E402
+
+R4_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "r4")
+
+# Relative frequency of each resource type, roughly that of a clinical store
+TYPE_MIX = {
+    "Observation": 45,
+    "QuestionnaireResponse": 15,
+    "Encounter": 12,
+    "Procedure": 8,
+    "MedicationRequest": 8,
+    "Condition": 6,
+    "Patient": 5,
+    "Questionnaire": 1,
+}
+
+CLINICAL_TEMPLATES = {
+    "Patient": {
+        "resourceType": "Patient", "id": "template",
+        "meta": {"versionId": "1", "lastUpdated": "2023-01-04T12:00:11.244-04:00"},
+        "name": [{"family": "Mock", "given": ["Data"]}],
+        "gender": "female", "birthDate": "1971-05-23",
+        "identifier": [{
+            "system": "http://example.org/mrn", "value": "000000",
+            "period": {"start": "2015-02-07"}}],
+    },
+    "Encounter": {
+        "resourceType": "Encounter", "id": "template",
+        "meta": {"versionId": "1", "lastUpdated": "2023-01-04T12:00:11.244-04:00"},
+        "status": "finished",
+        "class": {"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "AMB"},
+        "subject": {"reference": "Patient/template"},
+        "period": {"start": "2022-08-17T09:30:00-07:00", "end": "2022-08-17T10:15:00-07:00"},
+        "reasonCode": [{"text": "Follow up"}],
+    },
+    "Observation": {
+        "resourceType": "Observation", "id": "template",
+        "meta": {"versionId": "1", "lastUpdated": "2023-01-04T12:00:11.244-04:00"},
+        "status": "final",
+        "category": [{"coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/observation-category",
+            "code": "vital-signs"}]}],
+        "code": {"coding": [{"system": "http://loinc.org", "code": "85354-9",
+                             "display": "Blood pressure panel"}]},
+        "subject": {"reference": "Patient/template"},
+        "effectiveDateTime": "2022-08-17T09:45:00-07:00",
+        "issued": "2022-08-17T09:47:12.318-07:00",
+        "component": [
+            {"code": {"coding": [{"system": "http://loinc.org", "code": "8480-6"}]},
+             "valueQuantity": {"value": 128, "unit": "mmHg"}},
+            {"code": {"coding": [{"system": "http://loinc.org", "code": "8462-4"}]},
+             "valueQuantity": {"value": 84, "unit": "mmHg"}},
+        ],
+    },
+    "Procedure": {
+        "resourceType": "Procedure", "id": "template",
+        "meta": {"versionId": "1", "lastUpdated": "2023-01-04T12:00:11.244-04:00"},
+        "status": "completed",
+        "code": {"text": "Depression screening"},
+        "subject": {"reference": "Patient/template"},
+        "performedPeriod": {"start": "2022-01-06T13:00:00Z", "end": "2022-01-06T13:20:00Z"},
+    },
+    "MedicationRequest": {
+        "resourceType": "MedicationRequest", "id": "template",
+        "meta": {"versionId": "1", "lastUpdated": "2023-01-04T12:00:11.244-04:00"},
+        "status": "active", "intent": "order",
+        "medicationCodeableConcept": {"text": "sertraline 50 MG Oral Tablet"},
+        "subject": {"reference": "Patient/template"},
+        "authoredOn": "2022-01-06",
+        "dosageInstruction": [{"text": "1 tablet daily", "timing": {"repeat": {
+            "boundsPeriod": {"start": "2022-01-07", "end": "2022-07-07"}}}}],
+        "dispenseRequest": {"validityPeriod": {"start": "2022-01-06", "end": "2023-01-06"}},
+    },
+    "Condition": {
+        "resourceType": "Condition", "id": "template",
+        "meta": {"versionId": "1", "lastUpdated": "2023-01-04T12:00:11.244-04:00"},
+        "clinicalStatus": {"coding": [{"code": "active"}]},
+        "code": {"text": "Major depressive disorder"},
+        "subject": {"reference": "Patient/template"},
+        "onsetDateTime": "2021-11",
+        "recordedDate": "2021-12-24T08:12:00-08:00",
+    },
+}
+
+# Days, at most, any copy's dates are moved back from the template's
+MAX_OFFSET_DAYS = 3650
+
+_Path = Tuple[Union[str, int], ...]
+
+
+def fixture_templates(r4_dir: str = R4_DIR) -> Dict[str, List[dict]]:
+    """Resources of the Bundle fixtures in r4_dir, by type"""
+    templates: Dict[str, List[dict]] = {}
+    for filename in sorted(os.listdir(r4_dir)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(r4_dir, filename), 'r') as bundle_file:
+            bundle = json.load(bundle_file)
+        for entry in bundle.get("entry", []):
+            resource = entry["resource"]
+            templates.setdefault(resource["resourceType"], []).append(resource)
+    return templates
+
+
+def date_paths(data: Union[dict, list], path: _Path = ()) -> List[_Path]:
+    """Paths to the date and datetime values of data, other than `meta.lastUpdated`"""
+    items = data.items() if isinstance(data, dict) else enumerate(data)
+    paths = []
+    for key, value in items:
+        if isinstance(value, (dict, list)):
+            paths.extend(date_paths(value, path + (key,)))
+        elif (isinstance(value, str) and key != "lastUpdated"
+                and shift_date_value(value, 0) is not None):
+            paths.append(path + (key,))
+    return paths
+
+
+class Template:
+    """A template resource, serialized, and the paths to its dates"""
+
+    def __init__(self, data: dict):
+        self.resource_type = data["resourceType"]
+        self.body = dumps(data)
+        self.dates = [(path, _lookup(data, path)) for path in date_paths(data)]
+        self.has_subject = "subject" in data
+
+
+def _lookup(data, path: _Path):
+    for key in path:
+        data = data[key]
+    return data
+
+
+def _assign(data, path: _Path, value):
+    for key in path[:-1]:
+        data = data[key]
+    data[path[-1]] = value
+
+
+def generate(
+        directory: str, resources: int, seed: int = 0, name: str = "bench",
+        r4_dir: str = R4_DIR) -> Dict[str, int]:
+    """Generate `resources` resources into NDJSON files in directory
+
+    :returns: count of resources written, by type
+    """
+    templates: Dict[str, List[Template]] = {
+        resource_type: [Template(data)] for resource_type, data in CLINICAL_TEMPLATES.items()}
+    for resource_type, resources_of_type in fixture_templates(r4_dir).items():
+        templates[resource_type] = [Template(data) for data in resources_of_type]
+    types = [resource_type for resource_type in TYPE_MIX if resource_type in templates]
+    weights = [TYPE_MIX[resource_type] for resource_type in types]
+    patients = max(1, resources * TYPE_MIX["Patient"] // sum(TYPE_MIX.values()))
+
+    rng = random.Random(seed)
+    counts: Counter = Counter()
+    files = {}
+    try:
+        for resource_type in types:
+            files[resource_type] = open(
+                os.path.join(directory, f"{name}.{resource_type}.ndjson"), 'wb')
+        for resource_type in rng.choices(types, weights, k=resources):
+            template = rng.choice(templates[resource_type])
+            data = loads(template.body)
+            data["id"] = f"{name}-{resource_type.lower()}-{counts[resource_type]}"
+            if template.has_subject:
+                data["subject"] = {"reference": f"Patient/{name}-patient-{rng.randrange(patients)}"}
+            offset = -rng.randrange(MAX_OFFSET_DAYS)
+            for path, value in template.dates:
+                _assign(data, path, shift_date_value(value, offset) or value)
+            files[resource_type].write(dumps(data) + b"\n")
+            counts[resource_type] += 1
+    finally:
+        for output_file in files.values():
+            output_file.close()
+    return dict(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic FHIR export data (NDJSON) for benchmarks")
+    parser.add_argument("directory", help="Directory to write the NDJSON files to")
+    parser.add_argument(
+        "--resources", action="store", help="Number of resources to generate", type=int,
+        default=10000)
+    parser.add_argument(
+        "--seed", action="store",
+        help="Random seed; output depends only on it and --resources", type=int, default=0)
+    parser.add_argument(
+        "--name", action="store", help="Prefix of file names and resource ids", default="bench")
+
+    args = parser.parse_args()
+    os.makedirs(args.directory, exist_ok=True)
+    counts = generate(args.directory, args.resources, seed=args.seed, name=args.name)
+    for resource_type, count in sorted(counts.items()):
+        print(f"{resource_type}: {count}")
+    print(f"generated {sum(counts.values())} resource(s) in {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Throughput benchmarks of the timewarp pipeline stages
+
+Measures, over the NDJSON files of a directory (see `generate.py`), the
+resources/s, MB/s and peak RSS of each stage on its own:
+
+  parse           `input_util.next_json_object()`
+  timeshift_json  `timeshift.timeshift_json()`, over parsed resources
+  fhir_resource   `FHIR_Resource.parse_fhir()` and `.timeshift()`, over parsed
+                  resources
+
+Parsing is excluded from the time of the timeshift stages: resources are
+parsed a batch at a time, and only the shift of each batch is timed.  MB/s
+is relative to the size of the input files in every stage.  Each stage
+runs in a fresh process, so its peak RSS isn't that of an earlier stage;
+`baseline_rss_kb` is the process' RSS before the stage started.
+
+Results are saved as JSON; given `--compare` with an earlier result, the
+change in throughput of each stage is reported.
+
+    python benchmarks/run.py /tmp/bench-data --output results.json [--compare baseline.json]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "timewarp"))
+
+from fhir_resource import FHIR_Resource  # noqa: E402
+from input_util import next_json_object  # noqa: E402
+from json_codec import BACKEND  # noqa: E402
+from timeshift import ShiftCache, timeshift_json  # noqa: E402
+
+STAGES = ("parse", "timeshift_json", "fhir_resource")
+
+
+def _peak_rss_kb() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # bytes on macOS
+
+
+def _batches(file_paths: List[str], batch_size: int):
+    for file_path in file_paths:
+        resources = next_json_object(file_path)
+        while batch := list(islice(resources, batch_size)):
+            yield batch
+
+
+def run_stage(
+        stage: str, file_paths: List[str], num_days: int = 1, batch_size: int = 10000,
+        cache_size: int = 100000) -> dict:
+    """Run the named stage over the given files; returns its measurements"""
+    baseline_rss = _peak_rss_kb()
+    resources, seconds = 0, 0.0
+    if stage == "parse":
+        start = time.perf_counter()
+        for file_path in file_paths:
+            for _ in next_json_object(file_path):
+                resources += 1
+        seconds = time.perf_counter() - start
+    elif stage == "timeshift_json":
+        exclusion_list = FHIR_Resource().exclusion_attributes()
+        for batch in _batches(file_paths, batch_size):
+            start = time.perf_counter()
+            for data in batch:
+                timeshift_json(data, num_days, exclusion_list)
+            seconds += time.perf_counter() - start
+            resources += len(batch)
+    elif stage == "fhir_resource":
+        cache = ShiftCache(maxsize=cache_size) if cache_size > 0 else None
+        for batch in _batches(file_paths, batch_size):
+            start = time.perf_counter()
+            for data in batch:
+                FHIR_Resource.parse_fhir(data).timeshift(num_days=num_days, cache=cache)
+            seconds += time.perf_counter() - start
+            resources += len(batch)
+    else:
+        raise ValueError(f"unknown stage: {stage}")
+
+    size = sum(os.path.getsize(file_path) for file_path in file_paths)
+    return {
+        "resources": resources,
+        "bytes": size,
+        "seconds": round(seconds, 6),
+        "resources_per_second": round(resources / seconds, 1) if seconds else None,
+        "mb_per_second": round(size / 1e6 / seconds, 3) if seconds else None,
+        "baseline_rss_kb": baseline_rss,
+        "peak_rss_kb": _peak_rss_kb(),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+        directory: str, stages=STAGES, num_days: int = 1, batch_size: int = 10000,
+        cache_size: int = 100000) -> dict:
+    """Run each stage over the NDJSON files of directory, in a fresh process"""
+    file_paths = sorted(
+        os.path.join(directory, filename) for filename in os.listdir(directory)
+        if filename.endswith(".ndjson"))
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "json_backend": BACKEND,
+        "directory": directory,
+        "files": [os.path.basename(file_path) for file_path in file_paths],
+        "num_days": num_days,
+        "stages": {},
+    }
+    context = multiprocessing.get_context("spawn")
+    for stage in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results["stages"][stage] = executor.submit(
+                run_stage, stage, file_paths, num_days, batch_size, cache_size).result()
+        print(_format(stage, results["stages"][stage]))
+    return results
+
+
+def _format(stage: str, measured: dict) -> str:
+    return (
+        f"{stage}: {measured['resources']} resource(s) in {measured['seconds']:.3f}s, "
+        f"{measured['resources_per_second']} resources/s, {measured['mb_per_second']} MB/s, "
+        f"peak RSS {measured['peak_rss_kb']} KB")
+
+
+def compare(results: dict, baseline: dict) -> Dict[str, float]:
+    """Throughput of each stage relative to baseline, i.e. 1.1 for 10% faster"""
+    ratios = {}
+    for stage, measured in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous and previous.get("resources_per_second") and measured["resources_per_second"]:
+            ratios[stage] = round(
+                measured["resources_per_second"] / previous["resources_per_second"], 3)
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark timewarp pipeline stages")
+    parser.add_argument("directory", help="Directory of NDJSON files, see generate.py")
+    parser.add_argument("--output", action="store", help="Save results to the given JSON file")
+    parser.add_argument(
+        "--compare", action="store",
+        help="Report throughput relative to the results in the given JSON file")
+    parser.add_argument(
+        "--stages", action="store",
+        help=f"Comma separated stages to run, of {','.join(STAGES)}", default=",".join(STAGES))
+    parser.add_argument("--num-days", action="store", help="Days to shift", type=int, default=1)
+    parser.add_argument(
+        "--batch-size", action="store", help="Resources parsed ahead of each timed shift",
+        type=int, default=10000)
+    parser.add_argument(
+        "--cache-size", action="store",
+        help="Bound of the fhir_resource stage's shift cache; 0 disables", type=int,
+        default=100000)
+
+    args = parser.parse_args()
+    stages = args.stages.split(",")
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    results = run_benchmarks(
+        args.directory, stages=stages, num_days=args.num_days, batch_size=args.batch_size,
+        cache_size=args.cache_size)
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            results["compared_to"] = {
+                "file": args.compare,
+                "throughput_ratio": compare(results, json.load(baseline_file))}
+        for stage, ratio in results["compared_to"]["throughput_ratio"].items():
+            print(f"{stage}: {ratio}x baseline throughput")
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
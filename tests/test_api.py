@@ -0,0 +1,179 @@
+import io
+import json
+import pytest
+import requests
+
+from timewarp import api
+from timewarp.api import move_24_ahead, stream_24_ahead
+from timewarp.journal import Journal
+from timewarp.line_index import LineIndex
+from timewarp.upload import PutUploader
+
+EXPORT = {
+    "Observation": b"".join(
+        b'{"resourceType": "Observation", "id": "%d", "issued": "2020-01-%02dT10:00:00Z"}\n'
+        % (i, i + 1) for i in range(20)),
+    "Patient": (
+        b'{"resourceType": "Patient", "id": "1", "birthDate": "1980-05-04"}\n'
+        b'{"resourceType": "Patient", "id": "2", "birthDate": "1981-06-07",'
+        b' "deceasedDateTime": "2021-02-03"}\n'),
+    "Questionnaire": b'{"resourceType": "Questionnaire", "id": "1", "date": "2020-01-01"}\n',
+}
+
+
+class TrickleRaw(io.BytesIO):
+    """Response body read a few bytes at a time, so lines split across chunks
+
+    With `drop_at`, the connection drops after that many bytes; cleanly
+    (i.e. short of Content-Length) unless `error` is given, to raise.
+    """
+
+    def __init__(self, body, drop_at=None, error=None):
+        super().__init__(body)
+        self.drop_at = len(body) if drop_at is None else drop_at
+        self.error = error
+
+    def read(self, size=-1):
+        remaining = self.drop_at - self.tell()
+        if remaining <= 0 and self.error is not None:
+            raise self.error
+        return super().read(max(min(size, 7, remaining), 0))
+
+
+class ExportSession:
+    """Serves the export output files of `EXPORT`; records PUTs"""
+
+    def __init__(self, drop=None, **drop_args):
+        self.drop = drop
+        self.drop_args = drop_args
+        self.fetched = []
+        self.put = {}
+
+    def get(self, url, headers, stream):
+        resource_type = url.rpartition("/")[2]
+        self.fetched.append(resource_type)
+        body = EXPORT[resource_type]
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Length"] = str(len(body))
+        response.raw = TrickleRaw(
+            body, **(self.drop_args if resource_type == self.drop else {}))
+        return response
+
+    def request(self, method, url, data, headers):
+        self.put[url.removeprefix("http://fhir/")] = json.loads(data)
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+
+class Interrupted(BaseException):
+    """The run killed part way through"""
+
+
+class StoreSession:
+    """Records PUTs, each resource at most once; the run is `Interrupted` at `interrupt_at`"""
+
+    def __init__(self, interrupt_at=None):
+        self.interrupt_at = interrupt_at
+        self.put = {}
+
+    def request(self, method, url, data, headers):
+        if len(self.put) == self.interrupt_at:
+            raise Interrupted
+        reference = url.removeprefix("http://fhir/")
+        assert reference not in self.put, f"{reference} uploaded twice"
+        self.put[reference] = json.loads(data)
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+
+def file_items(*resource_types):
+    return [
+        {"type": resource_type, "url": f"http://fhir/Binary/{resource_type}"}
+        for resource_type in resource_types]
+
+
+def test_stream_24_ahead():
+    session = ExportSession()
+    uploader = PutUploader("http://fhir/", session=session)
+    failures = stream_24_ahead(
+        file_items("Observation", "Patient", "Questionnaire"), "http://fhir/", 1,
+        uploader=uploader, session=session, max_workers=2)
+    assert failures == []
+    # types without dates to move aren't downloaded
+    assert sorted(session.fetched) == ["Observation", "Patient"]
+    assert sorted(session.put) == sorted(
+        [f"Observation/{i}" for i in range(20)] + ["Patient/2"])
+    assert session.put["Observation/19"]["issued"] == "2020-01-21T10:00:00Z"
+    assert session.put["Patient/2"]["deceasedDateTime"] == "2021-02-04"
+    assert session.put["Patient/2"]["birthDate"] == "1981-06-07"
+
+
+@pytest.mark.parametrize("error", [None, requests.exceptions.ConnectionError("reset")])
+def test_stream_24_ahead_dropped(error):
+    dropped = EXPORT["Observation"].index(b'"id": "10"')
+    session = ExportSession(drop="Observation", drop_at=dropped, error=error)
+    uploader = PutUploader("http://fhir/", session=session)
+    with pytest.raises(IOError):
+        stream_24_ahead(
+            file_items("Observation", "Patient"), "http://fhir/", 1,
+            uploader=uploader, session=session, max_workers=2)
+    # what arrived before the drop was shifted and uploaded, never the line cut short
+    # (downloads yet to start are cancelled); the run isn't taken as complete
+    assert "Observation/0" in session.put
+    assert not set(session.put) - {f"Observation/{i}" for i in range(10)} - {"Patient/2"}
+
+
+def test_stream_24_ahead_shift_error(monkeypatch):
+    # the downloads, blocked on the full queue, are stopped once the shift fails
+    monkeypatch.setattr(api, "STREAM_QUEUE_SIZE", 2)
+    monkeypatch.setitem(EXPORT, "Observation", EXPORT["Observation"].replace(
+        b'"id": "1",', b'"id": "1" ', 1))
+    session = ExportSession()
+    uploader = PutUploader("http://fhir/", session=session)
+    with pytest.raises(ValueError):
+        stream_24_ahead(
+            file_items("Observation", "Patient"), "http://fhir/", 1,
+            uploader=uploader, session=session, max_workers=2)
+
+
+@pytest.mark.parametrize("line_index", [False, True])
+def test_move_24_ahead_resumed(tmp_path, line_index):
+    for resource_type in "Observation", "Patient":
+        (tmp_path / f"1.{resource_type}.ndjson").write_bytes(EXPORT[resource_type])
+        if line_index:
+            LineIndex.build(str(tmp_path / f"1.{resource_type}.ndjson")).close()
+    path = str(tmp_path / "journal.sqlite")
+    journal = Journal(path, commit_interval=1)
+    journal.start_run(num_days=5)
+    session = StoreSession(interrupt_at=7)
+    with pytest.raises(Interrupted):
+        move_24_ahead(
+            str(tmp_path), "http://fhir/", 5, journal=journal,
+            uploader=PutUploader("http://fhir/", session=session, listener=journal))
+    journal.close()
+    assert len(session.put) == 7
+
+    resumed = Journal(path)
+    resumed.resume_run()
+    session.interrupt_at = None
+    failures = move_24_ahead(
+        str(tmp_path), "http://fhir/", resumed.num_days, journal=resumed,
+        uploader=PutUploader("http://fhir/", session=session, listener=resumed))
+    assert failures == []
+    resumed.complete_run()
+
+    # each uploaded once, shifted once
+    assert sorted(session.put) == sorted(
+        [f"Observation/{i}" for i in range(20)] + ["Patient/2"])
+    assert session.put["Observation/0"]["issued"] == "2020-01-06T10:00:00Z"
+    assert session.put["Observation/19"]["issued"] == "2020-01-25T10:00:00Z"
+    assert session.put["Patient/2"]["deceasedDateTime"] == "2021-02-08"
+    assert resumed.cumulative_offset == 5
+    assert {resumed.shifted_days("Observation", str(i)) for i in range(20)} == {5}
+    # progress of the completed run pruned, offsets kept
+    assert resumed.counts() == {}
+    assert resumed.db.execute("SELECT COUNT(*) FROM resources").fetchone()[0] == 0
+    resumed.close()
@@ -0,0 +1,23 @@
+from benchmarks.generate import generate
+from benchmarks.run import STAGES, run_stage
+
+
+def test_generate_deterministic(tmp_path):
+    one, two = tmp_path / "one", tmp_path / "two"
+    one.mkdir()
+    two.mkdir()
+    counts = generate(str(one), 500, seed=7)
+    assert generate(str(two), 500, seed=7) == counts
+    assert sum(counts.values()) == 500
+    assert counts["Observation"] > counts["Patient"]
+    for path in one.iterdir():
+        assert path.read_bytes() == (two / path.name).read_bytes()
+
+
+def test_run_stage(tmp_path):
+    counts = generate(str(tmp_path), 200, seed=1)
+    file_paths = sorted(str(path) for path in tmp_path.iterdir())
+    for stage in STAGES:
+        measured = run_stage(stage, file_paths, batch_size=64)
+        assert measured["resources"] == sum(counts.values())
+        assert measured["peak_rss_kb"] > 0
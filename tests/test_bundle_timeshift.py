@@ -0,0 +1,74 @@
+from copy import deepcopy
+import io
+import json
+from pathlib import Path
+import pytest
+
+from timewarp.bundle_timeshift import read_bundle, timeshift_bundle, timeshift_bundle_file
+from timewarp.fhir_resource import FHIR_Resource
+
+SEED_BUNDLE = Path(__file__).parent.parent / "r4" / "pt-test-data.json"
+
+
+@pytest.fixture
+def seed_bundle():
+    with open(SEED_BUNDLE, "r") as bundle_file:
+        return json.load(bundle_file)
+
+
+def test_read_bundle_small_chunks(seed_bundle):
+    with open(SEED_BUNDLE, "r") as bundle_file:
+        members = list(read_bundle(bundle_file, chunk_size=7))
+    assert [value for key, value in members if key == "entry"] == seed_bundle["entry"]
+    assert ("type", "transaction") in members
+
+
+def test_read_bundle_rejects_other_resources():
+    with pytest.raises(ValueError):
+        list(read_bundle(io.StringIO('{"resourceType": "Patient", "id": "1"}')))
+    with pytest.raises(ValueError):
+        list(read_bundle(io.StringIO('{"resourceType": "Bundle", "entry": [{}')))
+
+
+def test_timeshift_bundle(seed_bundle, tmp_path):
+    expected = deepcopy(seed_bundle)
+    changed = 0
+    for entry in expected["entry"]:
+        changed += FHIR_Resource.parse_fhir(entry["resource"]).timeshift(num_days=3)
+
+    target = tmp_path / "shifted.json"
+    counts = timeshift_bundle_file(str(SEED_BUNDLE), str(target), 3, chunk_size=64)
+    assert counts == {"entries": len(expected["entry"]), "changed": changed}
+    with open(target, "r") as shifted:
+        assert json.load(shifted) == expected
+
+
+def test_timeshift_bundle_entry_rules():
+    bundle = {
+        "resourceType": "Bundle",
+        "timestamp": "2020-01-01T00:00:00Z",
+        "entry": [{
+            "resource": {
+                "resourceType": "Patient", "id": "p", "birthDate": "2000-01-01",
+                "deceasedDateTime": "2020-01-01"},
+            "request": {"method": "PUT", "url": "Patient/p", "ifModifiedSince": "2020-01-01"},
+            "response": {"status": "200", "lastModified": "2020-01-01T00:00:00Z"},
+        }, {
+            "request": {"method": "DELETE", "url": "Patient/q"},
+            "response": {"status": "204", "lastModified": "2020-01-01T00:00:00Z"},
+        }],
+        "total": 1,
+    }
+    target = io.StringIO()
+    counts = timeshift_bundle(io.StringIO(json.dumps(bundle)), target, 1)
+    assert counts == {"entries": 2, "changed": 2}
+    shifted = json.loads(target.getvalue())
+    # dates of the entries themselves are shifted too
+    assert shifted["entry"][0]["request"]["ifModifiedSince"] == "2020-01-02"
+    for entry in shifted["entry"]:
+        assert entry["response"]["lastModified"] == "2020-01-02T00:00:00Z"
+    assert list(shifted["entry"][0]) == ["resource", "request", "response"]
+    assert shifted["timestamp"] == "2020-01-02T00:00:00Z"
+    assert shifted["entry"][0]["resource"]["birthDate"] == "2000-01-01"
+    assert shifted["entry"][0]["resource"]["deceasedDateTime"] == "2020-01-02"
+    assert shifted["total"] == 1
@@ -5,6 +5,7 @@ import pytest
 from timewarp.fhir_resource import (
     FHIR_Resource,
     Patient,
+    Unshifted,
 )
 
 
@@ -49,6 +50,8 @@ def test_medrequest_timeshift(medrequest_resource):
     assert medrequest_resource.data['authoredOn'] == "2024-11-06"
     assert medrequest_resource.timeshift(num_days=20) is True
     assert medrequest_resource.data['authoredOn'] == "2024-11-26"
+    assert medrequest_resource.changed_paths == [
+        "/authoredOn", "/dispenseRequest/extension/1/valueDate"]
 
 
 @pytest.fixture
@@ -96,6 +99,18 @@ def test_parse_location(location_resource):
     assert location_resource.timeshift(num_days=1) is False
 
 
+def test_unshifted_types(location_resource):
+    assert isinstance(location_resource, Unshifted)
+    assert not FHIR_Resource.is_shiftable("Questionnaire")
+    assert FHIR_Resource.is_shiftable("Encounter")
+    assert FHIR_Resource.is_shiftable("Patient")
+
+    questionnaire = FHIR_Resource.parse_fhir(
+        {"resourceType": "Questionnaire", "id": "q", "date": "2020-01-01"})
+    assert questionnaire.timeshift(num_days=1) is False
+    assert questionnaire.data["date"] == "2020-01-01"
+
+
 @pytest.fixture
 def procedure_resource(datadir):
     filepath = str(datadir / "Procedure.json")
@@ -0,0 +1,316 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import pytest
+import requests
+
+from timewarp.fhir_server_export import (
+    download_file,
+    file_resource_type,
+    next_poll_wait,
+    poll_status,
+    run_export_by_type,
+    split_type_groups,
+    validate_ndjson,
+)
+
+NDJSON = b"".join(
+    b'{"resourceType": "Observation", "id": "%d"}\n' % i for i in range(100))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves NDJSON, honoring Range; the first full GET is cut short"""
+    requests_seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.requests_seen.append(range_header)
+        if range_header:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            body = NDJSON[start:]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(NDJSON) - 1}/{len(NDJSON)}")
+        else:
+            body = NDJSON
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if len(self.requests_seen) == 1:
+            # drop the connection part way through the first response
+            self.wfile.write(body[:1000])
+            self.wfile.flush()
+            self.connection.close()
+            return
+        self.wfile.write(body)
+
+
+class PartialHandler(BaseHTTPRequestHandler):
+    """Serves NDJSON; Range past its end is unsatisfiable, else honored per `honor_range`"""
+    honor_range = True
+    requests_seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.requests_seen.append(range_header)
+        start = int(range_header.split("=")[1].rstrip("-")) if range_header else 0
+        if start >= len(NDJSON) or self.path == "/unsatisfiable":
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = NDJSON
+        if range_header and self.honor_range:
+            body = NDJSON[start:]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(NDJSON) - 1}/{len(NDJSON)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GzipHandler(BaseHTTPRequestHandler):
+    """Serves NDJSON gzip encoded, when accepted"""
+    accept_encodings = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        accept_encoding = self.headers.get("Accept-Encoding", "")
+        self.accept_encodings.append(accept_encoding)
+        body = gzip.compress(NDJSON) if "gzip" in accept_encoding else NDJSON
+        self.send_response(200)
+        if "gzip" in accept_encoding:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    """Minimal Bulk Export; each _type completes after `polls_needed[type]` status polls
+
+    In progress responses ask for a (flat, HAPI like) 120 second wait, as an HTTP-date.
+    """
+    polls_needed = {}
+    polls = {}
+    events = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        if url.path.endswith("/$export"):
+            resource_type = parse_qs(url.query)["_type"][0]
+            self.polls[resource_type] = 0
+            return self._send(202, headers=[("Content-Location", f"{base}/status/{resource_type}")])
+        if url.path.startswith("/status/"):
+            resource_type = url.path.rpartition("/")[2]
+            self.polls[resource_type] += 1
+            if self.polls[resource_type] < self.polls_needed[resource_type]:
+                retry_after = format_datetime(
+                    datetime.now(timezone.utc) + timedelta(seconds=120), usegmt=True)
+                return self._send(202, headers=[("Retry-After", retry_after)])
+            self.events.append(f"complete {resource_type}")
+            output = [{"type": resource_type, "url": f"{base}/Binary/{resource_type}"}]
+            return self._send(200, json.dumps({"output": output}).encode())
+        if url.path.startswith("/Binary/"):
+            resource_type = url.path.rpartition("/")[2]
+            self.events.append(f"download {resource_type}")
+            return self._send(200, b'{"resourceType": "%s", "id": "1"}\n' % resource_type.encode())
+        self._send(404)
+
+
+def serve(handler):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+@pytest.fixture
+def server():
+    RangeHandler.requests_seen = []
+    httpd = serve(RangeHandler)
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+@pytest.fixture
+def export_server():
+    ExportHandler.polls, ExportHandler.events = {}, []
+    httpd = serve(ExportHandler)
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def test_resumed_download(server, tmp_path):
+    filename = str(tmp_path / "1.Observation.ndjson")
+    assert download_file(f"{server}/1", filename=filename, chunk_size=100) == filename
+    with open(filename, "rb") as f:
+        assert f.read() == NDJSON
+    assert RangeHandler.requests_seen == [None, "bytes=1000-"]
+
+
+@pytest.mark.parametrize("honor_range, partial, requests_seen", [
+    # stale partial, longer than the file; restarted
+    (True, NDJSON + b"{}\n", [f"bytes={len(NDJSON) + 3}-", None]),
+    # Range unsupported; the full file replaces the partial
+    (False, NDJSON[:1000], ["bytes=1000-"]),
+])
+def test_download_partial_restart(tmp_path, honor_range, partial, requests_seen):
+    PartialHandler.honor_range, PartialHandler.requests_seen = honor_range, []
+    httpd = serve(PartialHandler)
+    filename = str(tmp_path / "1.Observation.ndjson")
+    with open(f"{filename}.part", "wb") as f:
+        f.write(partial)
+    try:
+        download_file(f"http://127.0.0.1:{httpd.server_port}/1", filename=filename)
+    finally:
+        httpd.shutdown()
+    with open(filename, "rb") as f:
+        assert f.read() == NDJSON
+    assert PartialHandler.requests_seen == requests_seen
+
+
+def test_download_unsatisfiable(tmp_path):
+    PartialHandler.requests_seen = []
+    httpd = serve(PartialHandler)
+    try:
+        with pytest.raises(requests.exceptions.HTTPError):
+            download_file(
+                f"http://127.0.0.1:{httpd.server_port}/unsatisfiable",
+                filename=str(tmp_path / "1.Observation.ndjson"))
+    finally:
+        httpd.shutdown()
+
+
+@pytest.mark.parametrize("name", ["1.Observation.ndjson", "1.Observation.ndjson.gz"])
+def test_gzip_download(tmp_path, name):
+    GzipHandler.accept_encodings = []
+    httpd = serve(GzipHandler)
+    try:
+        filename = str(tmp_path / name)
+        download_file(f"http://127.0.0.1:{httpd.server_port}/1", filename=filename)
+    finally:
+        httpd.shutdown()
+    assert GzipHandler.accept_encodings == ["gzip"]
+    with open(filename, "rb") as f:
+        content = f.read()
+    # saved as transferred if named .gz, else decoded
+    assert (gzip.decompress(content) if name.endswith(".gz") else content) == NDJSON
+    assert not os.path.exists(f"{filename}.part")
+
+
+def test_validate_ndjson(tmp_path):
+    complete = tmp_path / "complete.ndjson"
+    complete.write_bytes(NDJSON)
+    validate_ndjson(str(complete))
+
+    truncated = tmp_path / "truncated.ndjson"
+    truncated.write_bytes(NDJSON[:-10])
+    with pytest.raises(IOError):
+        validate_ndjson(str(truncated))
+
+    compressed = tmp_path / "complete.ndjson.gz"
+    compressed.write_bytes(gzip.compress(NDJSON))
+    validate_ndjson(str(compressed))
+    for content in gzip.compress(NDJSON[:-10]), gzip.compress(NDJSON)[:-10]:
+        compressed.write_bytes(content)
+        with pytest.raises(IOError):
+            validate_ndjson(str(compressed))
+
+
+def test_next_poll_wait():
+    # interval doubles to the cap; Retry-After bounds the wait, never extends it
+    assert next_poll_wait(0.0, 1.0, 30.0) == (1.0, 2.0)
+    assert next_poll_wait(120.0, 16.0, 30.0) == (16.0, 30.0)
+    assert next_poll_wait(0.5, 30.0, 30.0) == (0.5, 30.0)
+    # once the server throttles polls, Retry-After is waited in full
+    assert next_poll_wait(120.0, 16.0, 30.0, throttled=True) == (120.0, 30.0)
+    assert next_poll_wait(0.0, 1.0, 30.0, throttled=True) == (1.0, 2.0)
+
+
+class ThrottleHandler(BaseHTTPRequestHandler):
+    """Export status, throttled with a 429 on every other poll; complete at the fifth"""
+    polls = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.polls.append(time.monotonic())
+        if len(self.polls) == 5:
+            body = b'{"output": []}'
+            self.send_response(200)
+        else:
+            body = b""
+            self.send_response(429 if len(self.polls) % 2 else 202)
+            self.send_header("Retry-After", "0.2")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_poll_throttled():
+    ThrottleHandler.polls = []
+    httpd = serve(ThrottleHandler)
+    try:
+        response = poll_status(
+            f"http://127.0.0.1:{httpd.server_port}/status", max_rety_time=10,
+            poll_interval=0.01)
+    finally:
+        httpd.shutdown()
+    assert response.json() == {"output": []}
+    # polled on through the 429s, never sooner than Retry-After once throttled
+    polls = ThrottleHandler.polls
+    assert len(polls) == 5
+    assert min(after - before for before, after in zip(polls, polls[1:])) >= 0.2
+
+
+def test_file_resource_type():
+    assert file_resource_type("/tmp/1.Observation.ndjson") == "Observation"
+    assert file_resource_type("/tmp/1.Observation.ndjson.gz") == "Observation"
+    assert file_resource_type("/tmp/pt-test-data.json") is None
+
+
+def test_split_type_groups():
+    assert split_type_groups("Patient,Encounter+EpisodeOfCare") == [
+        "Patient", "Encounter,EpisodeOfCare"]
+
+
+def test_run_export_by_type(export_server, tmp_path):
+    ExportHandler.polls_needed = {"Observation": 6, "Patient": 1}
+    filenames = run_export_by_type(
+        export_server, ["Observation", "Patient"], directory=str(tmp_path),
+        max_timeout=10, poll_interval=0.01)
+
+    assert [os.path.basename(f) for f in filenames] == [
+        "Observation.Observation.ndjson", "Patient.Patient.ndjson"]
+    # Patient downloaded without waiting on Observation, nor the 120 second Retry-After
+    events = ExportHandler.events
+    assert events.index("download Patient") < events.index("complete Observation")
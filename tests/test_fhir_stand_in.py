@@ -0,0 +1,87 @@
+import os
+import pytest
+import requests
+
+from benchmarks.fhir_server import serve
+from benchmarks.generate import generate
+from timewarp.fhir_server_export import run_export
+from timewarp.input_util import next_json_object
+from timewarp.upload import BundleUploader, PatchUploader, PutUploader
+
+
+@pytest.fixture
+def stand_in(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    counts = generate(str(data_dir), 300, seed=2)
+    server = serve(
+        str(data_dir), export_seconds=0.2, poll_retry_after=0.1, throttle_rate=0.2,
+        retry_after=0, seed=5)
+    yield server, counts
+    server.shutdown()
+    server.server_close()
+
+
+def test_export(stand_in, tmp_path):
+    server, counts = stand_in
+    directory = tmp_path / "export"
+    directory.mkdir()
+    file_paths = run_export(
+        base_url=server.base_url + "/", directory=str(directory), type="Observation,Patient")
+    assert sorted(path.rsplit(".", 2)[1] for path in file_paths) == ["Observation", "Patient"]
+    lines = sum(len(open(path).readlines()) for path in file_paths)
+    assert lines == counts["Observation"] + counts["Patient"]
+
+
+def test_compressed_export(stand_in, tmp_path):
+    server, counts = stand_in
+    directory = tmp_path / "export"
+    directory.mkdir()
+    file_paths = run_export(
+        base_url=server.base_url + "/", directory=str(directory), type="Patient",
+        compression="gzip")
+    assert [os.path.basename(path).split(".", 1)[1] for path in file_paths] == [
+        "Patient.ndjson.gz"]
+    assert len(list(next_json_object(file_paths[0]))) == counts["Patient"]
+
+
+def test_range(stand_in):
+    server, _ = stand_in
+    url = f"{server.base_url}/$export-output/0"
+    whole = requests.get(url).content
+    response = requests.get(url, headers={"Range": "bytes=10-"})
+    assert response.status_code == 206
+    assert response.content == whole[10:]
+    assert requests.get(url, headers={"Range": f"bytes={len(whole)}-"}).status_code == 416
+
+
+@pytest.mark.parametrize("make_uploader", [
+    lambda url: PutUploader(url),
+    lambda url: PatchUploader(url),
+    lambda url: BundleUploader(url, bundle_size=7),
+])
+def test_upload_with_throttling(stand_in, make_uploader):
+    server, _ = stand_in
+    uploader = make_uploader(server.base_url + "/")
+    for i in range(20):
+        resource = {"resourceType": "Observation", "id": str(i), "issued": "2020-01-02"}
+        uploader.submit_changes(resource, ["/issued"])
+    assert uploader.close() == []
+    stats = requests.get(f"{server.base_url}/$stats").json()
+    assert stats["resources updated"] == 20
+    assert stats["status 429"] > 0
+
+
+def test_no_patch_falls_back(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    generate(str(data_dir), 10)
+    server = serve(str(data_dir), patch=False)
+    try:
+        uploader = PatchUploader(server.base_url + "/")
+        uploader.submit_changes({"resourceType": "Patient", "id": "1"}, [])
+        assert uploader.close() == []
+        assert server.stats()["updates PUT"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,5 +1,6 @@
+import gzip
 import pytest
-from timewarp.input_util import determine_file_type
+from timewarp.input_util import determine_file_type, is_input_file, next_json_object
 
 
 def test_single_line_nd(datadir):
@@ -18,3 +19,68 @@ def test_valid_nd(datadir):
 def test_invalid(datadir):
     with pytest.raises(ValueError):
         determine_file_type(datadir / "bogus.json")
+
+
+def test_next_json_object_nd(datadir):
+    objs = list(next_json_object(datadir / "Patient.ndjson"))
+    assert len(objs) == 8
+    assert all(obj["resourceType"] == "Patient" for obj in objs)
+
+
+def test_next_json_object_multi_line(datadir):
+    assert list(next_json_object(datadir / "valid.json")) == [{"multiline": "but valid"}]
+
+
+def test_next_json_object_invalid(datadir):
+    with pytest.raises(ValueError):
+        list(next_json_object(datadir / "bogus.json"))
+
+
+def test_next_json_object_invalid_line(tmp_path):
+    filepath = tmp_path / "partial.ndjson"
+    filepath.write_text('{"resourceType": "Patient"}\n{"resourceType": "Pat\n')
+    objs = next_json_object(filepath)
+    assert next(objs) == {"resourceType": "Patient"}
+    with pytest.raises(ValueError):
+        next(objs)
+
+
+def test_next_json_object_compressed(tmp_path):
+    lines = b'{"resourceType": "Patient", "id": "1"}\n{"resourceType": "Patient", "id": "2"}\n'
+    named = tmp_path / "1.Patient.ndjson.gz"
+    named.write_bytes(gzip.compress(lines))
+    # detected by magic bytes, whatever the name
+    unnamed = tmp_path / "1.Patient.ndjson"
+    unnamed.write_bytes(gzip.compress(lines))
+    for filepath in named, unnamed:
+        assert determine_file_type(filepath) == "NDJSON"
+        assert [obj["id"] for obj in next_json_object(filepath)] == ["1", "2"]
+
+
+def test_next_json_object_truncated_compressed(tmp_path):
+    filepath = tmp_path / "1.Patient.ndjson.gz"
+    filepath.write_bytes(gzip.compress(b'{"resourceType": "Patient"}\n' * 100)[:-20])
+    with pytest.raises(ValueError):
+        list(next_json_object(filepath))
+
+
+def test_is_input_file(tmp_path):
+    files = {
+        "1.Patient.ndjson": b'{"resourceType": "Patient"}\n',
+        "1.Patient.ndjson.gz": gzip.compress(b'{"resourceType": "Patient"}\n'),
+        "bundle": b'  {"resourceType": "Bundle"}',
+        "1.Patient.ndjson.part": b'{"resourceType": "Patient"}\n',
+        "journal.sqlite": b"SQLite format 3\x00",
+        "notes.txt.gz": gzip.compress(b"notes"),
+        ".hidden.ndjson": b'{"resourceType": "Patient"}\n',
+        "Patient.json.gz": gzip.compress(b'{\n  "resourceType": "Patient"\n}'),
+        # left by earlier runs
+        "plan.json": b'{"Patient": ["deceasedDateTime"]}',
+        "metrics.json": b'{"counters": {}}',
+        "shard-0-of-2.json": b'{"shard": "0/2", "resources": 1}',
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_bytes(content)
+    assert sorted(
+        name for name in files if is_input_file(str(tmp_path / name))) == [
+            "1.Patient.ndjson", "1.Patient.ndjson.gz", "Patient.json.gz", "bundle"]
@@ -0,0 +1,100 @@
+import pytest
+
+from timewarp.journal import PENDING, UNCHANGED, UPLOADED, Journal, source_hash
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(str(tmp_path / "journal.sqlite"), commit_interval=2)
+    journal.start_run(num_days=3)
+    yield journal
+    journal.close()
+
+
+def test_source_hash():
+    assert source_hash({"a": 1, "b": 2}) == source_hash({"b": 2, "a": 1})
+    assert source_hash({"a": 1}) != source_hash({"a": 2})
+
+
+def test_is_done(journal):
+    journal.record("Patient", "1", "abc", UNCHANGED)
+    journal.record("Observation", "1", "def", PENDING)
+    assert journal.is_done("Patient", "1", "abc")
+    assert not journal.is_done("Patient", "1", "changed content")
+    assert not journal.is_done("Observation", "1", "def")
+
+    journal.uploaded("Observation/1")
+    assert journal.is_done("Observation", "1", "def")
+    assert journal.counts() == {UNCHANGED: 1, UPLOADED: 1}
+    assert journal.completed_references() == {"Patient/1", "Observation/1"}
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    journal = Journal(path)
+    run_id = journal.start_run(num_days=5)
+    journal.record("Observation", "1", "def", PENDING)
+    journal.uploaded("Observation/1")
+    journal.close()  # interrupted, not completed
+
+    resumed = Journal(path)
+    assert resumed.resume_run() == run_id
+    assert resumed.num_days == 5
+    assert resumed.is_done("Observation", "1", "def")
+    resumed.complete_run()
+    assert resumed.resume_run() is None
+    # progress is pruned once complete; the offset is kept
+    assert resumed.counts() == {}
+    assert resumed.shifted_days("Observation", "1") == 5
+    resumed.close()
+
+
+def test_crash_keeps_offsets(tmp_path, capsys):
+    path = str(tmp_path / "journal.sqlite")
+    journal = Journal(path)
+    journal.start_run(num_days=5)
+    journal.record("Observation", "1", "def", PENDING)
+    journal.uploaded("Observation/1")
+    journal.record("Observation", "2", "ghi", PENDING)
+    journal.db.close()  # crashed, uncommitted writes lost
+
+    # a new run, of a fresh export, doesn't shift the uploaded resource twice
+    journal = Journal(path)
+    journal.start_run(num_days=7)
+    assert "run 1 of journal" in capsys.readouterr().err
+    assert journal.days_due("Observation", "1") == 2
+    assert journal.days_due("Observation", "2") == 7
+    journal.close()
+
+
+def test_cumulative_offsets(tmp_path):
+    journal = Journal(str(tmp_path / "journal.sqlite"))
+    assert journal.cumulative_offset == 0 and journal.last_warp is None
+
+    journal.start_run(num_days=1)
+    assert journal.days_due("Observation", "1") == 1
+    journal.record("Observation", "1", "abc", PENDING)
+    journal.uploaded("Observation/1")
+    journal.complete_run()
+    assert journal.cumulative_offset == 1 and journal.last_warp
+
+    # Observation/1 not exported (i.e. incremental run), left behind
+    journal.start_run(num_days=1)
+    journal.complete_run()
+
+    journal.start_run(num_days=1)
+    assert journal.cumulative_offset == 2
+    # brought current by its accumulated delta
+    assert journal.days_due("Observation", "1") == 2
+    # new resources assumed current as of the last run
+    assert journal.days_due("Observation", "2") == 1
+    journal.close()
+
+
+def test_new_resources_from_seed(tmp_path):
+    journal = Journal(str(tmp_path / "journal.sqlite"))
+    journal.start_run(num_days=5)
+    journal.complete_run()
+    journal.start_run(num_days=1, new_resources_from_seed=True)
+    assert journal.days_due("Observation", "1") == 6
+    journal.close()
@@ -0,0 +1,47 @@
+import json
+import pytest
+
+from timewarp import json_codec
+from timewarp.json_codec import dumps, loads
+
+DOCUMENT = {
+    "resourceType": "Patient",
+    "id": "1",
+    "name": [{"text": "Zoë Ñúñez 山田"}],
+    "multipleBirthInteger": 2,
+    "extension": [
+        {"valueDecimal": 0.1},
+        {"valueDecimal": 1e-07},
+        {"valueInteger": 2 ** 70},
+    ],
+    "active": True,
+    "deceasedBoolean": None,
+}
+
+
+@pytest.fixture(params=["default", "stdlib"])
+def backend(request, monkeypatch):
+    if request.param == "stdlib":
+        monkeypatch.setattr(json_codec, "orjson", None)
+    return request.param
+
+
+def test_round_trip(backend):
+    body = dumps(DOCUMENT)
+    assert isinstance(body, bytes)
+    assert json.loads(body) == DOCUMENT
+    assert loads(body) == DOCUMENT
+    assert loads(body.decode()) == DOCUMENT
+
+
+def test_big_integers(backend):
+    assert dumps([2 ** 64, -2 ** 63 - 1]) == b"[18446744073709551616,-9223372036854775809]"
+    # beyond 64 bits, orjson parses integers as floats; see json_codec docstring
+    parsed = loads(b"[18446744073709551615,18446744073709551617]")
+    assert parsed[0] == 2 ** 64 - 1
+    assert isinstance(parsed[1], float if json_codec.orjson is not None else int)
+
+
+def test_invalid(backend):
+    with pytest.raises(json_codec.JSONDecodeError):
+        loads(b'{"resourceType": ')
@@ -0,0 +1,82 @@
+import os
+import pytest
+
+from timewarp.api import sample_resources
+from timewarp.line_index import LineIndex, index_path, read_resources
+from timewarp.parallel import WorkUnit, read_unit, split_work
+
+
+@pytest.fixture
+def ndjson_file(tmp_path):
+    filepath = tmp_path / "Procedure.ndjson"
+    filepath.write_text("".join(
+        '{"resourceType": "Procedure", "id": "%d", "performedDateTime": "2016-07-%02d"}\n%s'
+        % (i, i % 28 + 1, "\n" if i % 7 == 0 else "") for i in range(50)))
+    return str(filepath)
+
+
+def test_build_and_load(ndjson_file):
+    with LineIndex.build(ndjson_file) as built:
+        assert len(built) == 50
+    assert os.path.exists(index_path(ndjson_file))
+
+    with LineIndex.load(ndjson_file) as index:
+        assert len(index) == 50
+        assert index.reference(49) == "Procedure/49"
+        assert index.resource(7)["id"] == "7"
+        assert index.get("Procedure/23")["performedDateTime"] == "2016-07-24"
+        assert index.get("Procedure/50") is None
+        assert index.offset(len(index)) == os.path.getsize(ndjson_file)
+        with open(ndjson_file, "rb") as f:
+            f.seek(index.offset(3))
+            assert bytes(index.line(3)).startswith(f.readline())
+
+
+def test_duplicate_references(tmp_path):
+    filepath = tmp_path / "Patient.ndjson"
+    filepath.write_text("".join(
+        '{"resourceType": "Patient", "id": "%d"}\n' % (i % 40) for i in range(100)))
+    with LineIndex.build(str(filepath)) as built, LineIndex.load(str(filepath)) as loaded:
+        for index in built, loaded:
+            # the first line of each reference
+            assert [index.position(f"Patient/{i}") for i in range(40)] == list(range(40))
+            assert index.position("Patient/40") is None
+            assert index.position("Patient/") is None
+
+
+def test_stale_index(ndjson_file):
+    LineIndex.build(ndjson_file).close()
+    with open(ndjson_file, "a") as f:
+        f.write('{"resourceType": "Procedure", "id": "50"}\n')
+    assert LineIndex.load(ndjson_file) is None
+    with LineIndex.open(ndjson_file) as index:
+        assert len(index) == 51
+
+
+def test_read_resources_skips_unowned(ndjson_file):
+    def owns(reference):
+        return int(reference.rpartition("/")[2]) % 3 == 0
+
+    # without an index, every resource is yielded for the caller to filter
+    assert len(list(read_resources(ndjson_file, owns))) == 50
+    LineIndex.build(ndjson_file).close()
+    assert [data["id"] for data in read_resources(ndjson_file, owns)] == [
+        str(i) for i in range(0, 50, 3)]
+
+
+def test_read_unit_with_index(ndjson_file):
+    LineIndex.build(ndjson_file).close()
+    units = split_work([ndjson_file], chunk_size=256)
+    assert len(units) > 1
+    ids = [data["id"] for unit in units for data in read_unit(unit, lambda reference: True)]
+    assert ids == [str(i) for i in range(50)]
+    assert len(list(read_unit(WorkUnit(ndjson_file), lambda reference: False))) == 0
+
+
+def test_sample_resources(ndjson_file):
+    assert [data["id"] for data in sample_resources(ndjson_file, 5)] == ["0", "1", "2", "3", "4"]
+    # spread through the file, given an index
+    LineIndex.build(ndjson_file).close()
+    assert [data["id"] for data in sample_resources(ndjson_file, 5)] == [
+        "0", "10", "20", "30", "40"]
+    assert len(list(sample_resources(ndjson_file, 80))) == 50
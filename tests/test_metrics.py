@@ -0,0 +1,68 @@
+from timewarp import fhir_resource, input_util
+from timewarp.metrics import Metrics
+
+
+def test_counters_and_histograms():
+    metrics = Metrics()
+    metrics.count("resources_parsed", type="Patient")
+    metrics.count("resources_parsed", 2, type="Observation")
+    metrics.observe("upload_request_seconds", 0.003, method="PUT")
+    metrics.observe("upload_request_seconds", 0.2, method="PUT")
+    metrics.observe("upload_request_seconds", 30, method="PUT")
+    with metrics.stage("timeshift"):
+        pass
+    assert metrics.total("resources_parsed") == 3
+
+    summary = metrics.to_dict()
+    assert summary["counters"]["resources_parsed"] == {"type=Observation": 2, "type=Patient": 1}
+    assert "stage=timeshift" in summary["stages"]
+    histogram = summary["histograms"]["upload_request_seconds"]["method=PUT"]
+    assert histogram["count"] == 3
+    assert histogram["buckets"]["0.005"] == 1
+    assert histogram["buckets"]["+Inf"] == 1
+
+    text = metrics.to_prometheus()
+    assert '# TYPE timewarp_resources_parsed_total counter' in text
+    assert 'timewarp_resources_parsed_total{type="Observation"} 2' in text
+    assert 'timewarp_upload_request_seconds_bucket{method="PUT",le="0.25"} 2' in text
+    assert 'timewarp_upload_request_seconds_bucket{method="PUT",le="+Inf"} 3' in text
+    assert 'timewarp_upload_request_seconds_count{method="PUT"} 3' in text
+
+
+def test_drain_and_merge():
+    worker, parent = Metrics(), Metrics()
+    for _ in range(2):
+        worker.count("resources_shifted", type="Encounter")
+        worker.observe("upload_request_seconds", 0.01, method="PATCH")
+        parent.merge(worker.drain())
+    assert worker.total("resources_shifted") == 0
+    assert parent.total("resources_shifted") == 2
+    assert parent.to_dict()["histograms"]["upload_request_seconds"]["method=PATCH"]["count"] == 2
+
+
+def test_parse_counted(tmp_path):
+    filepath = tmp_path / "1.Observation.ndjson"
+    filepath.write_text("".join(
+        '{"resourceType": "Observation", "id": "%d"}\n' % i for i in range(600)))
+    input_util.METRICS.reset()
+    assert len(list(input_util.next_json_object(str(filepath)))) == 600
+    summary = input_util.METRICS.to_dict()
+    assert summary["counters"]["resources_parsed"] == {"type=Observation": 600}
+    assert summary["counters"]["parsed_bytes"][""] == filepath.stat().st_size
+    assert "stage=parse" in summary["stages"]
+
+
+def test_shift_tally():
+    metrics = fhir_resource.METRICS
+    metrics.reset()
+    with fhir_resource.ShiftTally(flush_every=3) as tally:
+        for i in range(4):
+            fhir_resource.FHIR_Resource.parse_fhir({
+                "resourceType": "Procedure", "id": str(i),
+                "performedDateTime": "2016-07-07" if i else "unknown"}).timeshift(1, tally=tally)
+            # added to the registry in bulk
+            assert metrics.total("resources_shifted") == (2 if i >= 2 else 0)
+    counters = metrics.to_dict()["counters"]
+    assert counters["resources_shifted"] == {"type=Procedure": 3}
+    assert counters["resources_unchanged"] == {"type=Procedure": 1}
+    assert "stage=timeshift" in metrics.to_dict()["stages"]
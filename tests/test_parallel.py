@@ -0,0 +1,50 @@
+import gzip
+import json
+import pytest
+
+from timewarp.parallel import WorkUnit, parallel_timeshift, read_unit, split_work
+
+
+@pytest.fixture
+def ndjson_file(tmp_path):
+    filepath = tmp_path / "Procedure.ndjson"
+    filepath.write_text("".join(
+        '{"resourceType": "Procedure", "id": "%d", "performedDateTime": "2016-07-%02d"}\n'
+        % (i, i % 28 + 1) for i in range(50)))
+    return str(filepath)
+
+
+def test_split_work(ndjson_file):
+    units = split_work([ndjson_file], chunk_size=256)
+    assert len(units) > 1
+    assert units[0].start == 0
+    assert all(a.end == b.start for a, b in zip(units, units[1:]))
+    ids = [obj["id"] for unit in units for obj in read_unit(unit)]
+    assert ids == [str(i) for i in range(50)]
+
+
+def test_small_file_single_unit(ndjson_file):
+    assert split_work([ndjson_file]) == [WorkUnit(ndjson_file)]
+
+
+def test_deterministic(ndjson_file):
+    one = list(parallel_timeshift([ndjson_file], 1, workers=1, chunk_size=256))
+    three = list(parallel_timeshift([ndjson_file], 1, workers=3, chunk_size=256))
+    assert one == three
+    assert [reference for reference, _ in one] == [f"Procedure/{i}" for i in range(50)]
+    assert json.loads(one[0][1])["performedDateTime"] == "2016-07-02"
+
+
+def test_batch_engine(ndjson_file):
+    tree = list(parallel_timeshift([ndjson_file], 1, workers=2, chunk_size=256))
+    batch = list(parallel_timeshift([ndjson_file], 1, workers=2, chunk_size=256, batch_size=7))
+    assert batch == tree
+
+
+def test_compressed_file_single_unit(tmp_path, ndjson_file):
+    filepath = tmp_path / "Procedure.ndjson.gz"
+    with open(ndjson_file, "rb") as f:
+        filepath.write_bytes(gzip.compress(f.read()))
+    units = split_work([str(filepath)], chunk_size=256)
+    assert units == [WorkUnit(str(filepath))]
+    assert [obj["id"] for obj in read_unit(units[0])] == [str(i) for i in range(50)]
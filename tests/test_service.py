@@ -0,0 +1,107 @@
+from datetime import datetime
+import os
+import threading
+import time
+import pytest
+import requests
+
+from benchmarks.fhir_server import serve
+from benchmarks.generate import generate
+from timewarp.journal import Journal
+from timewarp.service import ControlServer, Store, WarpService
+
+
+def test_next_run():
+    nightly = Store("nightly", "http://fhir/fhir", at="02:30")
+    assert nightly.next_run(datetime(2026, 1, 1, 1, 0)) == datetime(2026, 1, 1, 2, 30)
+    assert nightly.next_run(datetime(2026, 1, 1, 2, 30)) == datetime(2026, 1, 2, 2, 30)
+    assert Store("often", "http://fhir", every=60).next_run(
+        datetime(2026, 1, 1)) == datetime(2026, 1, 1, 0, 1)
+    assert Store("adhoc", "http://fhir").next_run(datetime(2026, 1, 1)) is None
+    for options in ({"at": "25:00"}, {"at": "02:30", "every": 60}, {"nightly": True}):
+        with pytest.raises(ValueError):
+            Store("invalid", "http://fhir", **options)
+
+
+def test_schedule_due():
+    service = WarpService([Store("often", "http://fhir", every=60), Store("adhoc", "http://fhir")])
+    scheduled = service.next_runs["often"]
+    service.schedule_due(scheduled)
+    service.schedule_due(scheduled.replace(year=scheduled.year + 1))
+    # not queued twice while the first is waiting
+    assert [(warp["store"], warp["trigger"]) for warp in service.queued] == [("often", "schedule")]
+    assert service.next_runs["often"] > scheduled
+    assert service.next_runs["adhoc"] is None
+
+
+@pytest.fixture
+def control(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    counts = generate(str(data_dir), 200, seed=3)
+    stand_in = serve(str(data_dir), export_seconds=0.1, poll_retry_after=0.1)
+    store = Store(
+        "demo", stand_in.base_url, input_dir=str(tmp_path / "warp"), concurrency=2,
+        export_types="Observation")
+    service = WarpService([store])
+    server = ControlServer(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    service.start()
+    yield server, stand_in, counts
+    server.shutdown()
+    server.server_close()
+    service.stop()
+    stand_in.shutdown()
+    stand_in.server_close()
+
+
+def wait_for_warps(url, number):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        status = requests.get(f"{url}/status").json()
+        if len(status["recent"]) >= number:
+            return status
+        time.sleep(0.1)
+    raise AssertionError("warp didn't finish")
+
+
+def test_on_demand_warp(control, tmp_path):
+    server, stand_in, counts = control
+    response = requests.post(f"{server.url}/warp", params={"store": "demo"})
+    assert response.status_code == 202
+    assert response.json()["state"] == "queued"
+    assert requests.post(f"{server.url}/warp", params={"store": "other"}).status_code == 404
+
+    warp = wait_for_warps(server.url, 1)["recent"][0]
+    assert warp["state"] == "completed"
+    assert warp["metrics"]["counters"]["resources_uploaded"][""] == counts["Observation"]
+    stats = requests.get(f"{stand_in.base_url}/$stats").json()
+    assert stats["resources updated"] == counts["Observation"]
+    assert os.listdir(tmp_path / "warp") == []
+
+    # the second warp of the store finds its shift cache warm
+    store = server.service.stores["demo"]
+    misses = store.cache.misses
+    requests.post(f"{server.url}/warp", params={"store": "demo"})
+    assert wait_for_warps(server.url, 2)["recent"][1]["state"] == "completed"
+    # but for partial dates, their shift carrying the days of the first warp
+    assert store.cache.misses - misses < misses / 10
+    # each warp a run of the store's journal
+    journal = Journal(str(tmp_path / "warp.sqlite"))
+    assert journal.cumulative_offset == 2
+    last_warp = journal.last_warp
+    # an Observation left a warp behind, i.e. its upload failed, is brought current
+    (lagging,) = journal.db.execute("SELECT resource_id FROM offsets LIMIT 1").fetchone()
+    journal.db.execute("UPDATE offsets SET total_days = 1 WHERE resource_id = ?", (lagging,))
+    journal.db.commit()
+    response = requests.post(
+        f"{server.url}/warp", params={"store": "demo", "type": "Observation"})
+    assert response.json()["types"] == ["Observation"]
+    assert wait_for_warps(server.url, 3)["recent"][2]["state"] == "completed"
+    stats = requests.get(f"{stand_in.base_url}/$stats").json()
+    assert stats["resources updated"] == counts["Observation"] * 2 + 1
+    # by a catch-up run, not advancing the offset
+    assert journal.cumulative_offset == 2 and journal.last_warp == last_warp
+    assert journal.shifted_days("Observation", lagging) == 2
+    journal.close()
+    assert "timewarp_resources_uploaded_total" in requests.get(f"{server.url}/metrics").text
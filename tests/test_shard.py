@@ -0,0 +1,77 @@
+import os
+import pytest
+
+from timewarp.line_index import LineIndex
+from timewarp.parallel import parallel_timeshift
+from timewarp.shard import Shard, ShardSummary, merge_summaries
+
+
+@pytest.fixture
+def ndjson_file(tmp_path):
+    filepath = tmp_path / "Procedure.ndjson"
+    filepath.write_text("".join(
+        '{"resourceType": "Procedure", "id": "%d", "performedDateTime": "2016-07-%02d"}\n'
+        % (i, i % 28 + 1) for i in range(50)))
+    return str(filepath)
+
+
+def test_parse():
+    assert Shard.parse("2/4") == Shard(2, 4)
+    assert str(Shard(0, 3)) == "0/3"
+    for value in ("4/4", "-1/2", "1", "a/b"):
+        with pytest.raises(ValueError):
+            Shard.parse(value)
+
+
+def test_owns_partitions():
+    references = [f"Observation/{i}" for i in range(1000)]
+    shards = [Shard(i, 3) for i in range(3)]
+    owners = [[shard.owns(reference) for shard in shards] for reference in references]
+    assert all(sum(owned) == 1 for owned in owners)
+    assert all(any(owned[i] for owned in owners) for i in range(3))
+
+
+def run_shards(ndjson_file, count):
+    summaries = []
+    for index in range(count):
+        summary = ShardSummary(
+            Shard(index, count), 1, [ndjson_file], source_dir=os.path.dirname(ndjson_file))
+        changed = list(parallel_timeshift([ndjson_file], 1, workers=2, shard=summary))
+        assert len(changed) == summary.changed
+        summaries.append(summary.to_dict())
+    return summaries
+
+
+def test_merge_summaries(ndjson_file):
+    merged = merge_summaries(run_shards(ndjson_file, 3), verify=True)
+    assert merged["errors"] == []
+    assert merged["resources"] == 50
+    assert merged["changed"] == 50
+
+
+def test_merge_detects_missing_and_duplicate(ndjson_file):
+    summaries = run_shards(ndjson_file, 3)
+    merged = merge_summaries([summaries[0], summaries[1], summaries[1]], verify=True)
+    assert "missing shard(s) 2/3" in merged["errors"]
+    assert "duplicate shard(s) 1/3" in merged["errors"]
+    assert any(error.startswith("shards processed") for error in merged["errors"])
+
+
+def test_verify_with_line_index(ndjson_file):
+    summaries = run_shards(ndjson_file, 2)
+    LineIndex.build(ndjson_file).close()
+    assert merge_summaries(summaries, verify=True)["errors"] == []
+    assert merge_summaries(summaries[:1], verify=True)["errors"]
+
+
+def test_sources_relative(ndjson_file, tmp_path):
+    summaries = run_shards(ndjson_file, 2)
+    assert summaries[0]["sources"] == ["Procedure.ndjson"]
+    # another node, mounting the shared export elsewhere
+    summaries[1]["source_dir"] = "/mnt/export"
+    merged = merge_summaries(summaries, verify=True)
+    assert merged["errors"] == []
+
+    merged = merge_summaries(summaries, verify=True, source_dir=str(tmp_path / "elsewhere"))
+    assert merged["errors"] == [
+        f"can't verify, source file(s) not found: {tmp_path / 'elsewhere' / 'Procedure.ndjson'}"]
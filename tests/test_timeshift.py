@@ -1,6 +1,11 @@
 import pytest
 
-from timewarp.timeshift import timeshift_json
+from timewarp.timeshift import (
+    ShiftCache,
+    shift_date_value,
+    timeshift_json,
+    timeshift_json_in_place,
+)
 
 
 @pytest.fixture
@@ -26,3 +31,82 @@ def test_no_dateshift(datetimeonly):
 def test_dateshift(datetimeonly):
     result = timeshift_json(datetimeonly, num_days=30, exclusion_list=[])
     assert result["dt1"] == "2025-01-31T01:01:00Z"
+
+
+def test_in_place_changed_paths():
+    data = {
+        "period": {"start": "2025-01-01", "end": "2025-01-02"},
+        "item": [{"answer": [{"valueDate": "2025-01-03"}, {"valueString": "n/a"}]}],
+        "meta": {"lastUpdated": "2025-01-01T01:01:00Z"},
+    }
+    changed = timeshift_json_in_place(data, num_days=1, exclusion_list=["lastUpdated"])
+    assert changed == ["/period/start", "/period/end", "/item/0/answer/0/valueDate"]
+    assert data["period"] == {"start": "2025-01-02", "end": "2025-01-03"}
+    assert data["item"][0]["answer"][0]["valueDate"] == "2025-01-04"
+    assert data["meta"]["lastUpdated"] == "2025-01-01T01:01:00Z"
+
+
+def test_in_place_no_change(datetimeonly):
+    assert timeshift_json_in_place(datetimeonly, num_days=0, exclusion_list=[]) == []
+
+
+def test_shift_cache():
+    cache = ShiftCache(maxsize=2)
+    assert cache.shift("2025-01-01", 1) == "2025-01-02"
+    assert cache.shift("2025-01-01", 1) == "2025-01-02"
+    assert cache.shift("not a date", 1) is None
+    assert cache.shift("not a date", 1) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # least recently used entry evicted
+    assert cache.shift("2025-01-01", 2) == "2025-01-03"
+    assert len(cache) == 2
+    cache.shift("2025-01-01", 1)
+    assert cache.misses == 4
+
+    # only partial dates are keyed by offset
+    assert cache.shift("2025-01-01", 1, offset=30) == "2025-01-02"
+    assert cache.shift("2025-01", 1, offset=30) == "2025-02"
+    assert (cache.hits, cache.misses) == (3, 5)
+
+
+def test_in_place_cached():
+    cache = ShiftCache()
+    data = [{"start": "2025-01-01"}, {"start": "2025-01-01"}]
+    assert timeshift_json_in_place(data, 1, [], cache=cache) == ["/0/start", "/1/start"]
+    assert data == [{"start": "2025-01-02"}, {"start": "2025-01-02"}]
+    assert cache.stats()["hits"] == 1
+
+
+def test_preserves_precision():
+    result = timeshift_json(
+        {"lastUpdated": "2022-12-05T22:44:19.336+00:00"}, num_days=1, exclusion_list=[])
+    assert result == {"lastUpdated": "2022-12-06T22:44:19.336+00:00"}
+
+
+def test_partial_dates():
+    assert shift_date_value("2022-08", 31) == "2022-09"
+    assert shift_date_value("2022-12", 62) == "2023-02"
+    # bare years only when the element is known to hold a date
+    assert shift_date_value("2022", 366) is None
+    assert shift_date_value("2022", 366, allow_year=True) == "2023"
+
+
+def test_partial_dates_carry():
+    # shifted a day at a time, the remainder carries via the days shifted before
+    assert shift_date_value("2022-12", 1) == "2022-12"
+    assert shift_date_value("2022-12", 1, offset=30) == "2023-01"
+    month, year, full = "2022-12", "2022", "2022-12-01"
+    for offset in range(400):
+        month = shift_date_value(month, 1, offset=offset)
+        year = shift_date_value(year, 1, allow_year=True, offset=offset)
+        full = shift_date_value(full, 1)
+    assert (month, year, full) == ("2024-01", "2023", "2024-01-05")
+    # the same as a single shift of the total
+    assert shift_date_value("2022-12", 400) == month
+
+
+@pytest.mark.parametrize("value", [
+    "20250101", "2025-02-29", "2025-01-01T24:00:00Z", "2025-1-01", "6788", "http://a.b/2025-01-01"])
+def test_not_dates(value):
+    assert shift_date_value(value, 1) is None
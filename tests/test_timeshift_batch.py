@@ -0,0 +1,69 @@
+from copy import deepcopy
+import importlib.util
+import json
+from pathlib import Path
+import random
+import pytest
+
+from timewarp.fhir_resource import FHIR_Resource
+from timewarp.timeshift import shift_date_value
+from timewarp.timeshift_batch import shift_values
+from timewarp.timeshift_plan import TimeshiftPlan
+
+KERNELS = ["python", pytest.param("numpy", marks=pytest.mark.skipif(
+    importlib.util.find_spec("numpy") is None, reason="numpy not installed"))]
+
+VALUES = [
+    "2024-02-29", "2023-02-29", "2023-12-31T23:59:59.123+05:00", "0001-01-01", "9999-12-31",
+    "2020-06", "2020", "1234", "2019-10-25T11:14:00Z", "not a date", "2019-13-01", "",
+    "0999-12-31", "0000-01-01", "2020-02-30",
+]
+
+
+@pytest.mark.parametrize("kernel", KERNELS)
+@pytest.mark.parametrize("num_days", [0, 1, -1, 365, -800, 3000000])
+def test_shift_values(kernel, num_days):
+    rng = random.Random(num_days)
+    values = VALUES + [
+        f"{rng.randint(1, 9999):04d}-{rng.randint(1, 12):02d}-{rng.randint(1, 31):02d}"
+        for _ in range(500)]
+    for allow_year in (False, True):
+        assert shift_values(values, num_days, allow_year, kernel=kernel) == [
+            shift_date_value(value, num_days, allow_year=allow_year) for value in values]
+        assert shift_values(values, num_days, allow_year, kernel=kernel, offset=30) == [
+            shift_date_value(value, num_days, allow_year=allow_year, offset=30)
+            for value in values]
+
+
+@pytest.fixture
+def resources():
+    datadir = Path(__file__).parent / "test_fhir_resource"
+    resources = []
+    for filepath in sorted(datadir.iterdir()):
+        with open(filepath, "r") as data_file:
+            if filepath.suffix == ".ndjson":
+                resources.extend(json.loads(line) for line in data_file if line.strip())
+            else:
+                resources.append(json.load(data_file))
+    return resources
+
+
+@pytest.mark.parametrize("kernel", KERNELS)
+@pytest.mark.parametrize("planned", [False, True])
+def test_batch_matches_tree(resources, kernel, planned):
+    plan = None
+    if planned:
+        plan = TimeshiftPlan()
+        for data in resources:
+            fhir_data = FHIR_Resource.parse_fhir(data)
+            plan.learn(fhir_data.resource_type, data, fhir_data.exclusion_attributes())
+
+    tree = [FHIR_Resource.parse_fhir(deepcopy(data)) for data in resources]
+    tree_changes = [fhir_data.timeshift(num_days=40, plan=plan) for fhir_data in tree]
+    batch = [FHIR_Resource.parse_fhir(deepcopy(data)) for data in resources]
+    batch_changes = FHIR_Resource.timeshift_batch(batch, 40, plan=plan, kernel=kernel)
+
+    assert any(tree_changes)
+    assert batch_changes == tree_changes
+    assert [r.data for r in batch] == [r.data for r in tree]
+    assert [r.changed_paths for r in batch] == [r.changed_paths for r in tree]
@@ -0,0 +1,105 @@
+from copy import deepcopy
+import json
+import pytest
+
+from timewarp.fhir_resource import FHIR_Resource
+from timewarp.timeshift_plan import TimeshiftPlan
+
+
+@pytest.fixture
+def qnr_data(datadir):
+    with open(datadir / "QuestionnaireResponse.json", "r") as json_data:
+        return json.load(json_data)
+
+
+@pytest.fixture
+def qnr_plan(qnr_data):
+    qnr = FHIR_Resource.parse_fhir(deepcopy(qnr_data))
+    plan = TimeshiftPlan()
+    plan.learn(qnr.resource_type, qnr.data, qnr.exclusion_attributes())
+    return plan
+
+
+def test_learn(qnr_plan):
+    assert qnr_plan.to_dict() == {"QuestionnaireResponse": ["authored"]}
+
+
+def test_round_trip(qnr_plan, tmp_path):
+    qnr_plan.save(tmp_path / "plan.json")
+    assert TimeshiftPlan.load(tmp_path / "plan.json").to_dict() == qnr_plan.to_dict()
+
+
+def test_planned_timeshift(qnr_plan, qnr_data):
+    planned = FHIR_Resource.parse_fhir(deepcopy(qnr_data))
+    full = FHIR_Resource.parse_fhir(deepcopy(qnr_data))
+    assert planned.timeshift(num_days=3, plan=qnr_plan) is True
+    assert full.timeshift(num_days=3) is True
+    assert planned.data == full.data
+
+
+def test_nested_paths():
+    plan = TimeshiftPlan.from_dict({"Encounter": ["period.end", "period.start"]})
+    encounter = FHIR_Resource.parse_fhir({
+        "resourceType": "Encounter",
+        "period": {"start": "2024-01-01", "end": "2024-01-02"},
+        "note": [{"text": "2024-01-01"}]})
+    assert encounter.timeshift(num_days=1, plan=plan) is True
+    assert encounter.data["period"] == {"start": "2024-01-02", "end": "2024-01-03"}
+    # paths absent from the plan, but for declared dates, are not shifted
+    assert encounter.data["note"] == [{"text": "2024-01-01"}]
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_declared_dates_off_plan(batch):
+    plan = TimeshiftPlan.from_dict({"Observation": ["issued"]})
+    observation = FHIR_Resource.parse_fhir({
+        "resourceType": "Observation", "issued": "2024-01-01",
+        "effectivePeriod": {"start": "2024-01-01"},
+        "extension": [{"url": "http://x", "valueDateTime": "2024"}],
+        "note": [{"text": "2024-01-01"}]})
+    if batch:
+        assert FHIR_Resource.timeshift_batch([observation], 366, plan=plan) == [True]
+    else:
+        assert observation.timeshift(num_days=366, plan=plan) is True
+    # dates the sample never held still shifted, at elements declared dates
+    assert observation.data["effectivePeriod"] == {"start": "2025-01-01"}
+    assert observation.data["extension"][0]["valueDateTime"] == "2025"
+    assert observation.data["note"] == [{"text": "2024-01-01"}]
+    assert observation.changed_paths == [
+        "/issued", "/effectivePeriod/start", "/extension/0/valueDateTime"]
+
+
+def test_unplanned_type_falls_back(qnr_plan):
+    procedure = FHIR_Resource.parse_fhir(
+        {"resourceType": "Procedure", "performedDateTime": "2016-07-07"})
+    assert procedure.timeshift(num_days=1, plan=qnr_plan) is True
+    assert procedure.data["performedDateTime"] == "2016-07-08"
+
+
+def test_years_only_at_declared_dates():
+    plan = TimeshiftPlan()
+    plan.learn("Observation", {
+        "resourceType": "Observation", "valueString": "2020-01-01",
+        "effectiveDateTime": "2020-01-01"}, [])
+    observation = FHIR_Resource.parse_fhir({
+        "resourceType": "Observation", "valueString": "1234", "effectiveDateTime": "2020"})
+    assert observation.timeshift(num_days=366, plan=plan) is True
+    assert observation.data["valueString"] == "1234"
+    assert observation.data["effectiveDateTime"] == "2021"
+
+
+def test_dateless_sample_falls_back():
+    plan = TimeshiftPlan()
+    plan.learn("Basic", {"resourceType": "Basic", "id": "1"}, [])
+    plan.learn("Observation", {"resourceType": "Observation", "issued": "2020-01-01"}, [])
+    assert "Basic" not in plan
+
+    # no dates at the planned paths; walked in full rather than left unshifted
+    observation = FHIR_Resource.parse_fhir(
+        {"resourceType": "Observation", "valueString": "2020-01-01"})
+    assert observation.timeshift(num_days=1, plan=plan) is True
+    assert observation.data["valueString"] == "2020-01-02"
+    observation = FHIR_Resource.parse_fhir(
+        {"resourceType": "Observation", "valueString": "2020-01-01"})
+    assert FHIR_Resource.timeshift_batch([observation], 1, plan=plan) == [True]
+    assert observation.data["valueString"] == "2020-01-02"
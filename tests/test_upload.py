@@ -0,0 +1,230 @@
+import json
+import pytest
+import requests
+
+from timewarp.journal import FAILED, PENDING, Journal
+from timewarp.upload import (
+    BundleUploader,
+    ConcurrentUploader,
+    PatchUploader,
+    PutUploader,
+    json_patch,
+    parse_retry_after,
+    request_with_retry,
+)
+
+
+class FakeResponse(requests.Response):
+    def __init__(self, status_code, json_data=None, headers=None):
+        super().__init__()
+        self.status_code = status_code
+        self._content = json.dumps(json_data or {}).encode()
+        self.headers.update(headers or {})
+
+
+class FakeSession:
+    """Answers batch POSTs, rejecting bundles over max_entries and `bad` ids"""
+    def __init__(self, max_entries=100, bad=()):
+        self.max_entries = max_entries
+        self.bad = bad
+        self.posted = []
+
+    def request(self, method, url, data, headers):
+        entries = json.loads(data)["entry"]
+        self.posted.append(len(entries))
+        if len(entries) > self.max_entries:
+            return FakeResponse(413)
+        return FakeResponse(200, {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [{"response": {"status": "400 Bad Request" if (
+                e["resource"]["id"] in self.bad) else "200 OK"}} for e in entries],
+        })
+
+
+def resources(count):
+    return [{"resourceType": "Observation", "id": str(i)} for i in range(count)]
+
+
+def test_bundles():
+    session = FakeSession()
+    uploader = BundleUploader("http://fhir/", bundle_size=4, session=session)
+    for resource in resources(10):
+        uploader.submit(resource)
+    assert uploader.close() == []
+    assert session.posted == [4, 4, 2]
+    assert uploader.uploaded == 10
+
+
+def test_entry_failures():
+    uploader = BundleUploader("http://fhir/", bundle_size=4, session=FakeSession(bad=("2",)))
+    for resource in resources(4):
+        uploader.submit(resource)
+    failures = uploader.close()
+    assert [(f["reference"], f["status"]) for f in failures] == [("Observation/2", 400)]
+
+
+def test_oversized_split():
+    session = FakeSession(max_entries=3)
+    uploader = BundleUploader("http://fhir/", bundle_size=8, session=session)
+    for resource in resources(8):
+        uploader.submit(resource)
+    assert uploader.close() == []
+    assert session.posted == [8, 4, 2, 2, 4, 2, 2]
+
+
+def test_bundle_type():
+    with pytest.raises(ValueError):
+        BundleUploader("http://fhir/", bundle_type="collection")
+
+
+class ScriptedSession:
+    """Returns the given responses in order, recording each request"""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.bodies = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        self.bodies.append(kwargs.get("data"))
+        return self.responses.pop(0)
+
+
+def test_retry_after(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("timewarp.upload.time.sleep", sleeps.append)
+    session = ScriptedSession(
+        FakeResponse(503, headers={"Retry-After": "7"}), FakeResponse(429), FakeResponse(200))
+    response = request_with_retry(session, "PUT", "http://fhir/Patient/1", backoff=1)
+    assert response.status_code == 200
+    assert sleeps == [7.0, 2.0]
+
+
+def test_retries_exhausted(monkeypatch):
+    monkeypatch.setattr("timewarp.upload.time.sleep", lambda delay: None)
+    session = ScriptedSession(FakeResponse(503), FakeResponse(503))
+    response = request_with_retry(session, "PUT", "http://fhir/Patient/1", max_retries=1)
+    assert response.status_code == 503
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+
+def test_concurrent_put():
+    class PutSession:
+        def __init__(self):
+            self.urls = []
+
+        def request(self, method, url, data, headers):
+            self.urls.append(url)
+            return FakeResponse(404 if json.loads(data)["id"] == "3" else 200)
+
+    session = PutSession()
+    uploader = ConcurrentUploader(
+        PutUploader("http://fhir/", session=session, max_retries=0), concurrency=3)
+    for resource in resources(10):
+        uploader.submit(resource)
+    failures = uploader.close()
+    assert [(f["reference"], f["status"]) for f in failures] == [("Observation/3", 404)]
+    assert sorted(session.urls) == sorted(f"http://fhir/Observation/{i}" for i in range(10))
+    assert uploader.uploaded == 9
+
+
+def test_concurrent_bundles():
+    session = FakeSession()
+    uploader = ConcurrentUploader(
+        BundleUploader("http://fhir/", bundle_size=4, session=session), concurrency=2)
+    for resource in resources(10):
+        uploader.submit(resource)
+    assert uploader.close() == []
+    assert sorted(session.posted) == [2, 4, 4]
+
+
+def test_json_patch():
+    resource = {"id": "1", "effectivePeriod": {"start": "2020-01-02"}, "a/b": ["x", "2020-01-02"]}
+    assert json.loads(json_patch(resource, ["/effectivePeriod/start", "/a~1b/1"])) == [
+        {"op": "replace", "path": "/effectivePeriod/start", "value": "2020-01-02"},
+        {"op": "replace", "path": "/a~1b/1", "value": "2020-01-02"},
+    ]
+
+
+def test_patch_fallback():
+    session = ScriptedSession(
+        FakeResponse(200), FakeResponse(422), FakeResponse(200), FakeResponse(405),
+        FakeResponse(200), FakeResponse(200))
+    uploader = PatchUploader("http://fhir/", session=session, max_retries=0)
+    for resource in resources(4):
+        resource["issued"] = "2020-01-02T00:00:00Z"
+        uploader.submit_changes(resource, ["/issued"])
+    assert uploader.close() == []
+    assert uploader.uploaded == 4
+    assert [method for method, _ in session.requests] == [
+        "PATCH", "PATCH", "PUT", "PATCH", "PUT", "PUT"]
+    assert json.loads(session.bodies[0]) == [
+        {"op": "replace", "path": "/issued", "value": "2020-01-02T00:00:00Z"}]
+    assert json.loads(session.bodies[-1])["id"] == "3"
+
+
+def test_concurrent_worker_error(tmp_path):
+    class NotJSONSession:
+        def request(self, method, url, data, headers):
+            response = FakeResponse(200)
+            response._content = b"<html>OK</html>"
+            return response
+
+    journal = Journal(str(tmp_path / "journal.sqlite"))
+    journal.start_run(num_days=1)
+    for resource in resources(4):
+        journal.record("Observation", resource["id"], "abc", PENDING)
+    uploader = ConcurrentUploader(
+        BundleUploader(
+            "http://fhir/", bundle_size=2, session=NotJSONSession(), listener=journal),
+        concurrency=2)
+    for resource in resources(4):
+        uploader.submit(resource)
+    failures = uploader.close()
+    assert sorted(f["reference"] for f in failures) == [
+        f"Observation/{i}" for i in range(4)]
+    assert uploader.uploaded == 0
+    assert journal.counts() == {FAILED: 4}
+    journal.close()
+
+
+@pytest.mark.parametrize("content", [
+    b"<html>OK</html>", b'{"resourceType": "Bundle"}', b'{"entry": [{}, {}]}',
+    b'{"entry": [{"response": null}, {"response": {"status": "200 OK"}}]}'])
+def test_unexpected_bundle_response(content):
+    response = FakeResponse(200)
+    response._content = content
+    uploader = BundleUploader("http://fhir/", bundle_size=2, session=ScriptedSession(response))
+    for resource in resources(2):
+        uploader.submit(resource)
+    failures = uploader.close()
+    assert [(f["reference"], f["status"]) for f in failures] == [
+        ("Observation/0", 200), ("Observation/1", 200)]
+    assert uploader.uploaded == 0
+
+
+@pytest.mark.parametrize("outcome", [FakeResponse(503), requests.exceptions.ConnectionError()])
+def test_bundle_not_split(monkeypatch, outcome):
+    # once retries run out, the Bundle's entries fail, rather than each half retrying
+    monkeypatch.setattr("timewarp.upload.time.sleep", lambda delay: None)
+
+    class FailingSession(ScriptedSession):
+        def request(self, method, url, **kwargs):
+            self.requests.append((method, url))
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+    session = FailingSession()
+    uploader = BundleUploader("http://fhir/", bundle_size=4, session=session, max_retries=1)
+    for resource in resources(4):
+        uploader.submit(resource)
+    assert len(uploader.close()) == 4
+    assert len(session.requests) == 2
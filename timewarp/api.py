@@ -1,24 +1,147 @@
 usage = """Usage:
-  {script} <FHIR_BASE_URL> [NUM_DAYS] [TMP_DIR]
+  {script} [OPTIONS] <FHIR_BASE_URL> [NUM_DAYS] [TMP_DIR]
 
 Positional Arguments:
   FHIR_BASE_URL  The base URL of the FHIR store to query and store the time shifted FHIR resources
   NUM_DAYS    Optional number of days to move date and time values forward, defaults to 1
   TMP_DIR    Optional temporary directory to use, defaults to /tmp
 
+Options:
+  --plan FILE    Use the compiled timeshift plan in FILE; only the date element
+                 paths it lists are visited, per resource type
+  --plan-sample N  Compile a timeshift plan from N resources of each exported
+                 file before shifting (saved to --plan FILE if given); the
+                 first N, or spread through files with a --line-index
+  --cache-size N  Bound of the shared date shift cache, defaults to 100000;
+                 0 disables caching
+  --bundle-size N  Upload changed resources in Bundles of up to N entries,
+                 POSTed to FHIR_BASE_URL, rather than one PUT per resource
+  --bundle-type TYPE  Bundle type for --bundle-size uploads, `batch` (default)
+                 or `transaction`
+  --patch        Upload only the changed elements of each resource, as a
+                 JSON Patch via HTTP PATCH, rather than PUT the whole
+                 resource; falls back to PUT where the server rejects PATCH,
+                 and with --workers
+  --concurrency N  Number of concurrent upload workers sharing a pool of
+                 keep-alive connections, defaults to 1
+  --stream       Shift and upload resources as the export output files
+                 download, without first saving them to TMP_DIR
+  --spool        With --stream, also save the export output files to TMP_DIR
+  --compress FORMAT  Save export output files to TMP_DIR compressed, `gzip`
+                 or `zstd` (requires the zstandard package); compressed
+                 files are read back as a stream, whatever their name
+  --workers N    Timeshift over N worker processes, splitting large NDJSON
+                 files into chunks, rather than in process; requires the
+                 export on disk (not --stream)
+  --engine ENGINE  Timeshift engine: `tree` (default) walks and shifts each
+                 resource a value at a time; `batch` gathers the date values
+                 of --batch-size resources and shifts them together, with
+                 NumPy when installed; output is identical
+  --batch-size N  Resources per batch of the `batch` engine, defaults to 10000
+  --journal FILE  Record per resource progress in the SQLite journal FILE
+  --resume       With --journal, resume the interrupted run it records,
+                 from the export left in TMP_DIR, skipping resources already
+                 uploaded; NUM_DAYS is taken from the journal
+  --incremental  With --journal, export only resources new or changed since
+                 the last completed run (see `_since`); each is shifted by
+                 the days it lags the store's cumulative offset
+  --export-types TYPES  Restrict the export to the given (comma separated)
+                 resource types; see `_type`
+  --split-export  Run a separate export per type of --export-types (or `+`
+                 joined group of types) in parallel, shifting none until all
+                 complete, but downloading each as soon as it does
+  --prune-types  Export only resource types with dates to move, skipping
+                 definitional and administrative types such as Questionnaire,
+                 ValueSet and Organization (see `fhir_resource`); the types
+                 kept come from --export-types, else the server's
+                 CapabilityStatement, and the resources and bytes avoided
+                 are reported
+  --new-resources-from-seed  With --journal, resources without a recorded
+                 offset hold original (seed) values and are shifted the full
+                 cumulative offset; by default they're shifted NUM_DAYS
+  --shard I/N    Process only shard I (0 to N-1) of N, those resources whose
+                 stable hash of `resourceType/id` falls in it, so N nodes can
+                 split a run of a shared export; requires --skip-export (or
+                 --resume), see `shard` to merge and check their summaries
+  --shard-summary FILE  Save the --shard summary to FILE, defaults to
+                 `shard-I-of-N.json` in the current directory
+  --skip-export  Process the export already in TMP_DIR (i.e. shared between
+                 the nodes of a sharded run) rather than export anew
+  --metrics FILE  Save a JSON summary of the run's metrics to FILE: per stage
+                 wall time, bytes downloaded, resources parsed, shifted and
+                 unchanged per type, and upload latency and status codes
+  --metrics-textfile FILE  Save the same metrics to FILE in the Prometheus
+                 text format, i.e. for the node_exporter textfile collector
+  --profile DIR  Profile the run with cProfile, saving `run.prof` to DIR
+                 (main process and thread only, where resources are parsed
+                 and shifted)
+  --progress-interval N  Seconds between progress lines, defaults to 10
+  --line-index   Index the NDJSON files of the export in TMP_DIR, saving
+                 `<file>.idx` next to each (reused while the file is
+                 unchanged); with --shard, resources of other shards, and
+                 with --resume, those already completed, are then skipped
+                 without being parsed, and `shard merge --verify` needn't
+                 parse the files
+
+  With --journal, every resource is shifted to the store's cumulative offset
+  (the total of all runs' NUM_DAYS), by the days it lags, rather than a flat
+  NUM_DAYS.  A full run after incremental runs brings those resources left
+  behind current.  Partial dates (`YYYY-MM`, `YYYY`) shift by the whole months
+  crossed, carrying the remainder via the journal; without it, a warp of fewer
+  days than a month leaves them be.
+
 Description:
   Query the FHIR store at FHIR_BASE_URL for all contained FHIR resources.  Shift
   all but a few excluded date and time values forward NUM_DAYS.  Excluded values
   include `Patient.birthDate` and all `meta.lastUpdated` fields.  All FHIR resources
   changed in the process will be PUT back to the same FHIR_BASE_URL.
 """
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import os
+import queue
 import requests
 import sys
+import threading
 
-from fhir_resource import FHIR_Resource
-from fhir_server_export import run_export
-from input_util import next_json_object
+from fhir_resource import FHIR_Resource, ShiftTally
+from fhir_server_export import (
+    download_session,
+    estimate_export_size,
+    export_file_items,
+    file_resource_type,
+    fixup_url,
+    local_filename_for,
+    run_export,
+    run_export_by_type,
+    server_resource_types,
+    split_type_groups,
+    stream_ndjson,
+)
+from input_util import (
+    ParseTally,
+    compression_available,
+    is_input_file,
+    next_json_object,
+    parse_json_line,
+)
+from json_codec import BACKEND
+from line_index import LineIndex, indexable, read_resources
+from metrics import METRICS
+from journal import PENDING, UNCHANGED, Journal, source_hash
+from parallel import parallel_timeshift
+from shard import Shard, ShardSummary
+from timeshift import ShiftCache
+from timeshift_batch import KERNEL
+from timeshift_plan import TimeshiftPlan
+from upload import (
+    BundleUploader,
+    ConcurrentUploader,
+    PatchUploader,
+    PutUploader,
+    make_session,
+)
 
 
 def bail(reason=None):
@@ -30,55 +153,529 @@ def bail(reason=None):
     sys.exit(1)
 
 
-def move_24_ahead(source_dir, fhir_base_url, num_days):
-    """Update the FHIR resources found in files, num_days forward in time"""
-    def timeshift_resource(data):
+def source_files(source_dir, file_paths=None):
+    """Files to process, defaults to all in source_dir; skips export output of unshifted types
+
+    Of source_dir, only JSON and NDJSON files (plain or compressed, see
+    `input_util.is_input_file()`) are processed, not partial downloads or
+    other files left behind by earlier runs.
+    """
+    if file_paths is None:
+        file_paths = [
+            file_path for file_path in (
+                os.path.join(source_dir, filename) for filename in sorted(os.listdir(source_dir)))
+            if is_input_file(file_path)]
+    return [
+        file_path for file_path in file_paths
+        if FHIR_Resource.is_shiftable(file_resource_type(file_path))]
+
+
+def prune_export_types(fhir_base_url, export_types=None):
+    """Drop resource types without dates to move from the types to export
+
+    :param export_types: comma separated types (or `+` joined groups of types),
+      defaults to all the server supports
+    :returns: the types to export, in the same form
+    """
+    with download_session(1) as session:
+        groups = (
+            export_types.split(",") if export_types
+            else server_resource_types(fhir_base_url, session=session))
+        kept, pruned = [], []
+        for group in groups:
+            resource_types = group.split("+")
+            pruned.extend(t for t in resource_types if not FHIR_Resource.is_shiftable(t))
+            group = "+".join(t for t in resource_types if FHIR_Resource.is_shiftable(t))
+            if group:
+                kept.append(group)
+
+        avoided_resources = avoided_bytes = 0
+        for resource_type in pruned:
+            count, size = estimate_export_size(fhir_base_url, resource_type, session=session)
+            print(f"pruned {resource_type} from export: {count} resource(s), ~{size} bytes")
+            avoided_resources += count
+            avoided_bytes += size
+    print(
+        f"export pruned of {len(pruned)} type(s) without dates to move, avoiding "
+        f"{avoided_resources} resource(s), ~{avoided_bytes} bytes")
+    return ",".join(kept)
+
+
+def build_line_indexes(file_paths):
+    """Build the line index of each plain NDJSON file, unless it has a current one"""
+    for file_path in file_paths:
+        if indexable(file_path):
+            with LineIndex.open(file_path) as index:
+                print(f"line index of {file_path}: {len(index)} line(s)")
+
+
+def sample_resources(file_path, sample_size):
+    """Up to sample_size resources of the file, the first unless it has a line index
+
+    Given a current saved index (see `line_index`), the sample is spread
+    evenly through the file, covering more than its start.
+    """
+    index = LineIndex.load(file_path)
+    if index is None:
+        yield from islice(next_json_object(file_path), sample_size)
+        return
+    with index:
+        step = max(len(index) // sample_size, 1)
+        yield from index.resources(range(0, len(index), step)[:sample_size])
+
+
+def compile_plan(source_dir, sample_size, plan=None, file_paths=None):
+    """Learn a timeshift plan from a sample of sample_size resources of each file
+
+    :param file_paths: files to sample, defaults to all in source_dir
+    """
+    plan = plan or TimeshiftPlan()
+    for file_path in source_files(source_dir, file_paths):
+        for data in sample_resources(file_path, sample_size):
+            fhir_data = FHIR_Resource.parse_fhir(data)
+            plan.learn(fhir_data.resource_type, fhir_data.data, fhir_data.exclusion_attributes())
+    return plan
+
+
+def timeshift_resource(
+        data, num_days, uploader, plan=None, cache=None, journal=None, shard=None, tally=None):
+    """Timeshift given resource data, submitting it to the uploader if changed
+
+    With a journal, resources already completed in the run are skipped, and
+    each is shifted by the days it lags the run's target offset, its partial
+    dates carrying the days it was shifted before.  With a
+    shard (see `shard.ShardSummary`) resources of other shards are skipped.
+    Metrics are added to tally, that of the file, see `fhir_resource.ShiftTally`.
+    """
+    fhir_data = FHIR_Resource.parse_fhir(data)
+    reference = f"{fhir_data.resource_type}/{data['id']}"
+    if shard is not None and not shard.owns(reference):
+        return
+    offset = 0
+    if journal is not None:
+        content_hash = source_hash(data)
+        if journal.is_done(fhir_data.resource_type, data['id'], content_hash):
+            if shard is not None:
+                shard.add(reference)
+            return
+        offset = journal.shifted_days(fhir_data.resource_type, data['id'])
+        num_days = journal.target_offset - offset
+    changed = num_days != 0 and fhir_data.timeshift(
+        num_days=num_days, plan=plan, cache=cache, offset=offset, tally=tally)
+    METRICS.progress()
+    if journal is not None:
+        journal.record(
+            fhir_data.resource_type, data['id'], content_hash, PENDING if changed else UNCHANGED)
+    if shard is not None:
+        shard.add(reference, changed)
+
+    # upload the time warped data to the requested FHIR server
+    if changed:
+        uploader.submit_changes(fhir_data.data, fhir_data.changed_paths)
+
+
+def timeshift_resources(
+        batch, num_days, uploader, plan=None, journal=None, shard=None, tally=None):
+    """Batch engine equivalent of `timeshift_resource()`, over a list of resource data"""
+    resources, days_due, offsets, hashes = [], [], [], []
+    for data in batch:
         fhir_data = FHIR_Resource.parse_fhir(data)
-        changed = fhir_data.timeshift(num_days=num_days)
+        reference = f"{fhir_data.resource_type}/{data['id']}"
+        if shard is not None and not shard.owns(reference):
+            continue
+        if journal is not None:
+            content_hash = source_hash(data)
+            if journal.is_done(fhir_data.resource_type, data['id'], content_hash):
+                if shard is not None:
+                    shard.add(reference)
+                continue
+            hashes.append(content_hash)
+            offsets.append(journal.shifted_days(fhir_data.resource_type, data['id']))
+            days_due.append(journal.target_offset - offsets[-1])
+        else:
+            offsets.append(0)
+            days_due.append(num_days)
+        resources.append(fhir_data)
 
-        # PUT the time warped data to the requested FHIR server
+    changes = FHIR_Resource.timeshift_batch(
+        resources, days_due, plan=plan, offset=offsets, tally=tally)
+    METRICS.progress()
+    for i, (fhir_data, changed) in enumerate(zip(resources, changes)):
+        if journal is not None:
+            journal.record(
+                fhir_data.resource_type, fhir_data.data['id'], hashes[i],
+                PENDING if changed else UNCHANGED)
+        if shard is not None:
+            shard.add(f"{fhir_data.resource_type}/{fhir_data.data['id']}", changed)
         if changed:
-            url = f"{fhir_base_url}{fhir_data.resource_type}/{fhir_data.data['id']}"
-            print(f"PUT timeshift change to {url}")
-            response = requests.put(url, json=fhir_data.data)
-            response.raise_for_status()
+            uploader.submit_changes(fhir_data.data, fhir_data.changed_paths)
+
+
+def pending_filter(journal=None, shard=None):
+    """Predicate of the references left to process, None if all are
+
+    Rejects those of other shards, and given a journal, those completed by
+    the (resumed) run, accounting for the latter in the shard as
+    `timeshift_resource()` does.  Resources of files with a current line
+    index are then skipped without being parsed, see `line_index`.
+    """
+    completed = journal.completed_references() if journal is not None else None
+    if not completed:
+        return shard.owns if shard is not None else None
 
-    for filename in os.listdir(source_dir):
+    def pending(reference):
+        if shard is not None and not shard.owns(reference):
+            return False
+        if reference in completed:
+            if shard is not None:
+                shard.add(reference)
+            return False
+        return True
+    return pending
+
+
+def move_24_ahead(
+        source_dir, fhir_base_url, num_days, plan=None, cache=None, uploader=None, workers=0,
+        journal=None, file_paths=None, batch_size=0, shard=None):
+    """Update the FHIR resources found in files, num_days forward in time
+
+    :param workers: timeshift over this many worker processes when more than one
+    :param batch_size: when set, timeshift with the batch engine, this many
+      resources at a time
+    :param journal: optional run journal, not supported with workers
+    :param file_paths: files to process, defaults to all in source_dir
+    :param shard: only process resources of the summary's shard, accounting for them;
+      those of other shards, or completed by a resumed run of the journal,
+      aren't parsed from files with a current line index
+    :returns: list of failed uploads, see `upload` module
+    """
+    uploader = uploader or PutUploader(fhir_base_url)
+    file_paths = source_files(source_dir, file_paths)
+    if workers > 1:
+        for reference, body in parallel_timeshift(
+                file_paths, num_days, workers=workers, plan=plan,
+                cache_size=cache.maxsize if cache is not None else 0, batch_size=batch_size,
+                shard=shard):
+            uploader.submit_serialized(reference, body)
+            METRICS.progress()
+        return finish(uploader, num_days)
+
+    owns = pending_filter(journal, shard)
+    if batch_size:
+        for file_path in file_paths:
+            resources = read_resources(file_path, owns)
+            with ShiftTally() as tally:
+                while batch := list(islice(resources, batch_size)):
+                    timeshift_resources(
+                        batch, num_days, uploader, plan=plan, journal=journal, shard=shard,
+                        tally=tally)
+        return finish(uploader, num_days)
+
+    for file_path in file_paths:
         # could be single JSON file, or NDJSON
-        for data in next_json_object(os.path.join(source_dir, filename)):
-            timeshift_resource(data)
+        with ShiftTally() as tally:
+            for data in read_resources(file_path, owns):
+                timeshift_resource(
+                    data, num_days, uploader, plan=plan, cache=cache, journal=journal,
+                    shard=shard, tally=tally)
+    return finish(uploader, num_days, cache)
+
+
+# Bound of the lines downloaded ahead of the shift, see `stream_24_ahead()`
+STREAM_QUEUE_SIZE = 10000
+
+
+def stream_24_ahead(
+        file_items, fhir_base_url, num_days, plan=None, cache=None, uploader=None,
+        spool_dir=None, max_workers=4, journal=None, shard=None, compression=None,
+        session=None):
+    """Update the resources of export output files num_days forward in time, as they download
+
+    A pool of download threads streams the file items' URLs into a bounded
+    queue of lines; each is shifted as it arrives and changed resources are
+    handed to the uploader, so upload overlaps download.
+
+    :param spool_dir: optionally also save the downloaded files to this directory
+    :param compression: `gzip` or `zstd` to spool the files compressed
+    :param shard: only process resources of the summary's shard, accounting for them
+    :param session: session to download with, defaults to a new pooled one
+    :returns: list of failed uploads, see `upload` module
+    """
+    uploader = uploader or PutUploader(fhir_base_url)
+    file_items = [
+        file_item for file_item in file_items
+        if FHIR_Resource.is_shiftable(file_item.get("type"))]
+    lines = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    done = object()
+    errors = []
+    stop = threading.Event()
+    session = session or make_session(pool_size=max_workers)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def put(item):
+        """Queue item, unless stopped while waiting for room; returns False if stopped"""
+        while not stop.is_set():
+            try:
+                lines.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def download(file_item):
+        url = fixup_url(url=file_item["url"], base_url=fhir_base_url)
+        spool_filename = (
+            local_filename_for(url, file_item, spool_dir, compression) if spool_dir else None)
+        print("streaming: ", url)
+        for line in stream_ndjson(url, session=session, spool_filename=spool_filename):
+            if not put((url, line)):
+                return
+
+    def feed():
+        try:
+            for future in [executor.submit(download, file_item) for file_item in file_items]:
+                future.result()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(done)
+
+    feeder = threading.Thread(target=feed, name="export-stream", daemon=True)
+    feeder.start()
+    try:
+        with ParseTally() as tally, ShiftTally() as shift_tally:
+            while (item := lines.get()) is not done:
+                url, line = item
+                start = tally.begin()
+                data = parse_json_line(line, url)
+                tally.end(start, data, len(line) + 1)
+                timeshift_resource(
+                    data, num_days, uploader, plan=plan, cache=cache, journal=journal,
+                    shard=shard, tally=shift_tally)
+    finally:
+        # on error above, unblock the downloads waiting on a full queue, and drop the rest
+        stop.set()
+        while not lines.empty():
+            lines.get_nowait()
+        executor.shutdown(cancel_futures=True)
+        feeder.join()
+    failures = finish(uploader, num_days, cache)
+    if errors:
+        raise errors[0]
+    return failures
+
+
+def finish(uploader, num_days, cache=None):
+    """Close out the uploader and report; returns list of failed uploads"""
+    failures = uploader.close()
+    METRICS.progress(force=True)
     print(f"timeshift of {num_days} day(s) complete")
+    if cache is not None:
+        print(f"shift cache: {cache.stats()}")
+    if failures:
+        print(f"{len(failures)} resource(s) failed to upload", file=sys.stderr)
+    return failures
+
+
+def parse_args(argv):
+    """Parse command line, see `usage` at top of file; errors bail with usage"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.error = bail
+    parser.add_argument("fhir_base_url", nargs="?")
+    parser.add_argument("num_days", nargs="?", type=int, default=1)
+    parser.add_argument("input_dir", nargs="?", default="/tmp")
+    parser.add_argument("--plan")
+    parser.add_argument("--plan-sample", type=int)
+    parser.add_argument("--cache-size", type=int, default=100000)
+    parser.add_argument("--bundle-size", type=int, default=0)
+    parser.add_argument("--bundle-type", choices=("batch", "transaction"), default="batch")
+    parser.add_argument("--patch", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--spool", action="store_true")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--engine", choices=("tree", "batch"), default="tree")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--journal")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--new-resources-from-seed", action="store_true")
+    parser.add_argument("--export-types")
+    parser.add_argument("--split-export", action="store_true")
+    parser.add_argument("--prune-types", action="store_true")
+    parser.add_argument("--shard")
+    parser.add_argument("--shard-summary")
+    parser.add_argument("--skip-export", action="store_true")
+    parser.add_argument("--metrics")
+    parser.add_argument("--metrics-textfile")
+    parser.add_argument("--profile")
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    parser.add_argument("--compress", choices=("gzip", "zstd"))
+    parser.add_argument("--line-index", action="store_true")
+    return parser.parse_args(argv)
 
 
 def main():
     """Main function, see `usage` as top of file for documentation."""
-    if len(sys.argv) < 2:
+    args = parse_args(sys.argv[1:])
+    if not args.fhir_base_url:
         bail("requires FHIR_BASE_URL")
-    fhir_base_url = sys.argv[1]
+    fhir_base_url = args.fhir_base_url
     response = requests.options(fhir_base_url)
     try:
         response.raise_for_status()
     except requests.exceptions.HTTPError as he:
         bail(f"Unable to access FHIR_BASE_URL: {fhir_base_url}, {he.response.text}")
 
-    num_days = 1
-    if len(sys.argv) > 2:
-        num_days = int(sys.argv[2])
+    print(f"JSON backend: {BACKEND}")
+    METRICS.progress_interval = args.progress_interval
+    METRICS.reset()
+    if args.profile:
+        METRICS.start_profile()
+    num_days = args.num_days
+    if args.stream and args.plan_sample:
+        bail("--plan-sample requires exported files on disk; use --plan with --stream")
+    if args.journal and args.workers > 1:
+        bail("--journal is not supported with --workers")
+    if args.stream and args.workers > 1:
+        bail("--workers requires the export on disk; not supported with --stream")
+    if args.resume and (args.stream or not args.journal):
+        bail("--resume requires --journal, and the export on disk (not --stream)")
+    if (args.incremental or args.new_resources_from_seed) and not args.journal:
+        bail("--incremental and --new-resources-from-seed require --journal")
+    if args.patch and args.bundle_size > 0:
+        bail("--patch is not supported with --bundle-size")
+    if args.engine == "batch" and (args.stream or args.batch_size < 1):
+        bail("--engine batch requires a positive --batch-size, and is not supported with --stream")
+    if args.split_export and (args.stream or not (args.export_types or args.prune_types)):
+        bail(
+            "--split-export requires --export-types or --prune-types, "
+            "and is not supported with --stream")
+    if args.skip_export and (args.stream or args.resume):
+        bail("--skip-export is not supported with --stream or --resume")
+    if args.line_index and args.stream:
+        bail("--line-index requires the export on disk; not supported with --stream")
+    if not compression_available(args.compress):
+        bail("--compress zstd requires the zstandard package")
+    if args.shard and not (args.skip_export or args.resume):
+        bail("--shard requires --skip-export (or --resume), of an export shared by the nodes")
+    shard = None
+    if args.shard:
+        try:
+            shard = Shard.parse(args.shard)
+        except ValueError:
+            bail(f"invalid --shard `{args.shard}`; expected I/N, with 0 <= I < N")
 
-    input_dir = '/tmp'
-    if len(sys.argv) > 3:
-        input_dir = sys.argv[3]
-        if not os.path.isdir(input_dir):
-            bail(f"can't access input directory `{input_dir}`")
+    input_dir = args.input_dir
+    if not os.path.isdir(input_dir):
+        bail(f"can't access input directory `{input_dir}`")
 
     if not fhir_base_url.endswith('/'):
         fhir_base_url += '/'
 
-    # Export all FHIR resources to temp directory
-    run_export(base_url=fhir_base_url, directory=input_dir)
+    journal, since = None, None
+    if args.journal:
+        journal = Journal(args.journal)
+        if args.incremental:
+            since = journal.last_warp
+            print(f"incremental run, exporting resources changed since {since}")
+        if args.resume:
+            if journal.resume_run() is None:
+                bail(f"no interrupted run to resume in journal `{args.journal}`")
+            num_days = journal.num_days
+            print(f"resuming run {journal.run_id}; timeshift of {num_days} day(s)")
+        else:
+            journal.start_run(
+                num_days, source_dir=input_dir,
+                new_resources_from_seed=args.new_resources_from_seed)
+
+    export_types = args.export_types
+    if args.prune_types and not args.resume:
+        export_types = prune_export_types(fhir_base_url, export_types)
+        if not export_types:
+            bail("no resource types with dates to move left to export")
+    # `+` joined groups only matter to --split-export
+    export_type = export_types.replace("+", ",") if export_types else None
+
+    file_paths = None
+    if args.stream:
+        # Export all FHIR resources, shifting as they stream back
+        with METRICS.stage("export"):
+            file_items = export_file_items(
+                base_url=fhir_base_url, type=export_type, since=since)
+    elif args.resume or args.skip_export:
+        pass  # continue with the export already on disk
+    elif args.split_export:
+        file_paths = run_export_by_type(
+            base_url=fhir_base_url, type_groups=split_type_groups(export_types),
+            directory=input_dir, since=since, compression=args.compress)
+    else:
+        # Export all FHIR resources to temp directory
+        file_paths = run_export(
+            base_url=fhir_base_url, directory=input_dir, type=export_type, since=since,
+            compression=args.compress)
+
+    if args.line_index:
+        build_line_indexes(source_files(input_dir, file_paths))
+
+    plan = None
+    if args.plan_sample:
+        plan = compile_plan(input_dir, args.plan_sample, file_paths=file_paths)
+        if args.plan:
+            plan.save(args.plan)
+    elif args.plan:
+        plan = TimeshiftPlan.load(args.plan)
 
     # Timeshift and PUT any changed resources back to FHIR store
-    return move_24_ahead(input_dir, fhir_base_url, num_days)
+    if args.engine == "batch":
+        print(f"batch timeshift engine, {KERNEL} kernel")
+    cache = ShiftCache(maxsize=args.cache_size) if args.cache_size > 0 else None
+    session = make_session(pool_size=max(args.concurrency, 1))
+    if args.bundle_size > 0:
+        uploader = BundleUploader(
+            fhir_base_url, bundle_size=args.bundle_size, bundle_type=args.bundle_type,
+            session=session, listener=journal)
+    elif args.patch:
+        uploader = PatchUploader(fhir_base_url, session=session, listener=journal)
+    else:
+        uploader = PutUploader(fhir_base_url, session=session, listener=journal)
+    if args.concurrency > 1:
+        uploader = ConcurrentUploader(uploader, concurrency=args.concurrency)
+    summary = None
+    if shard is not None:
+        summary = ShardSummary(
+            shard, num_days, source_files(input_dir, file_paths), source_dir=input_dir)
+        print(f"processing shard {shard}")
+    if args.stream:
+        failures = stream_24_ahead(
+            file_items, fhir_base_url, num_days, plan=plan, cache=cache, uploader=uploader,
+            spool_dir=input_dir if args.spool else None, journal=journal, shard=summary,
+            compression=args.compress)
+    else:
+        failures = move_24_ahead(
+            input_dir, fhir_base_url, num_days, plan=plan, cache=cache, uploader=uploader,
+            workers=args.workers, journal=journal, file_paths=file_paths,
+            batch_size=args.batch_size if args.engine == "batch" else 0, shard=summary)
+    if summary is not None:
+        summary_path = args.shard_summary or f"shard-{shard.index}-of-{shard.count}.json"
+        summary.save(summary_path, uploaded=uploader.uploaded, failures=failures)
+        print(
+            f"shard {shard}: {summary.resources} resource(s), {summary.changed} changed; "
+            f"summary saved to {summary_path}")
+    if journal is not None:
+        print(f"journal run {journal.run_id}: {journal.counts()}")
+        if not failures:
+            journal.complete_run()
+        journal.close()
+    if args.metrics:
+        METRICS.save_json(args.metrics)
+    if args.metrics_textfile:
+        METRICS.save_textfile(args.metrics_textfile)
+    if args.profile:
+        METRICS.stop_profile()
+        METRICS.save_profile(args.profile)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""Streaming timeshift of large local Bundle files, i.e. seed data, before loading
+
+A Bundle is read incrementally: top level members other than `entry` are
+decoded whole, while `entry` is decoded one element at a time.  Each
+entry's `resource` is dispatched to its registered `FHIR_Resource` subclass
+(so per type rules, such as the `Patient.birthDate` exclusion, apply) and
+shifted; the rest of each entry (i.e. `request.ifModifiedSince`,
+`response.lastModified`) and the other members are walked in full, as the
+Bundle is.  The Bundle is written back out as it goes, holding a single
+entry in memory regardless of file size.
+"""
+import argparse
+import json
+import os
+from typing import Any, Iterator, TextIO, Tuple
+
+from fhir_resource import FHIR_Resource, ShiftTally
+from json_codec import dumps
+from timeshift import ShiftCache, timeshift_json_in_place
+from timeshift_plan import TimeshiftPlan
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class JSONStream:
+    """Buffered reader of a JSON text stream, decoding a value or token at a time"""
+
+    def __init__(self, file: TextIO, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.consumed = 0  # characters discarded from the front of the buffer
+        self.eof = False
+
+    def _fill(self, size: int) -> bool:
+        """Read up to size more characters into the buffer; False at end of file"""
+        data = self.file.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.consumed += self.position
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f"{message} at offset {self.consumed + self.position}")
+
+    def peek(self) -> str:
+        """Next non-whitespace character, without consuming it; '' at end of file"""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in _WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill(self.chunk_size):
+                return ''
+
+    def expect(self, token: str):
+        """Consume the given structural character, raising ValueError if it's not next"""
+        if self.peek() != token:
+            raise self._error(f"expected '{token}'")
+        self.position += 1
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value"""
+        self.peek()
+        read_size = self.chunk_size
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # likely cut short by the end of the buffer; read more and retry
+                if not self._fill(read_size):
+                    raise self._error("invalid JSON")
+                read_size *= 2
+                continue
+            if end == len(self.buffer) and not self.eof and self._fill(read_size):
+                continue  # a number may continue past the end of the buffer
+            self.position = end
+            return value
+
+
+def read_bundle(file: TextIO, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[str, Any]]:
+    """Generator of the top level members of a Bundle as (key, value)
+
+    Each element of the `entry` array is yielded on its own, as
+    ("entry", element), never holding the whole array.
+
+    :raises ValueError: on invalid JSON, or if the object isn't a Bundle
+    """
+    stream = JSONStream(file, chunk_size=chunk_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        if not isinstance(key, str):
+            raise stream._error("expected object key")
+        stream.expect(':')
+        if key == "entry" and stream.peek() == '[':
+            stream.expect('[')
+            while stream.peek() != ']':
+                yield key, stream.value()
+                if stream.peek() != ',':
+                    break
+                stream.expect(',')
+            stream.expect(']')
+        else:
+            value = stream.value()
+            if key == "resourceType" and value != "Bundle":
+                raise ValueError(f"expected a Bundle, not {value}")
+            yield key, value
+        if stream.peek() != ',':
+            break
+        stream.expect(',')
+    stream.expect('}')
+
+
+def timeshift_bundle(
+        source: TextIO, target: TextIO, num_days: int, plan: TimeshiftPlan = None,
+        cache: ShiftCache = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """Timeshift the Bundle read from source, writing the result to target as it goes
+
+    :returns: counts of `entries` read and `changed` by the shift, in the
+      entry's resource or elsewhere
+    """
+    counts = {"entries": 0, "changed": 0}
+    bundle_exclusions = FHIR_Resource().exclusion_attributes()
+    in_entries = False
+    separator = ''
+    target.write('{')
+    tally = ShiftTally()
+    for key, value in read_bundle(source, chunk_size=chunk_size):
+        if key == "entry":
+            target.write(',' if in_entries else f'{separator}"entry":[')
+            in_entries, separator = True, ','
+            resource = value.get("resource") if isinstance(value, dict) else None
+            changed = False
+            if isinstance(value, dict):
+                # dates of the entry itself, i.e. `response.lastModified`, as of the Bundle
+                rest = {name: item for name, item in value.items() if name != "resource"}
+                if timeshift_json_in_place(rest, num_days, bundle_exclusions, cache=cache):
+                    value.update(rest)
+                    changed = True
+            if isinstance(resource, dict) and resource.get("resourceType"):
+                fhir_data = FHIR_Resource.parse_fhir(resource)
+                if fhir_data.timeshift(num_days=num_days, plan=plan, cache=cache, tally=tally):
+                    changed = True
+            counts["entries"] += 1
+            counts["changed"] += changed
+            target.write(dumps(value).decode())
+            continue
+
+        if in_entries:
+            target.write(']')
+            in_entries = False
+        member = {key: value}
+        timeshift_json_in_place(member, num_days, bundle_exclusions, cache=cache)
+        target.write(separator + dumps(member).decode()[1:-1])
+        separator = ','
+    if in_entries:
+        target.write(']')
+    target.write('}\n')
+    tally.flush()
+    return counts
+
+
+def timeshift_bundle_file(
+        source_path: str, target_path: str, num_days: int, plan: TimeshiftPlan = None,
+        cache: ShiftCache = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """Timeshift the Bundle file at source_path into target_path, see `timeshift_bundle()`
+
+    Output is written to `<target_path>.part`, renamed when complete.
+    """
+    partial = f"{target_path}.part"
+    with open(source_path, 'r', encoding='utf-8') as source, \
+            open(partial, 'w', encoding='utf-8') as target:
+        counts = timeshift_bundle(
+            source, target, num_days, plan=plan, cache=cache, chunk_size=chunk_size)
+    os.replace(partial, target_path)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Timeshift a (large) local FHIR Bundle file, streaming entry by entry")
+    parser.add_argument("source", help="Bundle JSON file to read")
+    parser.add_argument("target", help="File to write the shifted Bundle to")
+    parser.add_argument(
+        "num_days", type=int, help="Number of days to move date and time values forward")
+    parser.add_argument(
+        "--plan", action="store", help="Use the compiled timeshift plan in the given file")
+    parser.add_argument(
+        "--cache-size", action="store", help="Bound of the shared date shift cache; 0 disables",
+        type=int, default=100000)
+    parser.add_argument(
+        "--chunk-size", action="store", help="Read chunk size in characters",
+        type=int, default=DEFAULT_CHUNK_SIZE)
+
+    args = parser.parse_args()
+    plan = TimeshiftPlan.load(args.plan) if args.plan else None
+    cache = ShiftCache(maxsize=args.cache_size) if args.cache_size > 0 else None
+    counts = timeshift_bundle_file(
+        args.source, args.target, args.num_days, plan=plan, cache=cache,
+        chunk_size=args.chunk_size)
+    print(
+        f"timeshift of {args.num_days} day(s) complete; {counts['changed']} of "
+        f"{counts['entries']} entries changed, saved to {args.target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,13 @@ In general, every element in a FHIR resource should be warped a consistent
 amount of time forward.  The abstractions herein manage exceptions such
 as metadata and birthdate.
 """
-from copy import deepcopy
-from typing import Type, Dict
+from time import perf_counter
+from typing import Type, Dict, List, Sequence, Tuple, Union
 
-from timeshift import timeshift_json
+from metrics import METRICS
+from timeshift import ShiftCache, timeshift_json_in_place, timeshift_planned
+from timeshift_batch import timeshift_batch
+from timeshift_plan import TimeshiftPlan
 
 
 class FHIR_Resource:
@@ -17,8 +20,12 @@ class FHIR_Resource:
     """
     resource_type_map: Dict[str, Type['FHIR_Resource']] = {}
 
+    # False for types without any dates to move; never shifted nor exported
+    shiftable = True
+
     def __init__(self, data: dict = None):
         self.data = data
+        self.changed_paths: List[str] = []
 
     @property
     def resource_type(self):
@@ -34,6 +41,11 @@ class FHIR_Resource:
             return subclass
         return decorator
 
+    @classmethod
+    def is_shiftable(cls, resource_type: str) -> bool:
+        """True unless the subclass registered for resource_type declares no dates to move"""
+        return cls.resource_type_map.get(resource_type, FHIR_Resource).shiftable
+
     @classmethod
     def parse_fhir(cls, data: dict) -> 'FHIR_Resource':
         """
@@ -62,15 +74,95 @@ class FHIR_Resource:
         """
         return ["lastUpdated"]
 
-    def timeshift(self, num_days: int) -> bool:
+    def timeshift(
+            self, num_days: int, plan: TimeshiftPlan = None, cache: ShiftCache = None,
+            offset: int = 0, tally: 'ShiftTally' = None) -> bool:
         """Timeshift forward requested number of days
 
+        Elements are updated in place; JSON Pointers to those changed are
+        available in `changed_paths` after the call.
+
+        :param plan: optional compiled plan; when it covers this resource type
+          only the planned element paths are visited, unless none hold a date
+          to shift, when the resource (which may hold dates at paths the plan
+          wasn't learned from) is walked in full
+        :param cache: optional cache of shifted values, shared across resources
+        :param offset: days the resource was already shifted, i.e. by earlier
+          runs, which partial dates carry, see `timeshift.shift_date_value()`
+        :param tally: metrics of the file or work unit the resource is of,
+          see `ShiftTally`; by default, added to `METRICS` directly
         :returns: True if timeshift resulted in any change, False otherwise
         """
-        data_b4 = deepcopy(self.data)
-        self.data = timeshift_json(
-            self.data, num_days=num_days, exclusion_list=self.exclusion_attributes())
-        return data_b4 != self.data
+        if tally is None:
+            with ShiftTally() as tally:
+                return self.timeshift(num_days, plan=plan, cache=cache, offset=offset, tally=tally)
+
+        start = perf_counter()
+        if not self.shiftable:
+            self.changed_paths = []
+        else:
+            plan_paths = plan.paths_for(self.resource_type) if plan else None
+            if plan_paths is not None:
+                self.changed_paths = timeshift_planned(
+                    self.data, plan_paths, num_days=num_days,
+                    exclusion_list=self.exclusion_attributes(), cache=cache, offset=offset)
+                if not self.changed_paths:
+                    tally.count("resources_unplanned", self.resource_type)
+                    plan_paths = None
+            if plan_paths is None:
+                self.changed_paths = timeshift_json_in_place(
+                    self.data, num_days=num_days,
+                    exclusion_list=self.exclusion_attributes(), cache=cache, offset=offset)
+        tally.end(start, (self,))
+        return bool(self.changed_paths)
+
+    @classmethod
+    def timeshift_batch(
+            cls, resources: Sequence['FHIR_Resource'], num_days: Union[int, Sequence[int]],
+            plan: TimeshiftPlan = None, kernel: str = None,
+            offset: Union[int, Sequence[int]] = 0, tally: 'ShiftTally' = None) -> List[bool]:
+        """Timeshift a batch of resources at once, see `timeshift_batch` module
+
+        Equivalent to calling `timeshift()` on each, with identical results.
+
+        :param num_days: days to shift every resource, or per resource
+        :param kernel: `numpy` or `python`, see `timeshift_batch.shift_values()`
+        :param offset: days every resource was already shifted, or per resource
+        :param tally: metrics of the file or work unit, see `timeshift()`
+        :returns: per resource, True if timeshift resulted in any change
+        """
+        if tally is None:
+            with ShiftTally() as tally:
+                return cls.timeshift_batch(
+                    resources, num_days, plan=plan, kernel=kernel, offset=offset, tally=tally)
+
+        start = perf_counter()
+        if isinstance(num_days, int):
+            num_days = [num_days] * len(resources)
+        if isinstance(offset, int):
+            offset = [offset] * len(resources)
+        items = [
+            (resource.data, days, resource.exclusion_attributes(),
+             plan.paths_for(resource.resource_type) if plan else None, shifted)
+            for resource, days, shifted in zip(resources, num_days, offset)
+            if resource.shiftable]
+        changed_paths = timeshift_batch(items, kernel=kernel)
+        # as `timeshift()`, resources the plan finds no dates in are walked in full
+        unplanned = [
+            index for index, (item, paths) in enumerate(zip(items, changed_paths))
+            if item[3] is not None and not paths]
+        if unplanned:
+            fallback = timeshift_batch(
+                [items[index][:3] + (None,) + items[index][4:] for index in unplanned],
+                kernel=kernel)
+            for index, paths in zip(unplanned, fallback):
+                changed_paths[index] = paths
+                tally.count("resources_unplanned", items[index][0]["resourceType"])
+        changed_paths = iter(changed_paths)
+        for resource in resources:
+            resource.changed_paths = next(changed_paths) if resource.shiftable else []
+        tally.end(start, resources)
+        return [bool(resource.changed_paths) for resource in resources]
 
 
 @FHIR_Resource.register_resource("Patient")
@@ -83,3 +175,75 @@ class Patient(FHIR_Resource):
         ex_list = super().exclusion_attributes()
         ex_list.append("birthDate")
         return ex_list
+
+
+# Definitional, terminology and administrative resource types; any dates they
+# hold (publication, review, etc.) describe the artifact, not the mock timeline
+UNSHIFTED_RESOURCE_TYPES = (
+    "CodeSystem",
+    "ConceptMap",
+    "Endpoint",
+    "Location",
+    "NamingSystem",
+    "OperationDefinition",
+    "Organization",
+    "Questionnaire",
+    "SearchParameter",
+    "StructureDefinition",
+    "ValueSet",
+)
+
+
+class Unshifted(FHIR_Resource):
+    """Resource types without dates to move, see `UNSHIFTED_RESOURCE_TYPES`"""
+    shiftable = False
+
+
+for _resource_type in UNSHIFTED_RESOURCE_TYPES:
+    FHIR_Resource.register_resource(_resource_type)(Unshifted)
+
+
+class ShiftTally:
+    """Timeshift metrics of a file or work unit of resources, added to `METRICS` in bulk
+
+    As `input_util.ParseTally`: timing a `METRICS.stage()` and counting per
+    resource would take the registry's lock several times a resource, so
+    time and counts per type are accumulated locally, and flushed every
+    `flush_every` resources and on exit.
+    """
+
+    def __init__(self, flush_every: int = 256):
+        self.flush_every = flush_every
+        self._reset()
+
+    def _reset(self):
+        self.seconds, self.pending = 0.0, 0
+        self.counts: Dict[Tuple[str, str], int] = {}
+
+    def count(self, name: str, resource_type: str):
+        """Count a resource of resource_type in the counter name"""
+        key = (name, resource_type)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def end(self, start: float, resources: Sequence[FHIR_Resource]):
+        """Record the timeshift of resources, begun at start (a `perf_counter()`)"""
+        self.seconds += perf_counter() - start
+        for resource in resources:
+            self.count(
+                "resources_shifted" if resource.changed_paths else "resources_unchanged",
+                resource.resource_type)
+        self.pending += len(resources)
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        METRICS.add(("stage_seconds", (("stage", "timeshift"),)), self.seconds)
+        for (name, resource_type), count in self.counts.items():
+            METRICS.add((name, (("type", resource_type),)), count)
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
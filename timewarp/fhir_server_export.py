@@ -4,28 +4,292 @@ This minimally altered script was copied from:
 https://github.com/uwcirg/fhir-eval-environments/blob/main/utils/fhir-server-export.py
 """
 import argparse, os, requests, sys, json, time
+from concurrent.futures import ThreadPoolExecutor
+
+from input_util import (
+    COMPRESSION_SUFFIXES,
+    DECOMPRESSION_ERRORS,
+    compression_available,
+    compression_of,
+    open_input,
+    open_output,
+    output_compression,
+    strip_compression_suffix,
+)
+from metrics import METRICS
+from upload import parse_retry_after
+
+# Adaptive status polling; first interval and cap, in seconds, see `next_poll_wait()`
+POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 30.0
+# Status poll responses of a server throttling polls; polled again after its Retry-After
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+def _expected_size(response, offset):
+    """Total size of the file being downloaded, as transferred, if the server reported it"""
+    if response.status_code == 206:
+        content_range = response.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get("Content-Length")
+    return int(content_length) if content_length and content_length.isdigit() else None
+
+
+def validate_ndjson(filename):
+    """Confirm the final line of an NDJSON file is complete; raises IOError if not
+
+    Compressed files (see `input_util.open_input()`) are decompressed in
+    full, which also verifies the compressed stream is complete.
+    """
+    if compression_of(filename) is not None:
+        tail = b""
+        try:
+            with open_input(filename) as f:
+                while chunk := f.read(1024 * 1024):
+                    tail += chunk
+                    # keep from the start of the last non-empty line
+                    cut = tail.rstrip().rfind(b"\n")
+                    if cut > 0:
+                        tail = tail[cut:]
+        except DECOMPRESSION_ERRORS as e:
+            raise IOError(f"truncated or corrupt compressed NDJSON {filename}: {e}")
+        _validate_last_line(filename, tail)
+        return
+
+    with open(filename, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        position, tail = end, b""
+        # read backwards until the start of the last non-empty line
+        while position > 0:
+            step = min(64 * 1024, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            if b"\n" in tail.rstrip():
+                break
+    _validate_last_line(filename, tail)
+
+
+def _validate_last_line(filename, tail):
+    last_line = tail.rstrip().rpartition(b"\n")[2]
+    if not last_line:
+        return
+    try:
+        json.loads(last_line)
+    except ValueError:
+        raise IOError(f"truncated NDJSON, final line of {filename} is incomplete")
+
 
+def download_file(
+        url, filename=None, auth_token=None, chunk_size=1024*1024, max_retries=3,
+        session=None):
+    """Download given large file via streaming
 
-def download_file(url, filename=None, auth_token=None):
-    """Download given large file via streaming"""
+    The transfer is requested gzip encoded.  A filename ending `.gz` or `.zst`
+    is saved compressed (see `input_util.open_output()`); a gzip encoded
+    transfer is then saved as is, without decoding and compressing again.
+
+    Data is written to `<filename>.part`, renamed when complete.  Interrupted
+    downloads of uncompressed files (including those of an earlier run)
+    resume via HTTP Range requests when the server supports them; those of
+    compressed files start over.  The result is checked against the
+    reported size and for a complete final NDJSON line.
+    """
     # https://stackoverflow.com/a/16696317
+    session = session or requests
     headers = {}
     if auth_token is not None:
         headers["Authorization"] = f"Bearer {auth_token}"
 
     if not filename:
         filename = url.split("/")[-1]
-    with requests.get(url, headers=headers, stream=True) as r:
-        r.raise_for_status()
-        with open(filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                # if chunk:
-                f.write(chunk)
+    partial = f"{filename}.part"
+    compressed = output_compression(filename) is not None
+
+    for attempt in range(max_retries + 1):
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset and compressed:
+            os.remove(partial)
+            offset = 0
+        request_headers = dict(headers)
+        if offset:
+            # ranges of a gzip encoded transfer aren't byte offsets into the file
+            request_headers["Accept-Encoding"] = "identity"
+            request_headers["Range"] = f"bytes={offset}-"
+        else:
+            request_headers["Accept-Encoding"] = "gzip"
+        transferred = 0
+        try:
+            with session.get(url, headers=request_headers, stream=True) as r:
+                if r.status_code == 416 and offset:
+                    # nothing left to fetch, or a stale partial; restart
+                    os.remove(partial)
+                    continue
+                r.raise_for_status()
+                if r.status_code != 206:
+                    offset = 0  # Range unsupported; start over
+                expected_size = _expected_size(r, offset)
+                encoding = r.headers.get("Content-Encoding", "identity").lower()
+                if encoding == "gzip" and output_compression(filename) == "gzip":
+                    # a gzip encoded body is a gzip file
+                    with open(partial, "wb") as f:
+                        for chunk in r.raw.stream(chunk_size, decode_content=False):
+                            f.write(chunk)
+                elif offset:
+                    with open(partial, "ab") as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                else:
+                    with open_output(partial, output_compression(filename)) as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                transferred = r.raw.tell()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == max_retries:
+                raise
+            print(f"download of {url} interrupted ({e}), resuming", file=sys.stderr)
+            continue
+        finally:
+            METRICS.count("downloaded_bytes", transferred)
+
+        size = (offset if r.status_code == 206 else 0) + transferred
+        if expected_size is not None and size != expected_size:
+            if attempt == max_retries:
+                raise IOError(f"truncated download of {url}: {size} of {expected_size} bytes")
+            print(f"download of {url} incomplete, resuming", file=sys.stderr)
+            continue
+        break
+    else:
+        raise IOError(f"unable to download {url}")
+
+    if strip_compression_suffix(filename).endswith(".ndjson"):
+        validate_ndjson(partial)
+    os.replace(partial, filename)
     return filename
 
 
+def local_filename_for(url, file_item, directory, compression=None):
+    """Local path to save the given export output file item
+
+    :param compression: `gzip` or `zstd` to save the file compressed, named
+      with the matching suffix
+    """
+    local_filename = ".".join((
+        url.split("/")[-1],
+        file_item["type"],
+        "ndjson",
+    ))
+    if compression:
+        local_filename += COMPRESSION_SUFFIXES[compression]
+    return os.path.join(directory, local_filename)
+
+
+def file_resource_type(file_path):
+    """Resource type of an export output file named by `local_filename_for()`, else None"""
+    parts = os.path.basename(strip_compression_suffix(file_path)).split(".")
+    if len(parts) < 3 or parts[-1] != "ndjson":
+        return None
+    return parts[-2]
+
+
+def stream_ndjson(url, auth_token=None, session=None, chunk_size=1024*1024, spool_filename=None):
+    """Generator yielding each non-empty line of an NDJSON file as it downloads
+
+    The transfer is requested gzip encoded, and decoded as it streams.
+
+    :param spool_filename: optionally also save the downloaded file, compressed
+      if named `.gz` or `.zst`
+    :raises IOError: if the transfer is cut short of the reported size, before
+      yielding the (possibly incomplete) final line
+    """
+    session = session or requests
+    headers = {"Accept-Encoding": "gzip"}
+    if auth_token is not None:
+        headers["Authorization"] = f"Bearer {auth_token}"
+
+    with session.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        spool = (
+            open_output(spool_filename, output_compression(spool_filename))
+            if spool_filename else None)
+        last_line = None
+        try:
+            for line in r.iter_lines(chunk_size=chunk_size):
+                if spool:
+                    spool.write(line + b"\n")
+                if not line.strip():
+                    continue
+                if last_line is not None:
+                    yield last_line
+                # held back until the size is checked; a dropped transfer cuts it short
+                last_line = line
+        finally:
+            METRICS.count("downloaded_bytes", r.raw.tell())
+            if spool:
+                spool.close()
+        expected_size = _expected_size(r, 0)
+        if expected_size is not None and r.raw.tell() != expected_size:
+            raise IOError(f"truncated download of {url}: {r.raw.tell()} of {expected_size} bytes")
+        if last_line is not None:
+            yield last_line
+
+
+def download_session(pool_size=4):
+    """Session pooling keep-alive connections for pool_size concurrent downloads"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_item(
+        file_item, base_url, directory='./', auth_token=None, chunk_size=1024*1024,
+        session=None, compression=None):
+    """Download a single `output` file item of a completed export; returns local filename
+
+    :param compression: `gzip` or `zstd` to save the file compressed
+    """
+    url = fixup_url(url=file_item["url"], base_url=base_url)
+    local_filename = local_filename_for(url, file_item, directory, compression)
+    print("downloading: ", url)
+    with METRICS.stage("download"):
+        download_file(
+            url=url, filename=local_filename, auth_token=auth_token,
+            chunk_size=chunk_size, session=session)
+    print("saved to: ", local_filename)
+    return local_filename
+
+
+def download_files(
+        file_items, base_url, directory='./', auth_token=None, max_workers=4,
+        chunk_size=1024*1024, compression=None, session=None):
+    """Download the `output` file items of a completed export, concurrently
+
+    :param compression: `gzip` or `zstd` to save the files compressed
+    :param session: session to download with, i.e. one kept open across
+      exports; defaults to a new `download_session()`, closed when done
+    :returns: list of local filenames, in file_items order
+    """
+    if session is None:
+        with download_session(max_workers) as session:
+            return download_files(
+                file_items, base_url=base_url, directory=directory, auth_token=auth_token,
+                max_workers=max_workers, chunk_size=chunk_size, compression=compression,
+                session=session)
+
+    def download(file_item):
+        return download_item(
+            file_item, base_url=base_url, directory=directory, auth_token=auth_token,
+            chunk_size=chunk_size, session=session, compression=compression)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(download, file_items))
+
+
 def fixup_url(url, base_url):
     """
     Replace FHIR base URL in given FHIR API call with different base_url
@@ -50,38 +314,126 @@ def fixup_url(url, base_url):
         return f"{base_url}/{second_last_path}/{last_path}"
 
 
-def poll_status(status_poll_url, auth_token=None, max_rety_time=600):
-    """Poll given status URL until ready (or timeout).
+def check_status(status_poll_url, auth_token=None, session=None):
+    """Request export status once
 
-    Returns response JSON when ready to download
+    Returns (response, retry_after); retry_after is None once the export is
+    complete, otherwise the seconds the server asked to wait (0.0 if it
+    didn't say).  A poll throttled by the server (see `THROTTLE_STATUS_CODES`)
+    is returned as one in progress, to poll again.
     """
-
+    session = session or requests
     headers = {}
     if auth_token is not None:
         headers["Authorization"] = f"Bearer {auth_token}"
 
-    rety_time = 0
-    while rety_time < max_rety_time:
-        status_poll_response = requests.get(status_poll_url, headers=headers)
-        status_poll_response.raise_for_status()
+    status_poll_response = session.get(status_poll_url, headers=headers)
+    retry_after = parse_retry_after(status_poll_response.headers.get("Retry-After"))
+    if status_poll_response.status_code in THROTTLE_STATUS_CODES:
+        print(
+            f"status poll of {status_poll_url} throttled "
+            f"({status_poll_response.status_code})", file=sys.stderr)
+        return status_poll_response, retry_after or 0.0
+    status_poll_response.raise_for_status()
+
+    if status_poll_response.status_code != 202 and not retry_after:
+        return status_poll_response, None
+
+    progress = status_poll_response.headers.get("X-Progress")
+    if progress:
+        print(f"progress of {status_poll_url}: ", progress)
+    return status_poll_response, retry_after or 0.0
+
+
+def next_poll_wait(retry_after, interval, max_interval=MAX_POLL_INTERVAL, throttled=False):
+    """Adaptive poll wait; returns (seconds to wait, interval for the poll after)
+
+    The interval starts short and doubles on each poll, up to max_interval,
+    so small exports are noticed promptly without hammering the server over
+    long ones.  A server's `Retry-After` (often a flat 120 seconds on HAPI,
+    regardless of the size of the export) bounds the wait but doesn't extend it,
+    unless the server has throttled polls (see `check_status()`): then it's
+    waited in full.
+    """
+    if throttled and retry_after:
+        wait = retry_after
+    else:
+        wait = min(retry_after, interval) if retry_after else interval
+    return wait, min(interval * 2, max_interval)
+
 
-        retry_after = int(status_poll_response.headers.get("Retry-After", 0))
-        if not retry_after:
-            return status_poll_response
+def poll_status(
+        status_poll_url, auth_token=None, max_rety_time=600, poll_interval=POLL_INTERVAL,
+        max_poll_interval=MAX_POLL_INTERVAL, session=None):
+    """Poll given status URL until ready (or timeout).
 
-        progress = status_poll_response.headers.get("X-Progress")
-        if progress:
-            print("progress: ", progress)
+    Returns response JSON when ready to download
+    """
+    deadline = time.monotonic() + max_rety_time
+    interval, throttled = poll_interval, False
+    while True:
+        status_poll_response, retry_after = check_status(
+            status_poll_url, auth_token=auth_token, session=session)
+        if retry_after is None:
+            return status_poll_response
 
-        print(f"waiting {retry_after} seconds")
-        rety_time += retry_after
-        time.sleep(retry_after)
+        throttled = throttled or status_poll_response.status_code in THROTTLE_STATUS_CODES
+        wait, interval = next_poll_wait(
+            retry_after, interval, max_poll_interval, throttled=throttled)
+        if time.monotonic() + wait > deadline:
+            break
+        print(f"waiting {wait:g} seconds")
+        time.sleep(wait)
     print("timeout exceeded", file=sys.stderr)
     exit(1)
 
 
-def kickoff(base_url, no_cache=False, auth_token=None, type=None, since=None):
+def _auth_headers(auth_token=None):
+    headers = {"Accept": "application/fhir+json"}
+    if auth_token is not None:
+        headers["Authorization"] = f"Bearer {auth_token}"
+    return headers
+
+
+def server_resource_types(base_url, auth_token=None, session=None):
+    """Resource types the server supports, per its CapabilityStatement"""
+    session = session or requests
+    response = session.get(f"{base_url.rstrip('/')}/metadata", headers=_auth_headers(auth_token))
+    response.raise_for_status()
+    return [
+        resource["type"]
+        for rest in response.json().get("rest", [])
+        for resource in rest.get("resource", [])]
+
+
+def estimate_export_size(base_url, resource_type, auth_token=None, sample_size=10, session=None):
+    """Estimate what exporting resource_type would cost
+
+    The count comes from `_summary=count`; bytes are extrapolated from the
+    serialized size of a sample page of resources.
+
+    :returns: (number of resources, estimated NDJSON bytes)
+    """
+    session = session or requests
+    url = f"{base_url.rstrip('/')}/{resource_type}"
+    headers = _auth_headers(auth_token)
+    response = session.get(url, headers=headers, params={"_summary": "count"})
+    response.raise_for_status()
+    count = response.json().get("total", 0)
+    if not count:
+        return 0, 0
+
+    response = session.get(url, headers=headers, params={"_count": sample_size})
+    response.raise_for_status()
+    sample = [
+        len(json.dumps(entry["resource"], separators=(",", ":"))) + 1
+        for entry in response.json().get("entry", []) if "resource" in entry]
+    return count, count * sum(sample) // len(sample) if sample else 0
+
+
+def kickoff(base_url, no_cache=False, auth_token=None, type=None, since=None, session=None):
     """Initate a Bulk Export, return endpoint to poll"""
+    session = session or requests
     headers = {
         "Accept": "application/fhir+json",
         "Prefer": "respond-async",
@@ -101,7 +453,7 @@ def kickoff(base_url, no_cache=False, auth_token=None, type=None, since=None):
     if since is not None:
         params["_since"] = since
 
-    kickoff_response = requests.get(
+    kickoff_response = session.get(
         url=f"{base_url}/$export",
         headers=headers,
         params=params,
@@ -122,14 +474,53 @@ def kickoff(base_url, no_cache=False, auth_token=None, type=None, since=None):
 def main():
     parser = argparse.ArgumentParser(description="Download FHIR resources using Bulk Export")
     parser.add_argument("base_url", help="FHIR base URL")
-    parser.add_argument("--directory", action="store", help="Save files to given directory", default="./")
+    parser.add_argument(
+        "--directory", action="store", help="Save files to given directory", default="./")
     parser.add_argument("--no-cache", action="store_true", help="Disable server-side caching")
-    parser.add_argument("--max-timeout", action="store", help="Max timeout in seconds before failing", type=int, default=60*10)
+    parser.add_argument(
+        "--max-timeout", action="store", help="Max timeout in seconds before failing",
+        type=int, default=60*10)
     parser.add_argument("--auth-token", action="store", help="Use given token to authenticate")
-    parser.add_argument("--type", action="store", help="Restrict Export to specific (comma-separated) resource types; see _type")
-    parser.add_argument("--since", action="store", help="Restrict Export to resources last updated on or after the given time (format eg '2019-10-25T11:14:00Z'); see _since")
+    parser.add_argument(
+        "--type", action="store",
+        help="Restrict Export to specific (comma-separated) resource types; see _type")
+    parser.add_argument(
+        "--since", action="store",
+        help="Restrict Export to resources last updated on or after the given time "
+             "(format eg '2019-10-25T11:14:00Z'); see _since")
+    parser.add_argument(
+        "--download-concurrency", action="store",
+        help="Number of output files to download concurrently", type=int, default=4)
+    parser.add_argument(
+        "--chunk-size", action="store", help="Download chunk size in bytes", type=int,
+        default=1024*1024)
+    parser.add_argument(
+        "--split-types", action="store_true",
+        help="Run a separate export per --type (or `+` joined group of types) in parallel, "
+             "downloading each as it completes")
+    parser.add_argument(
+        "--compress", action="store", choices=sorted(COMPRESSION_SUFFIXES),
+        help="Save output files compressed; zstd requires the zstandard package")
 
     args = parser.parse_args()
+    if not compression_available(args.compress):
+        parser.error("--compress zstd requires the zstandard package")
+    if args.split_types:
+        if not args.type:
+            parser.error("--split-types requires --type")
+        run_export_by_type(
+            base_url=args.base_url,
+            type_groups=split_type_groups(args.type),
+            directory=args.directory,
+            no_cache=args.no_cache,
+            max_timeout=args.max_timeout,
+            auth_token=args.auth_token,
+            since=args.since,
+            max_workers=args.download_concurrency,
+            chunk_size=args.chunk_size,
+            compression=args.compress,
+        )
+        return
     run_export(
         base_url=args.base_url,
         directory=args.directory,
@@ -138,13 +529,65 @@ def main():
         auth_token=args.auth_token,
         type=args.type,
         since=args.since,
+        max_workers=args.download_concurrency,
+        chunk_size=args.chunk_size,
+        compression=args.compress,
     )
 
 
 def run_export(
         base_url, directory='./', no_cache=False, max_timeout=60*10, auth_token=None,
-        type=None, since=None):
-    """run export as requested.  see main() arg lists for parameter documentation"""
+        type=None, since=None, max_workers=4, chunk_size=1024*1024, compression=None,
+        session=None):
+    """run export as requested.  see main() arg lists for parameter documentation
+
+    :param session: session to export and download the output files with, i.e.
+      one kept open across exports; defaults to a new `download_session()`,
+      closed when done
+    """
+    if session is None:
+        with download_session(max_workers) as session:
+            return run_export(
+                base_url, directory=directory, no_cache=no_cache, max_timeout=max_timeout,
+                auth_token=auth_token, type=type, since=since, max_workers=max_workers,
+                chunk_size=chunk_size, compression=compression, session=session)
+
+    with METRICS.stage("export"):
+        file_items = export_file_items(
+            base_url=base_url,
+            no_cache=no_cache,
+            max_timeout=max_timeout,
+            auth_token=auth_token,
+            type=type,
+            since=since,
+            session=session,
+        )
+    return download_files(
+        file_items,
+        base_url=base_url,
+        directory=directory,
+        auth_token=auth_token,
+        max_workers=max_workers,
+        chunk_size=chunk_size,
+        compression=compression,
+        session=session,
+    )
+
+
+def export_file_items(
+        base_url, no_cache=False, max_timeout=60*10, auth_token=None, type=None, since=None,
+        session=None):
+    """Kickoff export and wait for completion; returns the `output` file items
+
+    :param session: session to kick off and poll with, keeping its connection
+      alive between polls; defaults to a new one, closed when done
+    """
+    if session is None:
+        with download_session(1) as session:
+            return export_file_items(
+                base_url, no_cache=no_cache, max_timeout=max_timeout, auth_token=auth_token,
+                type=type, since=since, session=session)
+
     print(f"Launch export against {base_url}")
     status_poll_url = kickoff(
         base_url=base_url,
@@ -152,16 +595,29 @@ def run_export(
         auth_token=auth_token,
         type=type,
         since=since,
+        session=session,
     )
     complete_response = poll_status(
         fixup_url(url=status_poll_url, base_url=base_url),
         auth_token=auth_token,
         max_rety_time=max_timeout,
+        session=session,
     )
+    return complete_file_items(complete_response, since=since)
+
+
+def complete_file_items(complete_response, since=None, required=True):
+    """The `output` file items of a Complete status response
+
+    :param required: exit if the export produced no output files (other
+      than for a `since` restricted export, where that's expected)
+    """
     try:
         complete_json = complete_response.json()
     except json.decoder.JSONDecodeError:
-        print("error: export completed successfully, but response is not JSON: ", complete_response.text)
+        print(
+            "error: export completed successfully, but response is not JSON: ",
+            complete_response.text)
         print("warning: the Bulk Export request (for Hapi) likely did not return any resources")
         exit(1)
 
@@ -170,23 +626,89 @@ def run_export(
         print(errors)
 
     file_items = complete_json.get("output")
+    if not file_items and since is not None:
+        print(f"no resources changed since {since}")
+        return []
+    if not file_items and not required:
+        return []
     if not file_items:
         print("warning: no files listed in Complete status response:")
         print(complete_json)
         exit(1)
+    return file_items
 
-    for file_item in file_items:
-        url = fixup_url(url=file_item["url"], base_url=base_url)
-
-        local_filename = ".".join((
-            url.split("/")[-1],
-            file_item["type"],
-            "ndjson",
-        ))
-        local_filename = os.path.join(directory, local_filename)
-        print("downloading: ", url)
-        download_file(url=url, filename=local_filename, auth_token=auth_token)
-        print("saved to: ", local_filename)
+
+def split_type_groups(type):
+    """Split a --type list into groups to export separately; `+` joins types of a group
+
+    i.e. `Patient,Encounter+EpisodeOfCare` yields `Patient` and `Encounter,EpisodeOfCare`
+    """
+    return [group.replace("+", ",") for group in type.split(",") if group]
+
+
+def run_export_by_type(
+        base_url, type_groups, directory='./', no_cache=False, max_timeout=60*10,
+        auth_token=None, since=None, max_workers=4, chunk_size=1024*1024,
+        poll_interval=POLL_INTERVAL, max_poll_interval=MAX_POLL_INTERVAL, compression=None):
+    """Run a separate export per group of types in parallel, polling them together
+
+    The output files of each export start downloading as soon as it
+    completes, so small types don't wait behind the largest.
+
+    :returns: list of local filenames, in type_groups order
+    """
+    print(f"Launch {len(type_groups)} export(s) against {base_url}")
+    # kickoffs, polls and downloads all share the session's connections
+    session = download_session(max(max_workers, len(type_groups)))
+    with METRICS.stage("export"), ThreadPoolExecutor(max_workers=len(type_groups)) as executor:
+        status_poll_urls = dict(zip(type_groups, executor.map(
+            lambda group: fixup_url(
+                url=kickoff(
+                    base_url=base_url, no_cache=no_cache, auth_token=auth_token,
+                    type=group, since=since, session=session),
+                base_url=base_url),
+            type_groups)))
+
+    started = time.monotonic()
+    deadline = started + max_timeout
+    next_poll = dict.fromkeys(type_groups, started)
+    intervals = dict.fromkeys(type_groups, poll_interval)
+    # polls of every export are to the same server; once it throttles one, it's heeded for all
+    throttled = False
+    downloads = {group: [] for group in type_groups}
+    with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while next_poll:
+            group = min(next_poll, key=next_poll.get)
+            if next_poll[group] > deadline:
+                print(
+                    f"timeout exceeded, waiting on export of {', '.join(next_poll)}",
+                    file=sys.stderr)
+                exit(1)
+            time.sleep(max(next_poll[group] - time.monotonic(), 0))
+
+            with METRICS.stage("export"):
+                complete_response, retry_after = check_status(
+                    status_poll_urls[group], auth_token=auth_token, session=session)
+            if retry_after is not None:
+                throttled = throttled or complete_response.status_code in THROTTLE_STATUS_CODES
+                wait, intervals[group] = next_poll_wait(
+                    retry_after, intervals[group], max_poll_interval, throttled=throttled)
+                next_poll[group] = time.monotonic() + wait
+                continue
+
+            del next_poll[group]
+            file_items = complete_file_items(complete_response, since=since, required=False)
+            print(
+                f"export of {group} complete after {time.monotonic() - started:.1f} seconds, "
+                f"{len(file_items)} file(s); {len(next_poll)} export(s) pending")
+            downloads[group] = [
+                executor.submit(
+                    download_item, file_item, base_url=base_url, directory=directory,
+                    auth_token=auth_token, chunk_size=chunk_size, session=session,
+                    compression=compression)
+                for file_item in file_items]
+
+        return [future.result() for group in type_groups for future in downloads[group]]
 
 
 if __name__ == "__main__":
@@ -1,10 +1,165 @@
-import json
+"""Reading of JSON and NDJSON input files, plain or compressed
+
+Files compressed with gzip, or zstd (given the optional `zstandard`
+package), are detected by their magic bytes and decompressed as a stream,
+whatever their name.
+"""
+import gzip
+import io
+import os
+from time import perf_counter
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+
+from json_codec import JSONDecodeError, loads
+from metrics import METRICS
+
+try:
+    import zstandard
+except ImportError:  # optional, see module docstring
+    zstandard = None
+
+# File name suffix of each supported compression
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# Compression level of gzip output; NDJSON compresses well even at low levels
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+# Raised reading truncated or corrupt compressed data
+DECOMPRESSION_ERRORS = (EOFError, gzip.BadGzipFile) + (
+    (zstandard.ZstdError,) if zstandard is not None else ())
+
+_MAGIC = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+_NDJSON_EXTENSION = ".ndjson"
+# Bytes read from the start of other files, looking for a FHIR `resourceType`
+_SNIFF_SIZE = 16384
+
+
+def compression_of(file_path: str) -> Optional[str]:
+    """`gzip` or `zstd`, per the magic bytes the file starts with; None if neither"""
+    with open(file_path, 'rb') as file:
+        head = file.read(4)
+    for magic, compression in _MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def compression_available(compression: Optional[str]) -> bool:
+    """False if compression is `zstd` and the `zstandard` package isn't installed"""
+    return compression != "zstd" or zstandard is not None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise IOError("zstd compression requires the `zstandard` package")
+
+
+def open_input(file_path: str) -> BinaryIO:
+    """Open file_path for binary reading, decompressing as a stream if compressed"""
+    compression = compression_of(file_path)
+    if compression == "gzip":
+        return gzip.open(file_path, 'rb')
+    if compression == "zstd":
+        _require_zstandard()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(file_path, 'rb'), read_across_frames=True))
+    return open(file_path, 'rb')
+
+
+def output_compression(file_path: str) -> Optional[str]:
+    """Compression to write file_path with, per its suffix; None if plain"""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if file_path.endswith(suffix):
+            return compression
+    return None
+
+
+def open_output(file_path: str, compression: Optional[str]) -> BinaryIO:
+    """Open file_path for binary writing, compressed with `gzip`, `zstd` or None"""
+    if compression == "gzip":
+        return gzip.open(file_path, 'wb', compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        _require_zstandard()
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(file_path, 'wb'))
+    return open(file_path, 'wb')
+
+
+def strip_compression_suffix(file_path: str) -> str:
+    compression = output_compression(file_path)
+    return file_path[:-len(COMPRESSION_SUFFIXES[compression])] if compression else file_path
+
+
+def is_input_file(file_path: str) -> bool:
+    """True if file_path looks like FHIR JSON or NDJSON input, plain or compressed
+
+    Named `.ndjson` (optionally followed by `.gz` or `.zst`), or otherwise
+    holding a `"resourceType"` key near its (decompressed) start.  Partial
+    downloads (`.part`), hidden files, the journal, and JSON files left in a
+    directory by earlier runs, such as plans, metrics or shard summaries,
+    are not.  Compressed files that can't be read are, to fail when read.
+    """
+    name = os.path.basename(file_path)
+    if name.startswith('.') or name.endswith('.part') or not os.path.isfile(file_path):
+        return False
+    stem = strip_compression_suffix(name)
+    extension = os.path.splitext(stem)[1]
+    if extension == _NDJSON_EXTENSION:
+        return True
+    if extension and stem != name and extension != ".json":
+        return False  # compressed, but not JSON by name
+    if not compression_available(compression_of(file_path)):
+        return True
+    try:
+        with open_input(file_path) as file:
+            head = file.read(_SNIFF_SIZE)
+    except DECOMPRESSION_ERRORS:
+        return True
+    return b'"resourceType"' in head
+
+
+def _read_first_object(file: BinaryIO, file_path: str) -> Tuple[str, Optional[object]]:
+    """
+    Parse the first JSON object from an open file, reading no more than required.
+
+    A first non-empty line holding a complete JSON value is the first object of
+    an NDJSON stream (a single line file being a degenerate case, also valid JSON).
+    Otherwise the file must contain one multi-line JSON document, which is then
+    read in full.
+
+    Args:
+        file (BinaryIO): The open (binary) file, positioned at the start.
+        file_path (str): The path to the file, for error reporting.
+
+    Returns:
+        tuple: ("NDJSON" or "JSON", first object or None if the file is empty).
+        The file is left positioned just past the returned object.
+    """
+    for raw_line in file:
+        line = raw_line.strip()
+        if not line:
+            continue
+        try:
+            return "NDJSON", loads(line)
+        except JSONDecodeError:
+            pass  # Fall through to check for a multi-line JSON document
+
+        try:
+            json_obj = loads(raw_line + file.read())
+        except JSONDecodeError:
+            raise ValueError("Invalid JSON or NDJSON in file {}".format(file_path))
+        if not isinstance(json_obj, (dict, list)):  # Valid JSON must be a dictionary or a list
+            raise ValueError("Invalid JSON or NDJSON in file {}".format(file_path))
+        return "JSON", json_obj
+    return "JSON", None
 
 
 def determine_file_type(file_path: str) -> str:
     """
     Determine if a file is of type JSON or NDJSON (Newline Delimited JSON).
 
+    Only the first object (and the start of the following line) is read; a
+    single line NDJSON file is reported as JSON.
+
     Args:
         file_path (str): The path to the file.
 
@@ -12,45 +167,114 @@ def determine_file_type(file_path: str) -> str:
         str: "JSON" if the file is JSON, "NDJSON" if the file is NDJSON.
     """
     try:
-        with open(file_path, 'r') as file:
-            content = file.read().strip()  # Read entire content and strip leading/trailing whitespace
-
-        # Check for JSON by attempting to load the entire content
-        try:
-            json_obj = json.loads(content)
-            if isinstance(json_obj, (dict, list)):  # Valid JSON must be a dictionary or a list
-                return "JSON"
-        except json.JSONDecodeError:
-            pass  # Fall through to check NDJSON
-
-        # Check for NDJSON by validating line by line
-        with open(file_path, 'r') as file:
-            for line in file:
-                if line.strip():  # Ignore empty lines
-                    json.loads(line)  # Validate each line as JSON
-            return "NDJSON"
-
-    except json.JSONDecodeError:
-        raise ValueError("Invalid JSON or NDJSON in file {}".format(file_path))
+        with open_input(file_path) as file:
+            file_type, _ = _read_first_object(file, file_path)
+            if file_type == "NDJSON":
+                # Only NDJSON if another (non-empty) line follows
+                for line in file:
+                    if line.strip():
+                        return "NDJSON"
+            return "JSON"
+    except ValueError:
+        raise
     except Exception as e:
         raise IOError(f"Error reading file: {e}")
 
 
-def next_json_object(file_path: str) -> dict:
-    if determine_file_type(file_path) == "NDJSON":
-        with open(file_path, 'r') as ndjson:
-            for line in ndjson:
-                try:
-                    obj = json.loads(line.strip())
-                    yield obj
-                except AttributeError as ae:
-                    print(f"Can't parse line '{line}' from {file_path} : {ae}")
-                    raise ae
-    else:
-        with open(file_path, 'r') as json_file:
-            try:
-                obj = json.loads(json_file.read().strip())
+def next_json_object(file_path: str) -> Iterator[dict]:
+    """
+    Generator yielding each JSON object found in a JSON or NDJSON file.
+
+    The file is streamed as bytes, decompressed if need be (see
+    `open_input()`); every object is parsed exactly once (see `json_codec`)
+    and memory is bounded by the largest single object.
+
+    Raises:
+        ValueError: on invalid JSON or NDJSON content, or a truncated or
+          corrupt compressed file.
+    """
+    try:
+        yield from _json_objects(file_path)
+    except DECOMPRESSION_ERRORS as e:
+        raise ValueError(f"Truncated or corrupt compressed file {file_path}: {e}")
+
+
+def _json_objects(file_path: str) -> Iterator[dict]:
+    with open_input(file_path) as file, ParseTally() as tally:
+        start = tally.begin()
+        file_type, obj = _read_first_object(file, file_path)
+        if obj is None:
+            return
+        tally.end(start, obj, file.tell())
+        yield obj
+        if file_type == "JSON":
+            return
+
+        for line in file:
+            line = line.strip()
+            if line:
+                start = tally.begin()
+                obj = parse_json_line(line, file_path)
+                tally.end(start, obj, len(line) + 1)
                 yield obj
-            except AttributeError as ae:
-                print(f"Can't parse {file_path} : {ae}")
-                raise ae
+
+
+def parse_json_line(line: Union[str, bytes, memoryview], source: str) -> dict:
+    """
+    Parse a single line of NDJSON.
+
+    Args:
+        line (str, bytes or memoryview): The line, with or without its trailing newline.
+        source (str): The file path or URL the line came from, for error reporting.
+
+    Raises:
+        ValueError: on invalid JSON.
+    """
+    try:
+        return loads(line)
+    except JSONDecodeError:
+        raise ValueError("Invalid JSON or NDJSON in file {}".format(source))
+
+
+class ParseTally:
+    """Parse metrics of a stream of resources, added to `METRICS` in bulk
+
+    Updating the registry per resource would cost a good part of the parse
+    itself, so time, bytes and resources per type are accumulated locally,
+    and flushed every `flush_every` resources and on exit.  Time each parse
+    between `begin()` and `end()`.
+    """
+
+    def __init__(self, flush_every: int = 256):
+        self.flush_every = flush_every
+        self._reset()
+
+    def _reset(self):
+        self.seconds, self.size, self.pending = 0.0, 0, 0
+        self.types = {}
+
+    def begin(self) -> float:
+        return perf_counter()
+
+    def end(self, start: float, obj, size: int):
+        """Record a parse begun at start, of obj from size bytes"""
+        self.seconds += perf_counter() - start
+        self.size += size
+        resource_type = obj.get("resourceType") if isinstance(obj, dict) else None
+        self.types[resource_type] = self.types.get(resource_type, 0) + 1
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        METRICS.add(("stage_seconds", (("stage", "parse"),)), self.seconds)
+        METRICS.add(("parsed_bytes", ()), self.size)
+        for resource_type, count in self.types.items():
+            METRICS.add(("resources_parsed", (("type", resource_type),)), count)
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
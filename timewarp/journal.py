@@ -0,0 +1,279 @@
+"""Crash safe journal of timewarp runs
+
+Records, per resource, the hash of its source (pre shift) content, the
+offset applied and upload status, in SQLite.  When a run is interrupted,
+re-running against the export already on disk skips resources already
+uploaded; as the source on disk is never modified, anything redone is
+shifted from the original values, never twice.
+
+Progress is kept until the run completes, then deleted, leaving the
+journal's size bounded by the number of resources rather than of runs.
+
+A resource's offset, and its status once uploaded (or found unchanged),
+are committed as they're set: in WAL mode with `synchronous=NORMAL` that
+costs no sync to disk, and survives the process crashing (if not the
+machine).  Were they batched, a crash would lose the offsets of resources
+already shifted in the store, and any later run exporting afresh from
+the server (every run but a `--resume`) would shift them again.  Other
+writes are committed in batches; a crash may lose the last few pending
+or failed records, which a resumed run simply redoes.
+
+A run left incomplete, by a crash or failed uploads, is best resumed;
+starting a new run instead is consistent (each resource is shifted from
+the offset it's recorded at) but is warned about, as the resources the
+incomplete run didn't reach are then a run behind its cumulative offset
+until the new one completes.
+
+The journal also persists warp state across runs: the cumulative offset
+(total days the store has been warped) and when the last run completed,
+plus the total days each resource has been shifted.  Each run targets
+the previous cumulative offset plus NUM_DAYS, and every resource is
+shifted by the difference between that target and its own total.  This
+allows incremental runs, exporting only resources new or changed since
+the last (see `_since`), to leave the rest behind; a later full run
+brings each one current with a single shift of its accumulated delta.
+"""
+from datetime import datetime, timezone
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+from typing import Optional, Set
+
+PENDING = "pending"
+UNCHANGED = "unchanged"
+UPLOADED = "uploaded"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    completed TEXT,
+    num_days INTEGER NOT NULL,
+    source_dir TEXT,
+    cumulative_offset INTEGER NOT NULL,
+    new_resource_offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS resources (
+    run_id INTEGER NOT NULL,
+    resource_type TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    source_hash TEXT NOT NULL,
+    target_offset INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (run_id, resource_type, resource_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS offsets (
+    resource_type TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    total_days INTEGER NOT NULL,
+    PRIMARY KEY (resource_type, resource_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def source_hash(data: dict) -> str:
+    """Stable hash of resource content
+
+    Always the stdlib serialization, so hashes don't depend on the
+    `json_codec` backend in use.
+    """
+    return hashlib.blake2b(
+        json.dumps(data, sort_keys=True, separators=(',', ':')).encode(),
+        digest_size=16).hexdigest()
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class Journal:
+    """SQLite journal of the per resource progress of a timewarp run
+
+    Safe for use from multiple threads, i.e. concurrent upload workers.
+    """
+
+    def __init__(self, path: str, commit_interval: int = 1000):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.run_id: Optional[int] = None
+        self.num_days: Optional[int] = None
+        self.target_offset: Optional[int] = None
+        self.new_resource_offset: Optional[int] = None
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def _get_state(self, key: str) -> Optional[str]:
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row and row[0]
+
+    @property
+    def cumulative_offset(self) -> int:
+        """Total days the store has been warped, as of the last completed run"""
+        return int(self._get_state("cumulative_offset") or 0)
+
+    @property
+    def last_warp(self) -> Optional[str]:
+        """UTC time the last run completed, None if never"""
+        return self._get_state("last_warp")
+
+    def start_run(
+            self, num_days: int, source_dir: str = None, new_resources_from_seed=False) -> int:
+        """Start a run, advancing the cumulative offset num_days
+
+        :param new_resources_from_seed: resources without a recorded offset are
+          assumed to hold original (seed) values, and are shifted the full
+          cumulative offset; by default they're assumed current as of the last
+          run, and shifted num_days
+        """
+        last = self.db.execute(
+            "SELECT run_id, completed FROM runs ORDER BY run_id DESC LIMIT 1").fetchone()
+        if last is not None and last[1] is None:
+            print(
+                f"WARNING: run {last[0]} of journal `{self.path}` is incomplete; "
+                "starting a new run rather than resuming it, see `journal`", file=sys.stderr)
+        previous_offset = self.cumulative_offset
+        target_offset = previous_offset + num_days
+        new_resource_offset = 0 if new_resources_from_seed else previous_offset
+        with self._lock:
+            cursor = self.db.execute(
+                "INSERT INTO runs (started, num_days, source_dir, cumulative_offset, "
+                "new_resource_offset) VALUES (?, ?, ?, ?, ?)",
+                (_now(), num_days, source_dir, target_offset, new_resource_offset))
+            self.db.commit()
+        self.run_id, self.num_days = cursor.lastrowid, num_days
+        self.target_offset, self.new_resource_offset = target_offset, new_resource_offset
+        return self.run_id
+
+    def resume_run(self) -> Optional[int]:
+        """Resume the most recent incomplete run; returns its id, None if there isn't one"""
+        row = self.db.execute(
+            "SELECT run_id, num_days, completed, cumulative_offset, new_resource_offset "
+            "FROM runs ORDER BY run_id DESC LIMIT 1"
+        ).fetchone()
+        if row is None or row[2] is not None:
+            return None
+        self.run_id, self.num_days, _, self.target_offset, self.new_resource_offset = row
+        return self.run_id
+
+    def complete_run(self, record_warp: bool = True):
+        """Mark the run complete, recording the store's new cumulative offset
+
+        The per resource progress of the run, and of any before it left
+        incomplete, is then deleted; `offsets` hold all later runs need.
+
+        :param record_warp: False for a run of only some resource types (i.e.
+          a catch-up, see `service`), which leaves `last_warp`, the time
+          incremental runs export changes since, as it was
+        """
+        now = _now()
+        state = [("cumulative_offset", str(self.target_offset))]
+        if record_warp:
+            state.append(("last_warp", now))
+        with self._lock:
+            self.db.execute(
+                "UPDATE runs SET completed = ? WHERE run_id = ?", (now, self.run_id))
+            self.db.execute("DELETE FROM resources WHERE run_id <= ?", (self.run_id,))
+            self.db.executemany("INSERT OR REPLACE INTO state VALUES (?, ?)", state)
+            self.db.commit()
+            self._uncommitted = 0
+
+    def shifted_days(self, resource_type: str, resource_id: str) -> int:
+        """Total days the resource has been shifted, as of the last run it completed"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT total_days FROM offsets WHERE resource_type = ? AND resource_id = ?",
+                (resource_type, resource_id)).fetchone()
+        return row[0] if row is not None else self.new_resource_offset
+
+    def days_due(self, resource_type: str, resource_id: str) -> int:
+        """Days to shift the resource to bring it to the run's target offset"""
+        return self.target_offset - self.shifted_days(resource_type, resource_id)
+
+    def is_done(self, resource_type: str, resource_id: str, content_hash: str) -> bool:
+        """True if the resource, with the same source content, was completed this run"""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT source_hash, status FROM resources "
+                "WHERE run_id = ? AND resource_type = ? AND resource_id = ?",
+                (self.run_id, resource_type, resource_id)).fetchone()
+        return row is not None and row[0] == content_hash and row[1] in (UNCHANGED, UPLOADED)
+
+    def completed_references(self) -> Set[str]:
+        """`type/id` references of the resources completed this run, see `is_done()`"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT resource_type, resource_id FROM resources "
+                "WHERE run_id = ? AND status IN (?, ?)",
+                (self.run_id, UNCHANGED, UPLOADED)).fetchall()
+        return {f"{resource_type}/{resource_id}" for resource_type, resource_id in rows}
+
+    def record(self, resource_type: str, resource_id: str, content_hash: str, status: str):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run_id, resource_type, resource_id, content_hash, self.target_offset,
+                 status))
+            if status == UNCHANGED:
+                self._set_offset(resource_type, resource_id)
+            else:
+                self._wrote()
+
+    def _set_offset(self, resource_type: str, resource_id: str):
+        """Record the resource at the run's target offset; committed at once, see module doc"""
+        self.db.execute(
+            "INSERT INTO offsets VALUES (?, ?, ?) ON CONFLICT (resource_type, resource_id) "
+            "DO UPDATE SET total_days = excluded.total_days",
+            (resource_type, resource_id, self.target_offset))
+        self.db.commit()
+        self._uncommitted = 0
+
+    def set_status(self, reference: str, status: str):
+        """Update status of a previously recorded resource, given `type/id` reference"""
+        resource_type, _, resource_id = reference.partition('/')
+        with self._lock:
+            self.db.execute(
+                "UPDATE resources SET status = ? "
+                "WHERE run_id = ? AND resource_type = ? AND resource_id = ?",
+                (status, self.run_id, resource_type, resource_id))
+            if status == UPLOADED:
+                self._set_offset(resource_type, resource_id)
+            else:
+                self._wrote()
+
+    def uploaded(self, reference: str):
+        """Upload listener callback, see `upload.Uploader`"""
+        self.set_status(reference, UPLOADED)
+
+    def failed(self, reference: str):
+        """Upload listener callback, see `upload.Uploader`"""
+        self.set_status(reference, FAILED)
+
+    def counts(self) -> dict:
+        """Number of resources by status, for the current run, until complete"""
+        with self._lock:
+            return dict(self.db.execute(
+                "SELECT status, COUNT(*) FROM resources WHERE run_id = ? GROUP BY status",
+                (self.run_id,)).fetchall())
+
+    def _wrote(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_interval:
+            self.db.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,51 @@
+"""JSON codec, using a fast backend when available
+
+Parsing and serializing resources is a large part of a timewarp run.
+orjson is used when installed, the stdlib `json` module otherwise; see
+`BACKEND`.  Results are semantically identical either way: `loads()`
+accepts str or (UTF-8) bytes, bytearray or memoryview, and `dumps()`
+returns compact UTF-8 bytes, ready to send as a request body.
+
+The one exception is integers beyond 64 bits, which orjson parses as
+(lossy) floats rather than fail; scanning every document for them would
+cost more than the parse.  FHIR integer types, `integer64` included, are
+within 64 bits.  `dumps()` falls back to the stdlib for such integers.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # optional, see module docstring
+    orjson = None
+
+# Name of the active backend, `orjson` or `json`
+BACKEND = "orjson" if orjson is not None else "json"
+
+# Raised by `loads()` on invalid JSON; a ValueError
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """Parse a JSON document; raises `JSONDecodeError` if invalid
+
+    Integers beyond 64 bits are parsed as floats by orjson, see module docstring.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # unsupported by orjson, or invalid; the stdlib decides
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize obj as compact UTF-8 JSON"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # unsupported by orjson, i.e. integers beyond 64 bits
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
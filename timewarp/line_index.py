@@ -0,0 +1,341 @@
+"""Line index of NDJSON files, for random access without re-reading them
+
+A `LineIndex` holds the offset of each line of an NDJSON file, the
+`resourceType/id` reference of the resource on it, and a hash table of
+those references.  The file is mapped into memory: any resource is reached
+by position or reference in O(1), and lines are zero-copy slices of the
+mapping, parsed only when read.  A
+subset of the resources (i.e. those of a shard, see `shard`) can so be
+read without parsing the rest.
+
+Building an index parses the whole file once.  It's saved next to the
+file (see `index_path()`) with the file's size and mtime, and is stale,
+to be built again, once either changes.  A saved index is itself mapped,
+not read: loading one costs the same for any size of file.  Only plain
+NDJSON files are indexed; compressed files can't be mapped.
+
+Saved format: `MAGIC`, a JSON header line padded to a multiple of 8
+bytes, the offsets of each line and of the end of the file, the end
+offset of each reference in the references blob, the slots of the hash
+table (all as little-endian, unsigned 64 bit integers), then the blob of
+UTF-8 references.  The table is open addressed, probed linearly from the
+CRC-32 of a reference; a slot holds one plus the position of the (first)
+line with the reference, 0 if empty.
+
+    python line_index.py /tmp/warp/*.ndjson
+"""
+import argparse
+from array import array
+from bisect import bisect_left
+import json
+import mmap
+import os
+import sys
+from typing import Callable, Dict, Iterable, Iterator, Optional, Union
+import zlib
+
+from input_util import (
+    ParseTally,
+    compression_of,
+    determine_file_type,
+    next_json_object,
+    parse_json_line,
+)
+
+MAGIC = b"TIMEWARP LINE INDEX\n"
+VERSION = 2
+INDEX_SUFFIX = ".idx"
+
+_ALIGNMENT = 8
+
+
+def index_path(file_path: str) -> str:
+    """Path of the saved index of file_path"""
+    return f"{file_path}{INDEX_SUFFIX}"
+
+
+def indexable(file_path: str) -> bool:
+    """True if file_path is a plain (uncompressed) NDJSON file"""
+    return compression_of(file_path) is None and determine_file_type(file_path) == "NDJSON"
+
+
+def _signature(file_path: str) -> Dict[str, int]:
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _hash_slots(references: bytes, reference_ends: array) -> array:
+    """Hash table of the references, at most half full; see module docstring"""
+    slots = 1
+    while slots < 2 * len(reference_ends):
+        slots *= 2
+    table, mask, start = array("Q", bytes(8 * slots)), slots - 1, 0
+    seen = set()
+    for position, end in enumerate(reference_ends):
+        reference, start = bytes(references[start:end]), end
+        if reference in seen:
+            continue
+        seen.add(reference)
+        slot = zlib.crc32(reference) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = position + 1
+    return table
+
+
+def _integers(buffer: memoryview) -> Union[memoryview, array]:
+    """Buffer of little-endian uint64 values as a sequence of ints, zero-copy where native"""
+    if sys.byteorder == "little":
+        return buffer.cast("Q")
+    values = array("Q", buffer.tobytes())
+    values.byteswap()
+    return values
+
+
+class LineIndex:
+    """Offsets and references of the lines of an NDJSON file; see module docstring
+
+    Use `open()` to load the saved index, or build (and save) it if missing
+    or stale; close when done, or use as a context manager.
+    """
+
+    def __init__(self, file_path: str, buffer, index_file=None):
+        """Index of file_path, from the content of its saved index
+
+        :param buffer: bytes-like content of the index, i.e. a mapping of
+          the saved index file
+        :param index_file: the file buffer maps, closed with the index
+        :raises ValueError: if buffer isn't an index
+        """
+        self.file_path = file_path
+        self._buffer = buffer
+        self._index_file = index_file
+        self._data_file = self._data = None
+
+        view = memoryview(buffer)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"not a line index: {index_path(file_path)}")
+        header_end = bytes(view[:4096]).find(b"\n", len(MAGIC)) + 1
+        header = json.loads(bytes(view[len(MAGIC):header_end]))
+        if header.get("version") != VERSION:
+            raise ValueError(f"unsupported line index version: {header.get('version')}")
+        self.size, self.mtime_ns, lines = header["size"], header["mtime_ns"], header["lines"]
+        offsets_end = header_end + 8 * (lines + 1)
+        reference_ends_end = offsets_end + 8 * lines
+        slots_end = reference_ends_end + 8 * header["slots"]
+        self._offsets = _integers(view[header_end:offsets_end])
+        self._reference_ends = _integers(view[offsets_end:reference_ends_end])
+        self._slots = _integers(view[reference_ends_end:slots_end])
+        self._references = view[slots_end:]
+
+    @classmethod
+    def build(cls, file_path: str, save: bool = True) -> 'LineIndex':
+        """Index file_path, parsing every line; saved next to it unless save is False
+
+        Failing to save (i.e. to a read only directory) isn't an error; the
+        index is then only held in memory.
+
+        :raises ValueError: on invalid JSON, or if file_path isn't plain NDJSON
+        """
+        if not indexable(file_path):
+            raise ValueError(f"only plain NDJSON files can be indexed: {file_path}")
+        signature = _signature(file_path)
+        offsets, reference_ends = array("Q"), array("Q")
+        references = bytearray()
+        with open(file_path, "rb") as data_file:
+            position = 0
+            for line in data_file:
+                if line.strip():
+                    data = parse_json_line(line, file_path)
+                    if isinstance(data, dict):
+                        references += f"{data.get('resourceType')}/{data.get('id')}".encode()
+                    offsets.append(position)
+                    reference_ends.append(len(references))
+                position += len(line)
+        offsets.append(position)
+        slots = _hash_slots(references, reference_ends)
+        header = json.dumps(dict(
+            version=VERSION, lines=len(reference_ends), slots=len(slots),
+            **signature)).encode()
+        if sys.byteorder != "little":
+            for values in offsets, reference_ends, slots:
+                values.byteswap()
+
+        padding = -(len(MAGIC) + len(header) + 1) % _ALIGNMENT
+        content = b"".join((
+            MAGIC, header, b" " * padding, b"\n",
+            offsets.tobytes(), reference_ends.tobytes(), slots.tobytes(), references))
+        if save:
+            partial = f"{index_path(file_path)}.{os.getpid()}.tmp"
+            try:
+                with open(partial, "wb") as index_file:
+                    index_file.write(content)
+                os.replace(partial, index_path(file_path))
+            except OSError as e:
+                print(f"unable to save line index of {file_path}: {e}", file=sys.stderr)
+        return cls(file_path, content)
+
+    @classmethod
+    def load(cls, file_path: str) -> Optional['LineIndex']:
+        """The saved index of file_path; None if missing, stale or unreadable"""
+        try:
+            signature = _signature(file_path)
+            index_file = open(index_path(file_path), "rb")
+        except OSError:
+            return None
+        try:
+            buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            index = cls(file_path, buffer, index_file)
+        except (OSError, ValueError, KeyError):
+            index_file.close()
+            return None
+        if (index.size, index.mtime_ns) != (signature["size"], signature["mtime_ns"]):
+            index.close()
+            return None
+        return index
+
+    @classmethod
+    def open(cls, file_path: str, save: bool = True) -> 'LineIndex':
+        """The saved index of file_path, else a newly built one, see `build()`"""
+        index = cls.load(file_path)
+        return index if index is not None else cls.build(file_path, save=save)
+
+    def is_current(self) -> bool:
+        """False if the file has changed since it was indexed"""
+        try:
+            signature = _signature(self.file_path)
+        except OSError:
+            return False
+        return (self.size, self.mtime_ns) == (signature["size"], signature["mtime_ns"])
+
+    def __len__(self) -> int:
+        return len(self._reference_ends)
+
+    def offset(self, position: int) -> int:
+        """Byte offset of the line at position; that of the end of the file for `len()`"""
+        return self._offsets[position]
+
+    def positions_between(self, start: int, end: Optional[int] = None) -> range:
+        """Positions of the lines starting within byte range [start, end)"""
+        lines = len(self)
+        first = bisect_left(self._offsets, start, 0, lines)
+        last = lines if end is None else bisect_left(self._offsets, end, first, lines)
+        return range(first, last)
+
+    def _reference_bytes(self, position: int) -> memoryview:
+        start = self._reference_ends[position - 1] if position else 0
+        return self._references[start:self._reference_ends[position]]
+
+    def reference(self, position: int) -> str:
+        """`resourceType/id` of the resource at position"""
+        return bytes(self._reference_bytes(position)).decode()
+
+    def position(self, reference: str) -> Optional[int]:
+        """Position of the (first) resource with the given reference, None if not found"""
+        mask = len(self._slots) - 1
+        key = reference.encode()
+        slot = zlib.crc32(key) & mask
+        while self._slots[slot]:
+            position = self._slots[slot] - 1
+            if self._reference_bytes(position) == key:
+                return position
+            slot = (slot + 1) & mask
+        return None
+
+    def line(self, position: int) -> memoryview:
+        """The line at position, a zero-copy slice of the mapped file
+
+        Includes the trailing newline, and any blank lines following it.
+        """
+        if self._data is None:
+            self._data_file = open(self.file_path, "rb")
+            self._data = memoryview(
+                mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._data[self._offsets[position]:self._offsets[position + 1]]
+
+    def resource(self, position: int) -> dict:
+        """Parse the resource at position"""
+        return parse_json_line(self.line(position), self.file_path)
+
+    def get(self, reference: str) -> Optional[dict]:
+        """Parse the resource with the given reference, None if not found"""
+        position = self.position(reference)
+        return self.resource(position) if position is not None else None
+
+    def resources(
+            self, positions: Iterable[int] = None,
+            owns: Callable[[str], bool] = None) -> Iterator[dict]:
+        """Parse the resources at positions, defaults to all, in order
+
+        :param owns: predicate of references; resources it rejects are
+          skipped, without being parsed
+        """
+        with ParseTally() as tally:
+            for position in range(len(self)) if positions is None else positions:
+                if owns is not None and not owns(self.reference(position)):
+                    continue
+                line = self.line(position)
+                start = tally.begin()
+                obj = parse_json_line(line, self.file_path)
+                tally.end(start, obj, len(line))
+                yield obj
+
+    def close(self):
+        views = (self._offsets, self._reference_ends, self._slots, self._references)
+        for view in views:
+            if isinstance(view, memoryview):
+                view.release()
+        if self._data is not None:
+            mapping = self._data.obj
+            self._data.release()
+            mapping.close()
+            self._data_file.close()
+            self._data = None
+        if self._index_file is not None:
+            self._buffer.close()
+            self._index_file.close()
+            self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_resources(file_path: str, owns: Callable[[str], bool] = None) -> Iterator[dict]:
+    """Resources of a JSON or NDJSON file, as `input_util.next_json_object()`
+
+    Given owns, a predicate of references, and a current saved index of the
+    file, resources it rejects are skipped without being parsed.  Without
+    an index they're all yielded; callers still filter by owns.
+    """
+    index = LineIndex.load(file_path) if owns is not None else None
+    if index is None:
+        yield from next_json_object(file_path)
+        return
+    with index:
+        yield from index.resources(owns=owns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the line indexes of NDJSON files")
+    parser.add_argument(
+        "files", nargs="+", help="NDJSON files to index; indexes are saved next to them")
+    parser.add_argument("--force", action="store_true", help="Rebuild indexes even if current")
+
+    args = parser.parse_args()
+    for file_path in args.files:
+        if not indexable(file_path):
+            print(f"skipped {file_path}: not plain NDJSON", file=sys.stderr)
+            continue
+        index = None if args.force else LineIndex.load(file_path)
+        status = "current"
+        if index is None:
+            index, status = LineIndex.build(file_path), "built"
+        with index:
+            print(f"{file_path}: {len(index)} line(s), {status}")
+
+
+if __name__ == "__main__":
+    main()
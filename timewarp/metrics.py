@@ -0,0 +1,267 @@
+"""Instrumentation of timewarp runs: stage timers, counters and histograms
+
+The pipeline records into the process wide `METRICS` registry:
+
+  stage_seconds{stage}         wall time spent in each stage: `export`
+                               (kickoff and status polling), `download`,
+                               `parse`, `timeshift` and `upload`; summed over
+                               threads, and stages may overlap
+  downloaded_bytes             export output bytes downloaded
+  parsed_bytes                 NDJSON bytes parsed
+  resources_parsed{type}       resources parsed, per type
+  resources_shifted{type}      resources changed by the timeshift, per type
+  resources_unchanged{type}    resources left unchanged, per type
+  resources_unplanned{type}    resources a timeshift plan found no dates in,
+                               walked in full, per type
+  resources_uploaded           resources uploaded
+  resources_failed             resources that failed to upload
+  upload_request_seconds{method}  histogram of upload request latency, per
+                               attempt, retries included
+  upload_responses{method,status}  upload responses by status code, or
+                               `error` for connection errors
+
+Results are available as a JSON summary (`save_json()`) or a Prometheus
+textfile (`save_textfile()`, for the node_exporter textfile collector).
+The run can also be profiled with cProfile, once from start to end (see
+`start_profile()`); enabling a profiler per stage or item would cost
+more than many items, and the profile's call graph breaks down stages.
+
+`progress()` prints a one line summary of the counts, at most once per
+`progress_interval` seconds, and is cheap to call per resource.
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Upper bounds, in seconds, of the upload latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_PREFIX = "timewarp_"
+
+DESCRIPTIONS = {
+    "stage_seconds": "Wall time spent in each stage, summed over threads",
+    "downloaded_bytes": "Export output bytes downloaded",
+    "parsed_bytes": "NDJSON bytes parsed",
+    "resources_parsed": "Resources parsed",
+    "resources_shifted": "Resources changed by the timeshift",
+    "resources_unchanged": "Resources left unchanged by the timeshift",
+    "resources_unplanned": "Resources a timeshift plan found no dates in, walked in full",
+    "resources_uploaded": "Resources uploaded",
+    "resources_failed": "Resources that failed to upload",
+    "upload_request_seconds": "Upload request latency, per attempt",
+    "upload_responses": "Upload responses by status code",
+}
+
+# (name, ((label, value), ...))
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _number(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Stage:
+    """Times one pass through a stage, see `Metrics.stage()`"""
+    __slots__ = ("metrics", "key", "start")
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.key = ("stage_seconds", (("stage", name),))
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add(self.key, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """Thread safe registry of counters and histograms"""
+
+    def __init__(self, progress_interval: float = 10.0):
+        self.progress_interval = progress_interval
+        self.profile: Optional[cProfile.Profile] = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all metrics, i.e. at the start of a run"""
+        with self._lock:
+            self.counters: Dict[_Key, float] = {}
+            # bucket counts (the last for +Inf), then the sum of observations
+            self.histograms: Dict[_Key, list] = {}
+            self.started = time.monotonic()
+            self._next_progress = self.started + self.progress_interval
+
+    def count(self, name: str, amount: float = 1, **labels: str):
+        self.add((name, tuple(labels.items())), amount)
+
+    def add(self, key: _Key, amount: float = 1):
+        """As `count()`, given the (name, labels) key; cheaper on hot paths"""
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str):
+        """Record value in the (LATENCY_BUCKETS) histogram name"""
+        key = (name, tuple(labels.items()))
+        bucket = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                bucket = index
+                break
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += value
+
+    def stage(self, name: str) -> _Stage:
+        """Context manager adding its wall time to `stage_seconds{stage=name}`
+
+        Costs about a microsecond; per item hot paths (i.e. parsing) should
+        instead accumulate locally, and `add()` in bulk.
+        """
+        return _Stage(self, name)
+
+    def start_profile(self):
+        """Profile the run with cProfile until `stop_profile()`, see `save_profile()`
+
+        Only the calling thread is profiled; that's the main thread of a run,
+        parsing and shifting, but not those of downloads or concurrent uploads.
+        """
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop_profile(self):
+        if self.profile is not None:
+            self.profile.disable()
+
+    def total(self, name: str) -> float:
+        """Sum of the counter name, over all its labels"""
+        with self._lock:
+            return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def drain(self) -> dict:
+        """Snapshot of the counters and histograms, clearing them; see `merge()`"""
+        with self._lock:
+            snapshot = {"counters": self.counters, "histograms": self.histograms}
+            self.counters, self.histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """Add the counters and histograms of another registry's `drain()`"""
+        with self._lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(key, [0] * len(values))
+                for index, value in enumerate(values):
+                    histogram[index] += value
+
+    def progress(self, force: bool = False):
+        """Print a summary line of progress, if progress_interval has passed since the last"""
+        now = time.monotonic()
+        if not force and now < self._next_progress:
+            return
+        self._next_progress = now + self.progress_interval
+        elapsed = max(now - self.started, 1e-9)
+        parsed = self.total("resources_parsed")
+        print(
+            f"progress: {parsed:.0f} parsed, {self.total('resources_shifted'):.0f} shifted, "
+            f"{self.total('resources_unchanged'):.0f} unchanged, "
+            f"{self.total('resources_uploaded'):.0f} uploaded, "
+            f"{self.total('resources_failed'):.0f} failed; "
+            f"{parsed / elapsed:.0f} resources/s over {elapsed:.0f}s", flush=True)
+
+    def to_dict(self) -> dict:
+        """JSON summary; labels are rendered `name=value,...`, the empty string if none"""
+        def label_string(labels):
+            return ",".join(f"{name}={value}" for name, value in labels)
+
+        with self._lock:
+            summary = {"elapsed_seconds": round(time.monotonic() - self.started, 3)}
+            counters: Dict[str, dict] = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, {})[label_string(labels)] = (
+                    round(value, 6) if isinstance(value, float) else value)
+            histograms: Dict[str, dict] = {}
+            for (name, labels), values in sorted(self.histograms.items()):
+                buckets = dict(zip(map(str, LATENCY_BUCKETS + ("+Inf",)), values[:-1]))
+                count = sum(values[:-1])
+                histograms.setdefault(name, {})[label_string(labels)] = {
+                    "count": count,
+                    "sum": round(values[-1], 6),
+                    "mean": round(values[-1] / count, 6) if count else None,
+                    "buckets": buckets,
+                }
+        summary["stages"] = counters.pop("stage_seconds", {})
+        summary["counters"] = counters
+        summary["histograms"] = histograms
+        return summary
+
+    def to_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        def render(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ""
+            return "{%s}" % ",".join(
+                f'{name}="{_escape(value)}"' for name, value in labels)
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        described = set()
+        for (name, labels), value in counters:
+            metric = f"{PROMETHEUS_PREFIX}{name}_total"
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {metric} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{render(labels)} {_number(value)}")
+        for (name, labels), values in histograms:
+            metric = f"{PROMETHEUS_PREFIX}{name}"
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {metric} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), values[:-1]):
+                cumulative += bucket_count
+                bound = bound if isinstance(bound, str) else f"{bound:g}"
+                lines.append(f"{metric}_bucket{render(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{metric}_sum{render(labels)} {_number(values[-1])}")
+            lines.append(f"{metric}_count{render(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def save_json(self, file_path: str):
+        with open(file_path, 'w') as summary_file:
+            json.dump(self.to_dict(), summary_file, indent=2)
+
+    def save_textfile(self, file_path: str):
+        """Write the Prometheus textfile atomically, as the textfile collector requires"""
+        partial = f"{file_path}.tmp"
+        with open(partial, 'w') as textfile:
+            textfile.write(self.to_prometheus())
+        os.replace(partial, file_path)
+
+    def save_profile(self, directory: str):
+        """Save the run's cProfile stats, see `start_profile()`, to `run.prof` in directory"""
+        os.makedirs(directory, exist_ok=True)
+        self.profile.dump_stats(os.path.join(directory, "run.prof"))
+
+
+# Registry of this process; see module docstring
+METRICS = Metrics()
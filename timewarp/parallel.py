@@ -0,0 +1,212 @@
+"""Multi-core timeshift over a process pool
+
+Work is split into units: a whole file, or for large NDJSON files, byte
+ranges aligned to line boundaries.  Each worker parses and shifts the
+resources of a unit and returns only those changed, already serialized,
+to the parent for upload.  Units depend only on the files and the chunk
+size, and results are returned in unit order, so output is identical for
+any number of workers.
+
+Workers of a sharded run read units through the saved line index of a
+file, where current (see `line_index`), parsing only their shard's
+resources.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import os
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from fhir_resource import FHIR_Resource, ShiftTally
+from input_util import (
+    ParseTally,
+    compression_of,
+    determine_file_type,
+    next_json_object,
+    parse_json_line,
+)
+from json_codec import dumps
+from line_index import LineIndex
+from metrics import METRICS
+from shard import Shard, ShardSummary, reference_hash
+from timeshift import ShiftCache
+from timeshift_plan import TimeshiftPlan
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class WorkUnit(NamedTuple):
+    """A file, or the lines of an NDJSON file within byte range [start, end)"""
+    file_path: str
+    start: int = 0
+    end: Optional[int] = None
+
+
+def split_work(file_paths: List[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[WorkUnit]:
+    """Split files into work units of roughly chunk_size bytes, aligned to lines
+
+    Compressed files can't be split, and are one unit each.  Line
+    boundaries are looked up in the saved line index of a file, where
+    current (see `line_index`), rather than read from the file.
+    """
+    units = []
+    for file_path in file_paths:
+        size = os.path.getsize(file_path)
+        if size <= chunk_size:
+            units.append(WorkUnit(file_path))
+            continue
+        index = LineIndex.load(file_path)
+        if index is not None:
+            with index:
+                start = 0
+                while start < size:
+                    # the first line starting past start + chunk_size, as readline() below
+                    end = index.offset(index.positions_between(start + chunk_size + 1).start)
+                    units.append(WorkUnit(file_path, start, end))
+                    start = end
+            continue
+        if compression_of(file_path) is not None or determine_file_type(file_path) != "NDJSON":
+            units.append(WorkUnit(file_path))
+            continue
+
+        with open(file_path, "rb") as f:
+            start = 0
+            while start < size:
+                f.seek(start + chunk_size)
+                f.readline()  # advance to the start of the next line
+                end = min(f.tell(), size)
+                units.append(WorkUnit(file_path, start, end))
+                start = end
+    return units
+
+
+def read_unit(unit: WorkUnit, owns: Callable[[str], bool] = None) -> Iterator[dict]:
+    """Generator yielding each JSON object within the work unit
+
+    :param owns: predicate of `resourceType/id` references; given a current
+      line index of the file, resources it rejects are skipped unparsed
+    """
+    if owns is not None:
+        index = _line_index(unit.file_path)
+        if index is not None:
+            yield from index.resources(
+                index.positions_between(unit.start, unit.end), owns=owns)
+            return
+
+    if unit.end is None:
+        yield from next_json_object(unit.file_path)
+        return
+
+    with open(unit.file_path, "rb") as f, ParseTally() as tally:
+        f.seek(unit.start)
+        position = unit.start
+        while position < unit.end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            line = line.strip()
+            if line:
+                start = tally.begin()
+                obj = parse_json_line(line, unit.file_path)
+                tally.end(start, obj, len(line) + 1)
+                yield obj
+
+
+# per worker process state, see `_init_worker()`
+_worker_plan: Optional[TimeshiftPlan] = None
+_worker_cache: Optional[ShiftCache] = None
+# line indexes of the files of units read, kept for the worker's later units
+_worker_indexes: Dict[str, LineIndex] = {}
+
+
+def _line_index(file_path: str) -> Optional[LineIndex]:
+    """The current saved line index of file_path, None if there's none"""
+    index = _worker_indexes.get(file_path)
+    if index is not None and index.is_current():
+        return index
+    if index is not None:
+        index.close()
+        del _worker_indexes[file_path]
+    index = LineIndex.load(file_path)
+    if index is not None:
+        _worker_indexes[file_path] = index
+    return index
+
+
+def _init_worker(plan_dict: Optional[dict], cache_size: int):
+    global _worker_plan, _worker_cache
+    _worker_plan = TimeshiftPlan.from_dict(plan_dict) if plan_dict is not None else None
+    _worker_cache = ShiftCache(maxsize=cache_size) if cache_size > 0 else None
+    METRICS.reset()  # a forked worker starts with a copy of the parent's
+
+
+def shift_unit(
+        unit: WorkUnit, num_days: int, batch_size: int = 0,
+        shard: Shard = None) -> Tuple[List[Tuple[str, bytes]], Tuple[int, int, int], dict]:
+    """Timeshift resources of the unit, in a worker process
+
+    :param batch_size: when set, timeshift with the batch engine, this many
+      resources at a time
+    :param shard: only process resources of the given shard
+    :returns: (reference, JSON body) of those changed, and for a shard, the
+      number of resources processed, changed and their fingerprint, see
+      `ShardSummary.merge()`, and the worker's metrics of the unit, see
+      `Metrics.drain()`
+    """
+    changed, processed, fingerprint = [], 0, 0
+    resources = (
+        FHIR_Resource.parse_fhir(data)
+        for data in read_unit(unit, shard.owns if shard is not None else None))
+    if shard is not None:
+        resources = (
+            fhir_data for fhir_data in resources
+            if shard.owns(f"{fhir_data.resource_type}/{fhir_data.data['id']}"))
+    with ShiftTally() as tally:
+        while batch := list(islice(resources, batch_size or 1)):
+            if batch_size:
+                changes = FHIR_Resource.timeshift_batch(
+                    batch, num_days, plan=_worker_plan, tally=tally)
+            else:
+                changes = [batch[0].timeshift(
+                    num_days=num_days, plan=_worker_plan, cache=_worker_cache, tally=tally)]
+            for fhir_data, is_changed in zip(batch, changes):
+                reference = f"{fhir_data.resource_type}/{fhir_data.data['id']}"
+                if shard is not None:
+                    processed += 1
+                    fingerprint += reference_hash(reference)
+                if is_changed:
+                    changed.append((reference, dumps(fhir_data.data)))
+    return changed, (processed, len(changed), fingerprint), METRICS.drain()
+
+
+def parallel_timeshift(
+        file_paths: List[str], num_days: int, workers: int, plan: TimeshiftPlan = None,
+        cache_size: int = 100000, chunk_size: int = DEFAULT_CHUNK_SIZE,
+        batch_size: int = 0, shard: ShardSummary = None) -> Iterator[Tuple[str, bytes]]:
+    """Timeshift the resources of the given files over a pool of worker processes
+
+    At most twice `workers` units are in flight, bounding the results held
+    while the caller (i.e. uploads) catches up.
+
+    :param batch_size: when set, timeshift with the batch engine, see `shift_unit()`
+    :param shard: only process resources of the summary's shard, accounting for them
+    :returns: generator of (reference, JSON body) for every changed resource,
+      in file and line order
+    """
+    units = deque(split_work(file_paths, chunk_size=chunk_size))
+    plan_dict = plan.to_dict() if plan is not None else None
+    with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(plan_dict, cache_size)) as executor:
+        in_flight = deque()
+        while units or in_flight:
+            while units and len(in_flight) < workers * 2:
+                in_flight.append(executor.submit(
+                    shift_unit, units.popleft(), num_days, batch_size,
+                    shard.shard if shard is not None else None))
+            changed, tally, metrics = in_flight.popleft().result()
+            METRICS.merge(metrics)
+            if shard is not None:
+                shard.merge(*tally)
+            yield from changed
@@ -0,0 +1,434 @@
+"""Resident timewarp service: scheduled and on demand warps of several stores
+
+A run of `api.py` in a fresh process (i.e. a nightly cron job) pays each
+time for start up and imports, for connection setup to the store, and for
+a cold shift cache and plan.  The service stays resident instead, and per
+store keeps warm across its warps:
+
+  sessions pooling keep-alive connections, for export downloads and uploads
+  the shift cache (see `timeshift.ShiftCache`), whose entries are valid
+  for any later run
+  the timeshift plan (see `timeshift_plan`), loaded once or learned from
+  each export's sample, only growing
+
+Every warp is a run of the store's journal (see `journal`), so each
+resource is shifted to the store's cumulative offset; one interrupted or
+failed part way is brought current by the next.  A warp of only some
+resource types is a catch-up: a run bringing each resource of those types
+to the cumulative offset (i.e. those whose uploads failed) without
+advancing it, which would leave the other types behind.
+
+Warps run one at a time, in the order queued, on a worker thread.  They're
+queued on each store's schedule, and on demand through a local HTTP
+control endpoint:
+
+  GET  /status             the current warp, with its live metrics, queued
+                           warps, recent warps and next scheduled warps
+  GET  /stores             configured stores and their schedules
+  GET  /metrics            metrics of the current or last warp, in the
+                           Prometheus text format
+  POST /warp?store=NAME     queue a warp of the store; 202 with the queued
+                           warp, 404 if there's no such store
+  POST /warp?store=NAME&type=TYPE[,TYPE]
+                           queue a catch-up of the store's resources of
+                           the given types, see above
+
+Stores are configured in a JSON file, i.e.
+
+    {"stores": [
+        {"name": "demo", "fhir_base_url": "http://fhir-internal:8080/fhir", "at": "02:30"},
+        {"name": "test", "fhir_base_url": "http://fhir-test:8080/fhir", "every": 21600,
+         "concurrency": 8, "bundle_size": 100}]}
+
+each with a `name` and `fhir_base_url`, and optionally the `Store.OPTIONS`:
+`at` a daily local time (HH:MM) or `every` N seconds to warp on a
+schedule (neither: on demand only), `journal` the store's journal file,
+defaulting to `<input_dir>.sqlite` (keep it on persistent storage; it holds
+the offsets of the store's resources), and options as those of `api.py`.
+
+    python timewarp/service.py stores.json --port 8090
+    curl -X POST 'http://127.0.0.1:8090/warp?store=demo'
+"""
+import argparse
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+import json
+import os
+import queue
+import tempfile
+import threading
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from api import compile_plan, move_24_ahead
+from fhir_server_export import download_session, run_export
+from input_util import compression_available
+from journal import Journal
+from metrics import METRICS
+from timeshift import ShiftCache
+from timeshift_plan import TimeshiftPlan
+from upload import BundleUploader, ConcurrentUploader, PatchUploader, PutUploader, make_session
+
+# Warps kept for `/status`, most recent last
+HISTORY = 20
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def parse_time_of_day(value: str) -> Tuple[int, int]:
+    """(hour, minute) of `HH:MM`; raises ValueError if invalid"""
+    hour, _, minute = value.partition(":")
+    hour, minute = int(hour), int(minute)
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"invalid time of day {value}; expected HH:MM")
+    return hour, minute
+
+
+class Store:
+    """A configured FHIR store, and the state kept warm across its warps"""
+
+    # Options of a store, and their defaults; see `api.py` usage for most
+    OPTIONS = {
+        "num_days": 1,
+        "at": None,
+        "every": None,
+        "input_dir": None,
+        "journal": None,
+        "export_types": None,
+        "compress": None,
+        "keep_export": False,
+        "cache_size": 100000,
+        "plan": None,
+        "plan_sample": 0,
+        "concurrency": 1,
+        "bundle_size": 0,
+        "bundle_type": "batch",
+        "patch": False,
+    }
+
+    def __init__(self, name: str, fhir_base_url: str, **options):
+        """:raises ValueError: given unknown or invalid options"""
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise ValueError(f"store {name}: unknown option(s) {', '.join(sorted(unknown))}")
+        self.name = name
+        self.fhir_base_url = fhir_base_url if fhir_base_url.endswith('/') else fhir_base_url + '/'
+        self.options = {**self.OPTIONS, **options}
+        self.at = parse_time_of_day(self.options["at"]) if self.options["at"] else None
+        if self.at and self.options["every"]:
+            raise ValueError(f"store {name}: `at` and `every` are exclusive")
+        if not compression_available(self.options["compress"]):
+            raise ValueError(f"store {name}: zstd compression requires the zstandard package")
+        if self.options["patch"] and self.options["bundle_size"] > 0:
+            raise ValueError(f"store {name}: `patch` is not supported with `bundle_size`")
+        self.input_dir = self.options["input_dir"] or os.path.join(
+            tempfile.gettempdir(), f"timewarp-{name}")
+        self.journal_path = self.options["journal"] or f"{self.input_dir.rstrip(os.sep)}.sqlite"
+
+        # warm state, see module docstring
+        concurrency = max(self.options["concurrency"], 1)
+        self.session = make_session(pool_size=concurrency)
+        self.download_session = download_session()
+        cache_size = self.options["cache_size"]
+        self.cache = ShiftCache(maxsize=cache_size) if cache_size > 0 else None
+        self.plan = TimeshiftPlan.load(self.options["plan"]) if self.options["plan"] else None
+
+    def next_run(self, after: datetime) -> Optional[datetime]:
+        """Time of the first scheduled warp after the given (local) time; None if unscheduled"""
+        if self.options["every"]:
+            return after + timedelta(seconds=self.options["every"])
+        if self.at is None:
+            return None
+        hour, minute = self.at
+        scheduled = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        return scheduled if scheduled > after else scheduled + timedelta(days=1)
+
+    def describe(self) -> dict:
+        return {"name": self.name, "fhir_base_url": self.fhir_base_url, **self.options}
+
+    def make_uploader(self, journal: Journal = None):
+        options = self.options
+        if options["bundle_size"] > 0:
+            uploader = BundleUploader(
+                self.fhir_base_url, bundle_size=options["bundle_size"],
+                bundle_type=options["bundle_type"], session=self.session, listener=journal)
+        elif options["patch"]:
+            uploader = PatchUploader(self.fhir_base_url, session=self.session, listener=journal)
+        else:
+            uploader = PutUploader(self.fhir_base_url, session=self.session, listener=journal)
+        if options["concurrency"] > 1:
+            uploader = ConcurrentUploader(uploader, concurrency=options["concurrency"])
+        return uploader
+
+    def warp(self, types: List[str] = None) -> List[dict]:
+        """Export the store's resources, shift them and upload those changed
+
+        A run of the store's journal, completed unless uploads fail; each
+        resource is shifted the days it lags the cumulative offset.
+
+        :param types: export only resources of these types, in a catch-up run
+          that doesn't advance the cumulative offset, see module docstring
+        :returns: list of failed uploads, see `upload` module
+        """
+        options = self.options
+        num_days = 0 if types else options["num_days"]
+        os.makedirs(self.input_dir, exist_ok=True)
+        journal = Journal(self.journal_path)
+        try:
+            journal.start_run(num_days, source_dir=self.input_dir)
+            file_paths = run_export(
+                base_url=self.fhir_base_url, directory=self.input_dir,
+                type=",".join(types) if types else options["export_types"],
+                compression=options["compress"], session=self.download_session)
+            try:
+                if options["plan_sample"]:
+                    self.plan = compile_plan(
+                        self.input_dir, options["plan_sample"], plan=self.plan,
+                        file_paths=file_paths)
+                failures = move_24_ahead(
+                    self.input_dir, self.fhir_base_url, num_days, plan=self.plan,
+                    cache=self.cache, uploader=self.make_uploader(journal), journal=journal,
+                    file_paths=file_paths)
+            finally:
+                if not options["keep_export"]:
+                    for file_path in file_paths:
+                        if os.path.exists(file_path):
+                            os.remove(file_path)
+            print(f"store {self.name}: journal run {journal.run_id}: {journal.counts()}")
+            if not failures:
+                journal.complete_run(record_warp=not types)
+            return failures
+        finally:
+            journal.close()
+
+    def close(self):
+        self.session.close()
+        self.download_session.close()
+
+
+class WarpService:
+    """Queue of warps, run one at a time on a worker thread, and the stores' schedules"""
+
+    def __init__(self, stores: List[Store]):
+        self.stores = {store.name: store for store in stores}
+        self.current: Optional[dict] = None
+        self.queued: List[dict] = []
+        self.recent = deque(maxlen=HISTORY)
+        now = datetime.now()
+        self.next_runs = {store.name: store.next_run(now) for store in stores}
+        self._ids = count(1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def request(
+            self, store_name: str, trigger: str = "request", types: List[str] = None) -> dict:
+        """Queue a warp of the named store; returns it, see `status()`
+
+        :param types: a catch-up of only these resource types, see `Store.warp()`
+        :raises KeyError: if there's no such store
+        """
+        if store_name not in self.stores:
+            raise KeyError(store_name)
+        warp = {
+            "id": next(self._ids), "store": store_name, "trigger": trigger, "state": "queued",
+            "queued": _now(), "types": types}
+        with self._lock:
+            self.queued.append(warp)
+        self._queue.put(warp)
+        return dict(warp)
+
+    def run(self, warp: dict):
+        """Run a queued warp
+
+        Its state becomes `completed`, or `failed` with an error or failed uploads.
+        """
+        with self._lock:
+            self.queued.remove(warp)
+            warp.update(state="running", started=_now())
+            self.current = warp
+        METRICS.reset()
+        print(f"warp {warp['id']} of {warp['store']} ({warp['trigger']}) started")
+        try:
+            failures = self.stores[warp["store"]].warp(types=warp["types"])
+            warp.update(state="failed" if failures else "completed", failures=len(failures))
+        except (Exception, SystemExit) as e:  # export failures exit
+            warp.update(state="failed", error=str(e) or type(e).__name__)
+        finally:
+            metrics = METRICS.to_dict()
+            with self._lock:
+                warp.update(finished=_now(), metrics=metrics)
+                self.current = None
+                self.recent.append(warp)
+        print(f"warp {warp['id']} of {warp['store']} {warp['state']}")
+
+    def _work(self):
+        while (warp := self._queue.get()) is not None and not self._stopped.is_set():
+            self.run(warp)
+
+    def schedule_due(self, now: datetime):
+        """Queue the scheduled warps due by now, unless one of the store is already queued"""
+        for name, scheduled in self.next_runs.items():
+            if scheduled is None or scheduled > now:
+                continue
+            self.next_runs[name] = self.stores[name].next_run(now)
+            with self._lock:
+                already_queued = any(
+                    warp["store"] == name and not warp["types"] for warp in self.queued)
+            if not already_queued:
+                self.request(name, trigger="schedule")
+
+    def _schedule(self):
+        while not self._stopped.is_set():
+            now = datetime.now()
+            self.schedule_due(now)
+            upcoming = [scheduled for scheduled in self.next_runs.values() if scheduled]
+            wait = min(upcoming) - now if upcoming else timedelta(minutes=1)
+            self._stopped.wait(min(max(wait.total_seconds(), 0.0), 60.0))
+
+    def status(self) -> dict:
+        with self._lock:
+            current = dict(self.current, metrics=METRICS.to_dict()) if self.current else None
+            return {
+                "current": current,
+                "queued": [dict(warp) for warp in self.queued],
+                "recent": [dict(warp) for warp in self.recent],
+                "next_scheduled": {
+                    name: scheduled.isoformat(timespec="seconds") if scheduled else None
+                    for name, scheduled in self.next_runs.items()},
+            }
+
+    def start(self):
+        for target, name in ((self._work, "warp-worker"), (self._schedule, "warp-scheduler")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop scheduling, and wait for the current warp (but not those queued) to finish"""
+        self._stopped.set()
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for store in self.stores.values():
+            store.close()
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """The control endpoint, see module docstring"""
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body, content_type: str = "application/json"):
+        if not isinstance(body, str):
+            body = json.dumps(body, indent=2)
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse(self.path).path.rstrip("/")
+        if path == "/status":
+            return self._send(200, service.status())
+        if path == "/stores":
+            next_scheduled = service.status()["next_scheduled"]
+            return self._send(200, [
+                dict(store.describe(), next_scheduled=next_scheduled[name])
+                for name, store in service.stores.items()])
+        if path == "/metrics":
+            return self._send(200, METRICS.to_prometheus(), "text/plain; version=0.0.4")
+        self._send(404, {"error": f"no such endpoint: {path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/warp":
+            return self._send(404, {"error": f"no such endpoint: {url.path}"})
+        query = parse_qs(url.query)
+        store_name = query.get("store", [None])[0]
+        types = [
+            resource_type for value in query.get("type", [])
+            for resource_type in value.split(",") if resource_type] or None
+        try:
+            warp = self.server.service.request(store_name, types=types)
+        except KeyError:
+            return self._send(404, {"error": f"no such store: {store_name}"})
+        self._send(202, warp)
+
+
+class ControlServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service: WarpService, host: str = "127.0.0.1", port: int = 8090):
+        super().__init__((host, port), ControlHandler)
+        self.service = service
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def load_stores(config_path: str) -> List[Store]:
+    """Stores of the JSON config file; raises ValueError if invalid"""
+    with open(config_path, 'r') as config_file:
+        config = json.load(config_file)
+    stores = []
+    for options in config.get("stores", []):
+        options = dict(options)
+        try:
+            name, fhir_base_url = options.pop("name"), options.pop("fhir_base_url")
+        except KeyError as e:
+            raise ValueError(f"store missing {e}")
+        stores.append(Store(name, fhir_base_url, **options))
+    names = [store.name for store in stores]
+    if not stores or len(set(names)) != len(names):
+        raise ValueError("config requires one or more stores, with distinct names")
+    return stores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run timewarp as a resident service")
+    parser.add_argument(
+        "config", help="JSON file configuring the stores to warp, see module docstring")
+    parser.add_argument(
+        "--host", action="store", help="Address of the control endpoint; keep it local",
+        default="127.0.0.1")
+    parser.add_argument(
+        "--port", action="store", help="Port of the control endpoint", type=int, default=8090)
+    parser.add_argument(
+        "--progress-interval", action="store", help="Seconds between progress lines",
+        type=float, default=10.0)
+
+    args = parser.parse_args()
+    try:
+        stores = load_stores(args.config)
+    except (OSError, ValueError) as e:
+        parser.error(f"invalid config {args.config}: {e}")
+    METRICS.progress_interval = args.progress_interval
+    service = WarpService(stores)
+    server = ControlServer(service, host=args.host, port=args.port)
+    service.start()
+    for name, scheduled in service.status()["next_scheduled"].items():
+        print(f"store {name}: next warp {scheduled or 'on demand only'}")
+    print(f"control endpoint at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Deterministic sharding of a timewarp run across multiple nodes
+
+Each node runs timewarp with `--shard i/N` (i from 0 to N-1) against a
+shared export, and shifts and uploads only the resources whose stable hash
+of `resourceType/id` falls in its shard.  Every node writes a summary of
+its slice: counts, and an order independent fingerprint of the references
+it processed (the sum of their hashes).  The fingerprints of the N slices
+add up to that of the whole export exactly when no resource was missed or
+processed twice, which the `merge` command checks:
+
+    python shard.py merge shard-*-of-4.json [--verify [--source-dir DIR]]
+
+The export is shared: one export, i.e. by `api.py` without `--shard`, on
+storage every node mounts, each node then run with `--skip-export`.  Source
+files are recorded by name, relative to the export directory, so summaries
+agree wherever each node mounts it; `--verify` reads them from the export
+directory recorded by the first summary, unless given another.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from typing import Iterable, List, NamedTuple, Tuple
+
+from input_util import next_json_object
+from line_index import LineIndex
+
+_FINGERPRINT_MODULUS = 2 ** 128
+
+
+def reference_hash(reference: str) -> int:
+    """Stable 128 bit hash of a `resourceType/id` reference"""
+    return int.from_bytes(hashlib.blake2b(reference.encode(), digest_size=16).digest(), "big")
+
+
+class Shard(NamedTuple):
+    """Slice `index` of `count`, of the resources of a run"""
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, value: str) -> 'Shard':
+        """Parse `i/N`, raising ValueError unless 0 <= i < N"""
+        index, _, count = value.partition('/')
+        shard = cls(int(index), int(count))
+        if not 0 <= shard.index < shard.count:
+            raise ValueError(f"invalid shard {value}; expected i/N, with 0 <= i < N")
+        return shard
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    def owns(self, reference: str) -> bool:
+        return reference_hash(reference) % self.count == self.index
+
+
+class ShardSummary:
+    """Accounting of the resources a node processed for its shard
+
+    Source files are recorded relative to `source_dir`, the export directory.
+    """
+
+    def __init__(
+            self, shard: Shard, num_days: int, sources: List[str] = None,
+            source_dir: str = None):
+        self.shard = shard
+        self.num_days = num_days
+        self.source_dir = source_dir
+        self.sources = sorted(
+            os.path.relpath(file_path, source_dir) if source_dir else file_path
+            for file_path in sources or [])
+        self.resources = 0
+        self.changed = 0
+        self.fingerprint = 0
+
+    def owns(self, reference: str) -> bool:
+        return self.shard.owns(reference)
+
+    def add(self, reference: str, changed: bool = False):
+        """Count a resource of the shard, processed"""
+        self.merge(1, int(changed), reference_hash(reference))
+
+    def merge(self, resources: int, changed: int, fingerprint: int):
+        """Count resources processed elsewhere, i.e. by a worker process"""
+        self.resources += resources
+        self.changed += changed
+        self.fingerprint = (self.fingerprint + fingerprint) % _FINGERPRINT_MODULUS
+
+    def to_dict(self, uploaded: int = 0, failures: List[dict] = ()) -> dict:
+        return {
+            "shard": str(self.shard),
+            "num_days": self.num_days,
+            "source_dir": self.source_dir,
+            "sources": self.sources,
+            "resources": self.resources,
+            "changed": self.changed,
+            "uploaded": uploaded,
+            "failures": list(failures),
+            "fingerprint": f"{self.fingerprint:032x}",
+        }
+
+    def save(self, file_path: str, uploaded: int = 0, failures: List[dict] = ()):
+        with open(file_path, 'w') as summary_file:
+            json.dump(self.to_dict(uploaded, failures), summary_file, indent=2)
+
+
+def sources_fingerprint(sources: Iterable[str]) -> Tuple[int, int]:
+    """Number and fingerprint of all the resources found in the given files
+
+    Files with a current line index (see `line_index`) aren't parsed; the
+    references it holds are summed.
+    """
+    resources = fingerprint = 0
+    for file_path in sources:
+        index = LineIndex.load(file_path)
+        if index is not None:
+            with index:
+                resources += len(index)
+                fingerprint += sum(
+                    reference_hash(index.reference(position)) for position in range(len(index)))
+            continue
+        for data in next_json_object(file_path):
+            resources += 1
+            fingerprint += reference_hash(f"{data['resourceType']}/{data['id']}")
+    return resources, fingerprint % _FINGERPRINT_MODULUS
+
+
+def merge_summaries(
+        summaries: List[dict], verify: bool = False, source_dir: str = None) -> dict:
+    """Merge the summaries of every shard of a run
+
+    :param verify: also check the merged fingerprint against the resources
+      of the (shared, local) source files
+    :param source_dir: directory of the source files to verify, defaults to
+      that recorded by the first summary
+    :returns: the merged summary, with a list of `errors`, empty if the
+      shards are consistent and complete
+    """
+    errors = []
+    shards = [Shard.parse(summary["shard"]) for summary in summaries]
+    count = shards[0].count if shards else 0
+    if any(shard.count != count for shard in shards):
+        errors.append("summaries from runs with different shard counts")
+    indices = sorted(shard.index for shard in shards)
+    missing = sorted(set(range(count)) - set(indices))
+    if missing:
+        errors.append(f"missing shard(s) {', '.join(f'{i}/{count}' for i in missing)}")
+    duplicated = sorted({i for i in indices if indices.count(i) > 1})
+    if duplicated:
+        errors.append(f"duplicate shard(s) {', '.join(f'{i}/{count}' for i in duplicated)}")
+    for key in ("num_days", "sources"):
+        if len({json.dumps(summary[key]) for summary in summaries}) > 1:
+            errors.append(f"shards disagree on {key}")
+
+    merged = {
+        "shards": count,
+        "num_days": summaries[0]["num_days"] if summaries else None,
+        "sources": summaries[0]["sources"] if summaries else [],
+        "failures": [failure for summary in summaries for failure in summary["failures"]],
+    }
+    for key in ("resources", "changed", "uploaded"):
+        merged[key] = sum(summary[key] for summary in summaries)
+    fingerprint = sum(
+        int(summary["fingerprint"], 16) for summary in summaries) % _FINGERPRINT_MODULUS
+    merged["fingerprint"] = f"{fingerprint:032x}"
+
+    if verify:
+        if source_dir is None and summaries:
+            source_dir = summaries[0].get("source_dir")
+        file_paths = [os.path.join(source_dir or '', source) for source in merged["sources"]]
+        missing = [file_path for file_path in file_paths if not os.path.isfile(file_path)]
+        if missing:
+            errors.append(f"can't verify, source file(s) not found: {', '.join(missing)}")
+        else:
+            resources, expected = sources_fingerprint(file_paths)
+            if (resources, expected) != (merged["resources"], fingerprint):
+                errors.append(
+                    f"shards processed {merged['resources']} resource(s), sources hold "
+                    f"{resources}; fingerprints "
+                    f"{'match' if expected == fingerprint else 'differ'}")
+    if merged["failures"]:
+        errors.append(f"{len(merged['failures'])} resource(s) failed to upload")
+    merged["errors"] = errors
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coordinate a timewarp run sharded across nodes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    merge = subparsers.add_parser("merge", help="Merge and check the per shard summaries of a run")
+    merge.add_argument("summaries", nargs="+", help="Summary files written by each shard")
+    merge.add_argument(
+        "--verify", action="store_true",
+        help="Check the shards' fingerprint against the (local) source files")
+    merge.add_argument(
+        "--source-dir", action="store",
+        help="Directory of the source files to --verify, defaults to that of the summaries")
+    merge.add_argument("--output", action="store", help="Save the merged summary to the given file")
+
+    args = parser.parse_args()
+    summaries = []
+    for file_path in args.summaries:
+        with open(file_path, 'r') as summary_file:
+            summaries.append(json.load(summary_file))
+    merged = merge_summaries(summaries, verify=args.verify, source_dir=args.source_dir)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(merged, output_file, indent=2)
+    print(
+        f"{merged['shards']} shard(s): {merged['resources']} resource(s), "
+        f"{merged['changed']} changed, {merged['uploaded']} uploaded")
+    for error in merged["errors"]:
+        print(f"error: {error}", file=sys.stderr)
+    if merged["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,189 @@
-from datetime import datetime, timedelta, date
-from typing import List, Union
+from bisect import bisect_left
+from collections import OrderedDict
+import re
+from typing import List, Optional, Tuple, Union
+
+# FHIR date, dateTime and instant lexical forms; the time, fraction and offset
+# following the calendar date are left untouched by a shift
+_FHIR_TIME_PATTERN = (
+    r'T(?:[01][0-9]|2[0-3]):[0-5][0-9]:(?:[0-5][0-9]|60)(?:\.[0-9]+)?'
+    r'(?:Z|[+-][0-9]{2}:[0-9]{2})?')
+_FHIR_DATE = re.compile(
+    r'([0-9]{4})(?:-(0[1-9]|1[0-2])(?:-(0[1-9]|[12][0-9]|3[01])'
+    r'(?:' + _FHIR_TIME_PATTERN + r')?)?)?')
+_FHIR_TIME = re.compile(_FHIR_TIME_PATTERN)
+
+# Day number tables: days before each month (common and leap year), and before each year
+_DAYS_BEFORE_MONTH = (
+    (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365),
+    (0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366),
+)
+_DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_TWO_DIGITS = tuple(f"{i:02d}" for i in range(100))
+_MIN_YEAR, _MAX_YEAR = 1, 9999
+# Element names FHIR (R4) declares a date, dateTime or instant, but for choice
+# elements, named for their type (i.e. `valueDate`, `onsetDateTime`), and the
+# many named `...Date`; see `declares_date()`
+DATE_ELEMENTS = frozenset((
+    "asserted", "authored", "authoredOn", "created", "date", "dateAsserted", "end",
+    "issued", "lastUpdated", "received", "recorded", "sent", "start", "time", "timestamp",
+    "when", "whenHandedOver", "whenPrepared",
+))
+# Days and months of the 400 year Gregorian cycle, for whole months in a number of days
+_DAYS_PER_CYCLE, _MONTHS_PER_CYCLE = 146097, 4800
+
+
+_IS_LEAP = bytes(
+    int(year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)) for year in range(_MAX_YEAR + 1))
+
+
+def _build_days_before_year() -> List[int]:
+    days_before = [0] * (_MAX_YEAR + 2)
+    for year in range(_MIN_YEAR, _MAX_YEAR + 1):
+        days_before[year + 1] = days_before[year] + _DAYS_BEFORE_MONTH[_IS_LEAP[year]][12]
+    return days_before
+
+
+_DAYS_BEFORE_YEAR = _build_days_before_year()
+
+
+def _shift_ymd(year: int, month: int, day: int, num_days: int) -> Optional[str]:
+    """Add num_days to a calendar date via day numbers, None if out of range
+
+    :return: the shifted date as `YYYY-MM-DD`
+    """
+    day_number = (
+        _DAYS_BEFORE_YEAR[year] + _DAYS_BEFORE_MONTH[_IS_LEAP[year]][month - 1] + day + num_days)
+    if not _DAYS_BEFORE_YEAR[_MIN_YEAR] < day_number <= _DAYS_BEFORE_YEAR[_MAX_YEAR + 1]:
+        return None
+    year = bisect_left(_DAYS_BEFORE_YEAR, day_number) - 1
+    day_of_year = day_number - _DAYS_BEFORE_YEAR[year]
+    days_before_month = _DAYS_BEFORE_MONTH[_IS_LEAP[year]]
+    month = bisect_left(days_before_month, day_of_year)
+    return (
+        (str(year) if year >= 1000 else f"{year:04d}") + '-' + _TWO_DIGITS[month] + '-'
+        + _TWO_DIGITS[day_of_year - days_before_month[month - 1]])
+
+
+def declares_date(element: str) -> bool:
+    """True if FHIR declares the named element a date, dateTime or instant
+
+    Only there may a bare four digit value be taken for a year; elsewhere
+    (i.e. `valueString`, `code`) it may as well be anything else.
+    """
+    return element.endswith(("Date", "DateTime", "Instant")) or element in DATE_ELEMENTS
+
+
+def whole_months(num_days: int) -> int:
+    """Whole (mean Gregorian) months in num_days, rounded down"""
+    return num_days * _MONTHS_PER_CYCLE // _DAYS_PER_CYCLE
+
+
+def partial_shift(num_days: int, offset: int = 0, period: int = 1) -> int:
+    """Periods of `period` months to shift a partial date, given days to shift and shifted
+
+    A partial date advances by the whole periods (months, or years) its
+    cumulative shift crosses, so the remainder of one shift carries to the
+    next; shifting one day at a time, it keeps pace with full dates.
+    """
+    return whole_months(offset + num_days) // period - whole_months(offset) // period
+
+
+def shift_date_value(
+        value: str, num_days: int, allow_year: bool = False, offset: int = 0) -> Optional[str]:
+    """
+    Shift a FHIR date, dateTime or instant value forward requested days
+
+    Only the calendar portion of the string is rewritten; time, fractional
+    seconds and offset text are preserved byte for byte.  Partial dates
+    (`YYYY-MM`, or `YYYY` when allowed) retain their precision, shifting
+    by whole months, see `partial_shift()`.
+
+    :param value: The string to shift
+    :param num_days: The number of days to move the date / datetime forward
+    :param allow_year: Treat a bare four digit value as a year; only safe when
+      the element is known to hold a date, as codes may look the same
+    :param offset: The days value was already shifted, i.e. by earlier runs
+    :return: The shifted value, or None if value isn't a valid date or datetime
+    """
+    length = len(value)
+    if length < 7 and not (allow_year and length == 4):
+        return None
+    match = _FHIR_DATE.fullmatch(value)
+    if match is None:
+        return None
+
+    year_text, month_text, day_text = match.groups()
+    year = int(year_text)
+    if year < _MIN_YEAR:
+        return None
+    if month_text is None:
+        year += partial_shift(num_days, offset, period=12)
+        return f"{year:04d}" if _MIN_YEAR <= year <= _MAX_YEAR else None
+
+    month = int(month_text)
+    if day_text is None:
+        year, month = divmod(year * 12 + month - 1 + partial_shift(num_days, offset), 12)
+        return f"{year:04d}-{_TWO_DIGITS[month + 1]}" if _MIN_YEAR <= year <= _MAX_YEAR else None
+
+    day = int(day_text)
+    days_in_month = _DAYS_IN_MONTH[month] if month != 2 else 28 + _IS_LEAP[year]
+    if day > days_in_month:
+        return None
+    if 0 < day + num_days <= days_in_month:
+        # common case, shift within the same month
+        return value[:8] + _TWO_DIGITS[day + num_days] + value[10:]
+    shifted = _shift_ymd(year, month, day, num_days)
+    return shifted and shifted + value[10:]
+
+
+class ShiftCache:
+    """Bounded LRU memo of shifted values, keyed by (raw string, num_days, offset)
+
+    Only partial dates depend on the offset; other values are keyed with 0,
+    so entries serve resources of any offset, as the runs of a journal.
+
+    Strings found not to be dates are cached too (as None), so repeated
+    codes and identifiers skip the parse attempt as well.  Share a single
+    instance across all resources of a run; `hits` and `misses` report
+    effectiveness for tuning `maxsize`.
+    """
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[Tuple[str, int, int], Optional[str]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def shift(self, value: str, num_days: int, offset: int = 0) -> Optional[str]:
+        """Cached equivalent of `shift_date_value()`"""
+        key = (value, num_days, offset if len(value) < 10 else 0)
+        shifted = self._cache.get(key, self._MISSING)
+        if shifted is not self._MISSING:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return shifted
+
+        self.misses += 1
+        shifted = shift_date_value(value, num_days, offset=offset)
+        self._cache[key] = shifted
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return shifted
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+        }
 
 
 def timeshift_json(
@@ -20,20 +204,11 @@ def timeshift_json(
         if key in exclusion_list:
             return value
 
-        # Try to parse the value as a date or datetime and add requested days
         if isinstance(value, str):
-            try:
-                d = date.fromisoformat(value)
-                return (d + timedelta(days=num_days)).isoformat()
-            except ValueError:
-                try:
-                    dt = datetime.fromisoformat(value)
-                    result = (dt + timedelta(days=num_days)).isoformat()
-                    # prefer Z if offset is GMT
-                    return result.replace("+00:00", "Z")
-                except ValueError:
-                    return value  # Return unchanged if not a valid datetime or date
-        return value
+            shifted = shift_date_value(value, num_days)
+            if shifted is not None:
+                return shifted
+        return value  # Return unchanged if not a valid datetime or date
 
     if isinstance(data, dict):
         return {key: timeshift_json(value, num_days, exclusion_list)
@@ -44,3 +219,135 @@ def timeshift_json(
     else:
         return data  # Base case: return data unchanged
 
+
+def _shift(
+        value: str, num_days: int, cache: Optional[ShiftCache],
+        allow_year: bool = False, offset: int = 0) -> Optional[str]:
+    if allow_year and len(value) == 4:
+        return shift_date_value(value, num_days, allow_year=True, offset=offset)
+    if cache is not None:
+        return cache.shift(value, num_days, offset)
+    return shift_date_value(value, num_days, offset=offset)
+
+
+def _json_pointer(path: List[Union[str, int]]) -> str:
+    """Render path components as a JSON Pointer (RFC 6901)"""
+    return ''.join(
+        '/' + str(p).replace('~', '~0').replace('/', '~1') for p in path)
+
+
+def timeshift_json_in_place(
+        data: Union[dict, list],
+        num_days: int,
+        exclusion_list: List[str],
+        cache: ShiftCache = None,
+        offset: int = 0,
+        _path: List[Union[str, int]] = None) -> List[str]:
+    """
+    Recursively updates, in place, date and datetime elements in a JSON-like object,
+    while skipping keys in the exclusion list.
+
+    Nothing is copied; the changes are tracked as they're made.
+
+    :param data: The JSON-like object (dict or list) to process.
+    :param num_days: The number of days to move all date / datetime elements forward
+    :param exclusion_list: A list of keys to exclude from modification.
+    :param cache: Optional shared cache of shifted values
+    :param offset: The days data was already shifted, see `shift_date_value()`
+    :return: JSON Pointers to every element changed, empty if none
+    """
+    path = [] if _path is None else _path
+    changed = []
+    if isinstance(data, dict):
+        items = data.items()
+    elif isinstance(data, list):
+        items = enumerate(data)
+    else:
+        return changed
+
+    for key, value in items:
+        if isinstance(value, (dict, list)):
+            path.append(key)
+            changed.extend(
+                timeshift_json_in_place(value, num_days, exclusion_list, cache, offset, path))
+            path.pop()
+        elif isinstance(value, str) and isinstance(key, str) and key not in exclusion_list:
+            shifted = _shift(value, num_days, cache, offset=offset)
+            if shifted is not None and shifted != value:
+                data[key] = shifted
+                changed.append(_json_pointer(path + [key]))
+    return changed
+
+
+def timeshift_planned(
+        data: Union[dict, list],
+        plan_paths: dict,
+        num_days: int,
+        exclusion_list: List[str],
+        cache: ShiftCache = None,
+        offset: int = 0,
+        _path: List[Union[str, int]] = None) -> List[str]:
+    """
+    Updates, in place, date and datetime elements found at the paths of a compiled plan.
+
+    Only string leaves at the paths named in `plan_paths`, or of elements
+    declared dates (see `declares_date()`) the plan's sample never held, are
+    parsed; all others (narrative, codes, identifiers, etc.) are passed over
+    unexamined.  Bare years are shifted only at paths the plan marks as
+    declared dates, and at declared dates off the plan.
+
+    :param data: The JSON-like object (dict or list) to process.
+    :param plan_paths: The compiled path trie, see `TimeshiftPlan.paths_for()`
+    :param num_days: The number of days to move all date / datetime elements forward
+    :param exclusion_list: A list of keys to exclude from modification.
+    :param cache: Optional shared cache of shifted values
+    :param offset: The days data was already shifted, see `shift_date_value()`
+    :return: JSON Pointers to every element changed, empty if none
+    """
+    path = [] if _path is None else _path
+    changed = []
+    if isinstance(data, list):
+        for index, item in enumerate(data):
+            path.append(index)
+            changed.extend(
+                timeshift_planned(
+                    item, plan_paths, num_days, exclusion_list, cache, offset, path))
+            path.pop()
+        return changed
+    if not isinstance(data, dict):
+        return changed
+
+    for key, value in data.items():
+        if isinstance(value, str):
+            if key in exclusion_list:
+                continue
+            allow_year = _planned_year(key, value, plan_paths.get(key))
+            if allow_year is None:
+                continue
+            shifted = _shift(value, num_days, cache, allow_year=allow_year, offset=offset)
+            if shifted is not None and shifted != value:
+                data[key] = shifted
+                changed.append(_json_pointer(path + [key]))
+        elif isinstance(value, (dict, list)):
+            sub_paths = plan_paths.get(key)
+            path.append(key)
+            changed.extend(
+                timeshift_planned(
+                    value, _EMPTY_PLAN if sub_paths is None else sub_paths, num_days,
+                    exclusion_list, cache, offset, path))
+            path.pop()
+    return changed
+
+
+# Plan of a branch the plan's sample never held; only declared dates are shifted
+_EMPTY_PLAN: dict = {}
+
+
+def _planned_year(key: str, value: str, sub_paths: Optional[dict]) -> Optional[bool]:
+    """Whether the string value at key is shifted, allowing a bare year; None if it isn't"""
+    if sub_paths is not None and None in sub_paths:
+        return sub_paths[None]
+    # a cheap test first rules out most strings that can't be dates
+    if (len(value) >= 7 and value[4] == '-' or len(value) == 4) and declares_date(key):
+        return True
+    return None
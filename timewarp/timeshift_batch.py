@@ -0,0 +1,225 @@
+"""Batch timeshift engine, shifting the date values of many resources at once
+
+An alternative to the value at a time walk of `timeshift_json_in_place()`
+and `timeshift_planned()`, with identical results.  Every candidate string
+leaf of a batch of JSON-like objects is first gathered into a flat list,
+each with a back-pointer to its container and key.  The distinct values are
+then parsed and shifted together, and the changes written back.
+
+With NumPy installed, the distinct values are parsed, validated and shifted
+as arrays, with `datetime64` arithmetic; only the time portion of datetimes
+is checked a value at a time.  Otherwise each distinct value is shifted
+once via `shift_date_value()`.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from timeshift import (
+    _DAYS_IN_MONTH,
+    _FHIR_TIME,
+    _IS_LEAP,
+    _MAX_YEAR,
+    _MIN_YEAR,
+    _EMPTY_PLAN,
+    _json_pointer,
+    _planned_year,
+    partial_shift,
+    shift_date_value,
+)
+
+try:
+    import numpy as np
+except ImportError:  # optional, see module docstring
+    np = None
+
+# Name of the kernel used by default, `numpy` or `python`
+KERNEL = "numpy" if np is not None else "python"
+
+# A gathered candidate: (item index, container, key, value, container path, and
+# the distinct values of its group, see `timeshift_batch()`)
+_Site = Tuple[int, dict, str, str, Tuple[Union[str, int], ...], dict]
+
+
+def _shift_values_python(
+        values: Sequence[str], num_days: int, allow_year: bool, offset: int) -> list:
+    return [
+        shift_date_value(value, num_days, allow_year=allow_year, offset=offset)
+        for value in values]
+
+
+def _shift_values_numpy(
+        values: Sequence[str], num_days: int, allow_year: bool, offset: int) -> list:
+    count = len(values)
+    shifted = [None] * count
+    if not count:
+        return shifted
+
+    # calendar portion as a (count, 10) array of code points, zero padded
+    codes = np.array(
+        [value[:10] for value in values], dtype="U10").view(np.uint32).reshape(count, 10)
+    lengths = np.fromiter(map(len, values), dtype=np.int64, count=count)
+    digits = (codes >= ord('0')) & (codes <= ord('9'))
+    numbers = codes.astype(np.int64) - ord('0')
+    years = numbers[:, 0] * 1000 + numbers[:, 1] * 100 + numbers[:, 2] * 10 + numbers[:, 3]
+    months = numbers[:, 5] * 10 + numbers[:, 6]
+    days = numbers[:, 8] * 10 + numbers[:, 9]
+
+    valid_year = digits[:, :4].all(axis=1) & (years >= _MIN_YEAR)
+    valid_month = (
+        valid_year & (codes[:, 4] == ord('-')) & digits[:, 5:7].all(axis=1)
+        & (months >= 1) & (months <= 12))
+    months = np.where(valid_month, months, 1)
+    leap = np.frombuffer(_IS_LEAP, dtype=np.uint8)[np.where(valid_year, years, 0)]
+    days_in_month = np.array(_DAYS_IN_MONTH)[months] + ((months == 2) & (leap == 1))
+    is_year = valid_year & (lengths == 4) if allow_year else np.zeros(count, dtype=bool)
+    is_month = valid_month & (lengths == 7)
+    is_date = (
+        valid_month & (lengths >= 10) & (codes[:, 7] == ord('-')) & digits[:, 8:].all(axis=1)
+        & (days >= 1) & (days <= days_in_month))
+    # anything past the calendar date must be a valid time
+    for index in np.flatnonzero(is_date & (lengths > 10)).tolist():
+        if _FHIR_TIME.fullmatch(values[index], 10) is None:
+            is_date[index] = False
+
+    precisions = np.select([is_date, is_month, is_year], [10, 7, 4], 0)
+    selected = np.flatnonzero(precisions)
+    if not len(selected):
+        return shifted
+    # partial dates shift by whole months (or years), full dates by days
+    partial_months = np.where(
+        is_year[selected], partial_shift(num_days, offset, period=12) * 12,
+        partial_shift(num_days, offset))
+    full = is_date[selected]
+    dates = (
+        (years[selected] - 1970).astype("datetime64[Y]")
+        + (months[selected] - 1 + np.where(full, 0, partial_months)).astype("timedelta64[M]")
+    ).astype("datetime64[D]") + np.where(full, days[selected] - 1 + num_days, 0)
+    shifted_years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+    in_range = ((shifted_years >= _MIN_YEAR) & (shifted_years <= _MAX_YEAR)).tolist()
+    formatted = np.datetime_as_string(dates, unit="D").tolist()
+
+    for index, precision, text, valid in zip(
+            selected.tolist(), precisions[selected].tolist(), formatted, in_range):
+        if valid:
+            shifted[index] = text[:precision] + values[index][precision:]
+    return shifted
+
+
+def shift_values(
+        values: Sequence[str], num_days: int, allow_year: bool = False,
+        kernel: str = None, offset: int = 0) -> List[Optional[str]]:
+    """Shift each of values as `shift_date_value()` would, as one batch
+
+    :param kernel: `numpy` or `python`, defaults to `KERNEL`
+    :returns: per value, the shifted value or None if not a date
+    """
+    kernel = kernel or KERNEL
+    if kernel == "numpy":
+        if np is None:
+            raise ValueError("numpy kernel requested, but numpy isn't installed")
+        return _shift_values_numpy(values, num_days, allow_year, offset)
+    if kernel == "python":
+        return _shift_values_python(values, num_days, allow_year, offset)
+    raise ValueError(f"unknown kernel: {kernel}")
+
+
+def _gather_tree(
+        data: Union[dict, list], exclusion_list: List[str], index: int, distinct: dict,
+        sites: List[_Site], path: List[Union[str, int]]):
+    """Gather candidates as `timeshift_json_in_place()` visits them"""
+    if isinstance(data, dict):
+        items = data.items()
+    elif isinstance(data, list):
+        items = enumerate(data)
+    else:
+        return
+
+    container_path = None
+    for key, value in items:
+        if isinstance(value, (dict, list)):
+            path.append(key)
+            _gather_tree(value, exclusion_list, index, distinct, sites, path)
+            path.pop()
+        # a cheap test first rules out most strings that can't be dates
+        elif (isinstance(value, str) and len(value) >= 7 and value[4] == '-'
+                and isinstance(key, str) and key not in exclusion_list):
+            if container_path is None:
+                container_path = tuple(path)
+            distinct[value] = None
+            sites.append((index, data, key, value, container_path, distinct))
+
+
+def _gather_planned(
+        data: Union[dict, list], plan_paths: dict, exclusion_list: List[str], index: int,
+        distinct: dict, year_distinct: dict, sites: List[_Site], path: List[Union[str, int]]):
+    """Gather candidates as `timeshift_planned()` visits them"""
+    if isinstance(data, list):
+        for item_index, item in enumerate(data):
+            path.append(item_index)
+            _gather_planned(
+                item, plan_paths, exclusion_list, index, distinct, year_distinct, sites, path)
+            path.pop()
+        return
+    if not isinstance(data, dict):
+        return
+
+    container_path = None
+    for key, value in data.items():
+        if isinstance(value, str):
+            if key in exclusion_list:
+                continue
+            allow_year = _planned_year(key, value, plan_paths.get(key))
+            if allow_year is None or not (
+                    len(value) >= 7 and value[4] == '-' or len(value) == 4 and allow_year):
+                continue
+            if container_path is None:
+                container_path = tuple(path)
+            group = year_distinct if len(value) == 4 else distinct
+            group[value] = None
+            sites.append((index, data, key, value, container_path, group))
+        elif isinstance(value, (dict, list)):
+            sub_paths = plan_paths.get(key)
+            path.append(key)
+            _gather_planned(
+                value, _EMPTY_PLAN if sub_paths is None else sub_paths, exclusion_list, index,
+                distinct, year_distinct, sites, path)
+            path.pop()
+
+
+def timeshift_batch(
+        items: Sequence[Tuple[Union[dict, list], int, List[str], Optional[dict], int]],
+        kernel: str = None) -> List[List[str]]:
+    """
+    Updates, in place, date and datetime elements of a batch of JSON-like objects.
+
+    :param items: per object, (data, num_days, exclusion_list, plan_paths, offset);
+      given plan_paths (see `TimeshiftPlan.paths_for()`) only those paths are
+      visited, as by `timeshift_planned()`, otherwise all, as by
+      `timeshift_json_in_place()`; offset is the days data was already shifted
+    :param kernel: `numpy` or `python`, see `shift_values()`
+    :return: per object, JSON Pointers to every element changed, in the order
+      the equivalent walk would report them
+    """
+    # distinct values, mapped to their shifted value, per (num_days, offset, allow_year)
+    groups: Dict[Tuple[int, int, bool], Dict[str, Optional[str]]] = {}
+    sites: List[_Site] = []
+    for index, (data, num_days, exclusion_list, plan_paths, offset) in enumerate(items):
+        distinct = groups.setdefault((num_days, offset, False), {})
+        if plan_paths is None:
+            _gather_tree(data, exclusion_list, index, distinct, sites, [])
+        else:
+            year_distinct = groups.setdefault((num_days, offset, True), {})
+            _gather_planned(
+                data, plan_paths, exclusion_list, index, distinct, year_distinct, sites, [])
+
+    for (num_days, offset, allow_year), distinct in groups.items():
+        values = list(distinct)
+        distinct.update(zip(
+            values, shift_values(values, num_days, allow_year, kernel, offset=offset)))
+
+    changed: List[List[str]] = [[] for _ in items]
+    for index, container, key, value, container_path, distinct in sites:
+        shifted = distinct[value]
+        if shifted is not None and shifted != value:
+            container[key] = shifted
+            changed[index].append(_json_pointer(container_path + (key,)))
+    return changed
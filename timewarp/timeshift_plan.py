@@ -0,0 +1,101 @@
+"""Compiled timeshift plans, indexing where date values live per resource type
+
+Walking every string leaf of every resource, attempting to parse each as a
+date, is wasteful; most leaves are narrative, codes, identifiers and URLs.
+A plan is learned from a sample of the data: for each `resourceType` the
+element paths (list indices ignored) found to hold date or datetime values
+are compiled into a trie, and on timeshift only string leaves at those
+paths are parsed.
+
+Values at elements FHIR declares dates (see `timeshift.declares_date()`)
+are shifted wherever they are, so a rare extension's `valueDateTime` or an
+`effectivePeriod` the sample never held isn't left behind.  Resource types
+absent from the plan fall back to the full tree walk, as do resources the
+plan finds no dates to shift in (counted as `resources_unplanned`, see
+`metrics`).  Otherwise, dates at undeclared elements (i.e. `valueString`)
+not represented in the sample are not shifted, so sample generously.
+"""
+import json
+from typing import Dict, List, Optional, Tuple, Union
+
+from timeshift import declares_date, shift_date_value
+
+
+class TimeshiftPlan:
+    """Per resource type trie of element paths holding date values
+
+    Each trie node is a dict keyed by element name; a `None` key marks a
+    node whose (string) value holds a date, True if the element is declared
+    a date type (see `timeshift.declares_date()`), where a bare year is
+    shifted too.
+    """
+
+    def __init__(self):
+        self.plans: Dict[str, dict] = {}
+
+    def __contains__(self, resource_type: str) -> bool:
+        return resource_type in self.plans
+
+    def paths_for(self, resource_type: str) -> Optional[dict]:
+        """Return compiled path trie for resource_type, None if not planned"""
+        return self.plans.get(resource_type)
+
+    def add_path(self, resource_type: str, path: Tuple[str, ...]):
+        """Add a single element path, i.e. ('period', 'start'), to the plan"""
+        node = self.plans.setdefault(resource_type, {})
+        for key in path:
+            node = node.setdefault(key, {})
+        node[None] = declares_date(path[-1])
+
+    def learn(self, resource_type: str, data: dict, exclusion_list: List[str]):
+        """Add paths of all date values found in data to the plan for resource_type
+
+        A type is only planned once a date is found in a resource of it.
+        """
+        def walk(value: Union[dict, list], path: Tuple[str, ...]):
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, (dict, list)):
+                        walk(item, path)
+                return
+            for key, item in value.items():
+                if isinstance(item, (dict, list)):
+                    walk(item, path + (key,))
+                elif (isinstance(item, str) and key not in exclusion_list
+                        and shift_date_value(item, 0) is not None):
+                    self.add_path(resource_type, path + (key,))
+
+        walk(data, ())
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        """Serializable form; dot delimited paths by resource type"""
+        def flatten(node: dict, prefix: str) -> List[str]:
+            paths = []
+            for key, child in node.items():
+                if key is None:
+                    paths.append(prefix)
+                else:
+                    paths.extend(flatten(child, f"{prefix}.{key}" if prefix else key))
+            return paths
+
+        return {
+            resource_type: sorted(flatten(node, ''))
+            for resource_type, node in sorted(self.plans.items())}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, List[str]]) -> 'TimeshiftPlan':
+        plan = cls()
+        for resource_type, paths in data.items():
+            plan.plans.setdefault(resource_type, {})
+            for path in paths:
+                plan.add_path(resource_type, tuple(path.split('.')))
+        return plan
+
+    def save(self, file_path: str):
+        with open(file_path, 'w') as plan_file:
+            json.dump(self.to_dict(), plan_file, indent=2)
+
+    @classmethod
+    def load(cls, file_path: str) -> 'TimeshiftPlan':
+        with open(file_path, 'r') as plan_file:
+            return cls.from_dict(json.load(plan_file))
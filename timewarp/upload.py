@@ -0,0 +1,448 @@
+"""Upload of time warped resources back to the FHIR store
+
+Uploaders accept changed resources via `submit()`, along with JSON
+Pointers to the elements changed via `submit_changes()`, or already
+serialized via `submit_serialized()`, and must be `close()`d to flush any
+pending work; `close()` returns the list of failures, each a dict with the
+resource `reference`, HTTP `status` and `diagnostics`.
+
+An optional listener (i.e. `journal.Journal`) is notified via its
+`uploaded(reference)` and `failed(reference)` methods as each resource
+upload completes.
+
+Requests are retried with exponential backoff on connection errors and
+429/502/503/504 responses, honoring any `Retry-After` header.  Request
+latency and outcomes are recorded in `metrics.METRICS`, which reports
+progress periodically rather than per request.
+"""
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import queue
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from json_codec import dumps, loads
+from metrics import METRICS
+
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+FHIR_JSON_HEADERS = {"Content-Type": "application/fhir+json"}
+JSON_PATCH_HEADERS = {"Content-Type": "application/json-patch+json"}
+# PATCH responses indicating the server doesn't support (JSON) Patch at all
+PATCH_UNSUPPORTED_STATUS_CODES = (405, 415, 501)
+
+# Relative reference and JSON body of a serialized resource
+Serialized = Tuple[str, bytes]
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """Session with keep-alive connections pooled for pool_size concurrent users"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait given a `Retry-After` header (delay-seconds or HTTP-date)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def request_with_retry(
+        session, method: str, url: str, max_retries: int = 5, backoff: float = 0.5,
+        max_backoff: float = 60.0, **kwargs) -> requests.Response:
+    """Issue request, retrying transient failures
+
+    The latency and status of each attempt are recorded in `METRICS`.
+
+    :returns: the final response; connection errors are raised once retries
+      are exhausted
+    """
+    with METRICS.stage("upload"):
+        for attempt in range(max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                _record_attempt(method, start, "error")
+                if attempt == max_retries:
+                    raise
+                delay = None
+            else:
+                _record_attempt(method, start, str(response.status_code))
+                if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                    return response
+                delay = parse_retry_after(response.headers.get("Retry-After"))
+            if delay is None:
+                delay = backoff * 2 ** attempt
+            time.sleep(min(delay, max_backoff))
+
+
+def _record_attempt(method: str, start: float, status: str):
+    METRICS.observe("upload_request_seconds", time.perf_counter() - start, method=method)
+    METRICS.count("upload_responses", method=method, status=status)
+
+
+def resource_reference(resource: dict) -> str:
+    """Relative reference, i.e. `Patient/123`, of the given resource"""
+    return f"{resource['resourceType']}/{resource['id']}"
+
+
+def json_patch(resource: dict, changed_paths: List[str]) -> bytes:
+    """JSON Patch (RFC 6902) replacing each changed element with its value in resource"""
+    operations = []
+    for pointer in changed_paths:
+        value = resource
+        for token in pointer.split('/')[1:]:
+            token = token.replace('~1', '/').replace('~0', '~')
+            value = value[int(token)] if isinstance(value, list) else value[token]
+        operations.append({"op": "replace", "path": pointer, "value": value})
+    return dumps(operations)
+
+
+def _diagnostics(response: requests.Response) -> str:
+    """Best effort summary from an error response, typically an OperationOutcome"""
+    try:
+        outcome = response.json()
+    except ValueError:
+        return response.text[:500]
+    return _outcome_diagnostics(outcome) or response.text[:500]
+
+
+def _outcome_diagnostics(outcome: dict) -> str:
+    if not isinstance(outcome, dict):
+        return ''
+    return "; ".join(
+        issue.get("diagnostics") or issue.get("code", '')
+        for issue in outcome.get("issue", []))
+
+
+class Uploader:
+    """Base uploader; `collect()` gathers serialized resources into units of work to `send()`
+
+    Subclasses implement `collect()`, `remaining()` and `send()`, the latter
+    safe to call from multiple threads.
+    """
+
+    def __init__(
+            self, fhir_base_url: str, session=None, max_retries: int = 5, listener=None):
+        self.fhir_base_url = fhir_base_url
+        self.session = session or make_session()
+        self.max_retries = max_retries
+        self.listener = listener
+        self.failures: List[dict] = []
+        self.uploaded = 0
+        self._lock = threading.Lock()
+
+    def collect(self, serialized: Serialized):
+        """Return a unit of work ready to send, or None if pending more"""
+        raise NotImplementedError
+
+    def remaining(self):
+        """Return any pending unit of work, or None"""
+        return None
+
+    def send(self, item):
+        raise NotImplementedError
+
+    def references(self, item) -> List[str]:
+        """References of the resources in a unit of work, as returned by `collect()`"""
+        return [item[0]]
+
+    def collect_changes(self, resource: dict, changed_paths: List[str]):
+        """As `collect()`, given the resource and JSON Pointers to the elements changed"""
+        return self.collect((resource_reference(resource), dumps(resource)))
+
+    def submit(self, resource: dict):
+        self.submit_serialized(resource_reference(resource), dumps(resource))
+
+    def submit_changes(self, resource: dict, changed_paths: List[str]):
+        item = self.collect_changes(resource, changed_paths)
+        if item is not None:
+            self.send(item)
+
+    def submit_serialized(self, reference: str, body: bytes):
+        item = self.collect((reference, body))
+        if item is not None:
+            self.send(item)
+
+    def close(self) -> List[dict]:
+        item = self.remaining()
+        if item is not None:
+            self.send(item)
+        return self.failures
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        return request_with_retry(
+            self.session, method, url, max_retries=self.max_retries, **kwargs)
+
+    def _succeed(self, reference: str):
+        with self._lock:
+            self.uploaded += 1
+        METRICS.count("resources_uploaded")
+        METRICS.progress()
+        if self.listener is not None:
+            self.listener.uploaded(reference)
+
+    def _fail(self, reference: str, status, diagnostics: str):
+        failure = {
+            "reference": reference,
+            "status": status,
+            "diagnostics": diagnostics,
+        }
+        print(f"failed to upload {failure}", file=sys.stderr)
+        with self._lock:
+            self.failures.append(failure)
+        METRICS.count("resources_failed")
+        METRICS.progress()
+        if self.listener is not None:
+            self.listener.failed(reference)
+
+
+class PutUploader(Uploader):
+    """PUT each changed resource individually"""
+
+    def collect(self, serialized: Serialized):
+        return serialized
+
+    def send(self, serialized: Serialized):
+        reference, body = serialized
+        url = f"{self.fhir_base_url}{reference}"
+        try:
+            response = self._request("PUT", url, data=body, headers=FHIR_JSON_HEADERS)
+        except requests.exceptions.RequestException as e:
+            return self._fail(reference, None, str(e))
+        if not response.ok:
+            return self._fail(reference, response.status_code, _diagnostics(response))
+        self._succeed(reference)
+
+
+class PatchUploader(PutUploader):
+    """PATCH only the changed elements of each resource, as a JSON Patch
+
+    Falls back to PUT of the whole resource when the server rejects the
+    patch; after a response indicating PATCH isn't supported at all, every
+    resource is PUT.  Resources submitted already serialized, without their
+    changed paths, are always PUT.
+    """
+
+    def __init__(
+            self, fhir_base_url: str, session=None, max_retries: int = 5, listener=None):
+        super().__init__(
+            fhir_base_url, session=session, max_retries=max_retries, listener=listener)
+        self.patch_supported = True
+
+    def collect(self, serialized: Serialized):
+        reference, body = serialized
+        return reference, None, body
+
+    def collect_changes(self, resource: dict, changed_paths: List[str]):
+        return resource_reference(resource), json_patch(resource, changed_paths), resource
+
+    def send(self, item: Tuple[str, Optional[bytes], object]):
+        reference, patch, resource = item
+        if patch is not None and self.patch_supported:
+            url = f"{self.fhir_base_url}{reference}"
+            try:
+                response = self._request("PATCH", url, data=patch, headers=JSON_PATCH_HEADERS)
+            except requests.exceptions.RequestException as e:
+                return self._fail(reference, None, str(e))
+            if response.ok:
+                return self._succeed(reference)
+            if response.status_code in PATCH_UNSUPPORTED_STATUS_CODES:
+                print(
+                    f"PATCH unsupported ({response.status_code}), falling back to PUT",
+                    file=sys.stderr)
+                self.patch_supported = False
+            else:
+                print(
+                    f"PATCH of {reference} rejected ({response.status_code}), retrying as PUT",
+                    file=sys.stderr)
+        body = resource if isinstance(resource, bytes) else dumps(resource)
+        super().send((reference, body))
+
+
+class BundleUploader(Uploader):
+    """Collect changed resources into `batch` or `transaction` Bundles to POST
+
+    Each Bundle holds up to `bundle_size` PUT entries.  A Bundle rejected as
+    a whole for its content (a 4xx: too large, or for a transaction, any
+    failed entry) is split in half and each half retried, down to single
+    entries, which isolates the failing resources.  Failed entries of a
+    batch response are reported per resource, as are all those of a Bundle
+    failing otherwise, or answered with an unexpected response.
+    """
+
+    def __init__(
+            self, fhir_base_url: str, bundle_size: int = 100, bundle_type: str = "batch",
+            session=None, max_retries: int = 5, listener=None):
+        if bundle_type not in ("batch", "transaction"):
+            raise ValueError(f"unsupported bundle type: {bundle_type}")
+        super().__init__(
+            fhir_base_url, session=session, max_retries=max_retries, listener=listener)
+        self.bundle_size = bundle_size
+        self.bundle_type = bundle_type
+        self.pending: List[Serialized] = []
+
+    def collect(self, serialized: Serialized):
+        self.pending.append(serialized)
+        if len(self.pending) >= self.bundle_size:
+            return self.remaining()
+
+    def remaining(self):
+        resources, self.pending = self.pending, []
+        return resources or None
+
+    def references(self, resources: List[Serialized]) -> List[str]:
+        return [reference for reference, _ in resources]
+
+    def flush(self):
+        item = self.remaining()
+        if item is not None:
+            self.send(item)
+
+    def _bundle(self, resources: List[Serialized]) -> bytes:
+        """Assemble Bundle JSON from the serialized resources, without re-serializing"""
+        entries = b",".join(
+            b'{"resource":%s,"request":{"method":"PUT","url":%s}}' % (
+                body, dumps(reference))
+            for reference, body in resources)
+        return b'{"resourceType":"Bundle","type":"%s","entry":[%s]}' % (
+            self.bundle_type.encode(), entries)
+
+    def send(self, resources: List[Serialized]):
+        try:
+            response = self._request(
+                "POST",
+                self.fhir_base_url.rstrip('/'),
+                data=self._bundle(resources),
+                headers=FHIR_JSON_HEADERS)
+        except requests.exceptions.RequestException as e:
+            status, diagnostics = None, str(e)
+        else:
+            if response.ok:
+                return self._check_entries(resources, response)
+            status, diagnostics = response.status_code, _diagnostics(response)
+
+        if len(resources) > 1 and _rejected_content(status):
+            # re-split and retry, isolating failing entries
+            middle = len(resources) // 2
+            print(
+                f"{self.bundle_type} of {len(resources)} failed ({status}), retrying split",
+                file=sys.stderr)
+            self.send(resources[:middle])
+            self.send(resources[middle:])
+            return
+        for reference, _ in resources:
+            self._fail(reference, status, diagnostics)
+
+    def _check_entries(self, resources: List[Serialized], response: requests.Response):
+        """Record per entry outcome of a batch-response or transaction-response"""
+        try:
+            entries = loads(response.content)["entry"]
+            outcomes = [
+                (entry["response"]["status"], entry["response"].get("outcome"))
+                for entry in entries]
+            if len(outcomes) != len(resources):
+                raise ValueError(f"{len(outcomes)} entries returned")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            for reference, _ in resources:
+                self._fail(reference, response.status_code, f"unexpected response; {e!r}")
+            return
+        for (reference, _), (status, outcome) in zip(resources, outcomes):
+            status = str(status)
+            if status[:1] in ('2', '3'):
+                self._succeed(reference)
+                continue
+            code = int(status.split()[0]) if status[:3].isdigit() else status
+            self._fail(reference, code, _outcome_diagnostics(outcome))
+
+
+def _rejected_content(status: Optional[int]) -> bool:
+    """True if a Bundle failed with status was rejected for its content, i.e. too large
+
+    Only then is it split to retry; connection errors, server errors and
+    throttling are already retried by `request_with_retry()`, and would
+    only fail again, once per half.
+    """
+    return status is not None and 400 <= status < 500 and status not in RETRY_STATUS_CODES
+
+
+class ConcurrentUploader:
+    """Run the units of work of an uploader on a pool of worker threads
+
+    Work is handed to the workers through a bounded queue; `submit()` blocks
+    when the workers fall behind, keeping memory flat.
+    """
+    _DONE = object()
+
+    def __init__(self, uploader: Uploader, concurrency: int, queue_size: int = None):
+        self.uploader = uploader
+        self.queue = queue.Queue(maxsize=queue_size or concurrency * 2)
+        self.workers = [
+            threading.Thread(target=self._work, name=f"uploader-{i}", daemon=True)
+            for i in range(concurrency)]
+        for worker in self.workers:
+            worker.start()
+
+    @property
+    def failures(self) -> List[dict]:
+        return self.uploader.failures
+
+    @property
+    def uploaded(self) -> int:
+        return self.uploader.uploaded
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._DONE:
+                    return
+                self.uploader.send(item)
+            except Exception as e:
+                # i.e. an unparsable response; fail the work, rather than lose it
+                for reference in self.uploader.references(item):
+                    self.uploader._fail(reference, None, f"upload worker error: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def submit(self, resource: dict):
+        self.submit_serialized(resource_reference(resource), dumps(resource))
+
+    def submit_changes(self, resource: dict, changed_paths: List[str]):
+        item = self.uploader.collect_changes(resource, changed_paths)
+        if item is not None:
+            self.queue.put(item)
+
+    def submit_serialized(self, reference: str, body: bytes):
+        item = self.uploader.collect((reference, body))
+        if item is not None:
+            self.queue.put(item)
+
+    def close(self) -> List[dict]:
+        item = self.uploader.remaining()
+        if item is not None:
+            self.queue.put(item)
+        for _ in self.workers:
+            self.queue.put(self._DONE)
+        for worker in self.workers:
+            worker.join()
+        return self.uploader.failures